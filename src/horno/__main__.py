@@ -0,0 +1,5 @@
+import sys
+
+import horno.night
+
+sys.exit(horno.night.main())
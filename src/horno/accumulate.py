@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+
+import horno.image
+import horno.log
+
+
+def newstate(stack, sigma=3.0, paths=(), mask=None):
+    """
+    Return a new accumulation state from a stack of frames.
+
+    The state holds, for each pixel, the clipping bounds of a full
+    sigma-clipped combination of the stack, and the number, sum, and sum of
+    squares of the values that lie within those bounds. So initially, the
+    mean and standard deviation from :func:`meanandsigma` are exactly those
+    from :func:`horno.image.clippedmeanandsigma` with ``axis=0``.
+
+    Further frames are added by :func:`addframe`, which costs one pass over
+    the new frame, regardless of the number of frames already accumulated.
+    The bounds are not changed when frames are added, so the result stays
+    close to a full combination as long as the new frames are similar to the
+    original ones.
+
+    :param stack: The stack, with shape ``(nframes, ny, nx)``.
+    :param sigma: The number of standard deviations for the clipping bounds.
+        Defaults to 3.0.
+    :param paths: The paths of the frames in the stack. Defaults to ``()``.
+    :param mask: A stack of masks or quality planes, nonzero for the values
+        to ignore, or ``None``, as for :func:`horno.image.sigmaclippedstats`.
+        Defaults to ``None``.
+    :return: The state, as a dict.
+    """
+    lower, upper = horno.image.sigmaclippedbounds(stack, sigma=sigma, mask=mask)
+    shape = stack.shape[1:]
+    state = {
+        "sigma": float(sigma),
+        "lower": lower,
+        "upper": upper,
+        "n": np.zeros(shape, dtype="int32"),
+        "sum": np.zeros(shape, dtype="float64"),
+        "sumsq": np.zeros(shape, dtype="float64"),
+        "paths": [],
+    }
+    for i, data in enumerate(stack):
+        addframe(state, data, mask=None if mask is None else mask[i])
+    state["paths"] = list(paths)
+    return state
+
+
+def addframe(state, data, path=None, mask=None):
+    """
+    Add a frame to an accumulation state.
+
+    :param state: The state.
+    :param data: The frame.
+    :param path: The path of the frame, or ``None``. Defaults to ``None``.
+    :param mask: A mask or quality plane of the frame, nonzero for the values
+        to ignore, or ``None``. Defaults to ``None``.
+    """
+    with np.errstate(invalid="ignore"):
+        inside = (data >= state["lower"]) & (data <= state["upper"])
+    if mask is not None:
+        inside &= mask == 0
+    value = np.where(inside, data, 0).astype("float64")
+    state["n"] += inside
+    state["sum"] += value
+    state["sumsq"] += value * value
+    if path is not None:
+        state["paths"].append(path)
+    return
+
+
+def meanandsigma(state):
+    """
+    Return the mean and standard deviation images of an accumulation state.
+
+    :param state: The state.
+    :return: The mean and standard deviation images, as float32. Pixels with
+        no accumulated values are nan.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = state["sum"] / state["n"]
+        variance = state["sumsq"] / state["n"] - mean * mean
+    sigma = np.sqrt(np.maximum(variance, 0))
+    return mean.astype("float32"), sigma.astype("float32")
+
+
+def readstate(path, name=None):
+    """
+    Return an accumulation state read from a file, or ``None`` if the file
+    does not exist.
+
+    :param path: The path of the file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: The state or ``None``.
+    """
+    if not os.path.exists(path):
+        return None
+    if name is not None:
+        horno.log.info("%s: reading %s.", name, path)
+    with np.load(path) as npz:
+        state = {key: npz[key] for key in npz.files}
+    state["sigma"] = float(state["sigma"])
+    state["paths"] = list(str(path) for path in state["paths"])
+    return state
+
+
+def writestate(path, state, name=None):
+    """
+    Write an accumulation state to a file.
+
+    The state is written to a temporary file which then replaces the file, so
+    an interrupted write does not lose the previous state.
+
+    :param path: The path of the file. This should end with ``.npz``.
+    :param state: The state.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if name is not None:
+        horno.log.info("%s: writing %s.", name, path)
+    tmppath = path + ".tmp.npz"
+    np.savez(
+        tmppath,
+        **{key: value for key, value in state.items() if key != "paths"},
+        paths=np.array(state["paths"], dtype="str"),
+    )
+    os.replace(tmppath, path)
+    return
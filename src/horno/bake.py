@@ -1,34 +1,82 @@
+import collections
+import concurrent.futures
+import contextlib
+import inspect
+import io
 import math
 import os.path
+import shutil
+import sys
+import tempfile
 
 import numpy as np
 
+import horno.accumulate
+import horno.display
 import horno.fits
 import horno.image
 import horno.instrument
+import horno.log
 import horno.path
+import horno.profiling
+import horno.quality
+import horno.sky
+import horno.stack
 
 _darkdata = None
+_darkmodeldata = None
 _flatdata = None
+_flatmaskdata = None
+_workercalibration = None
+
+# The options of bake that affect its result, and so are part of the keys of a
+# frame cache.
+_cacheoptions = (
+    "dotrim",
+    "dodark",
+    "doflat",
+    "dosky",
+    "dorotate",
+    "nwindow",
+    "dofused",
+    "skymethod",
+    "doquality",
+    "docosmicrays",
+)
 
 
 def readdark(exposuretime, path="dark-{exposuretime:.0f}.fits", name="readdark"):
     global _darkdata
     path = path.format(exposuretime=exposuretime)
     if os.path.exists(path):
-        print("%s: reading %s." % (name, path))
+        horno.log.info("%s: reading %s.", name, path)
         _darkdata = horno.fits.readproductdata(path)
     else:
         raise RuntimeError("no dark found.")
     return _darkdata
 
 
+def readdarkmodel(path="darkmodel.fits", name="readdarkmodel"):
+    global _darkmodeldata
+    path = path.format()
+    if os.path.exists(path):
+        horno.log.info("%s: reading %s.", name, path)
+        _darkmodeldata = horno.fits.readproductdata(path)
+    else:
+        raise RuntimeError("no dark model found.")
+    return _darkmodeldata
+
+
 def readflat(path="flat.fits", name="readflat"):
     global _flatdata
+    global _flatmaskdata
     path = path.format()
     if os.path.exists(path):
-        print("%s: reading %s." % (name, path))
+        horno.log.info("%s: reading %s.", name, path)
         _flatdata = horno.fits.readproductdata(path)
+        _flatmaskdata = horno.quality.flatbadmask(
+            _flatdata, horno.fits.readproductmask(path)
+        )
     else:
         raise RuntimeError("no flat found.")
     return _flatdata
@@ -36,15 +84,22 @@ def readflat(path="flat.fits", name="readflat"):
 
 def writedark(path="dark-{exposuretime:.0f}.fits", exposuretime=None, name="writebias"):
     path = path.format(exposuretime=exposuretime)
-    print("%s: writing %s." % (name, path))
+    horno.log.info("%s: writing %s.", name, path)
     horno.fits.writeproduct(path, _darkdata, exposuretime=exposuretime)
     return
 
 
-def writeflat(path="flat.fits", name="writeflat"):
+def writedarkmodel(path="darkmodel.fits", name="writedarkmodel"):
     path = path.format()
-    print("%s: writing %s." % (name, path))
-    horno.fits.writeproduct(path, _flatdata)
+    horno.log.info("%s: writing %s.", name, path)
+    horno.fits.writeproduct(path, _darkmodeldata)
+    return
+
+
+def writeflat(path="flat.fits", name="writeflat", maskdata=None):
+    path = path.format()
+    horno.log.info("%s: writing %s.", name, path)
+    horno.fits.writeproduct(path, _flatdata, maskdata=maskdata)
     return
 
 
@@ -59,56 +114,587 @@ def bake(
     dorotate=False,
     nwindow=None,
     nmargin=0,
+    raw=None,
+    calibration=None,
+    dofused=True,
+    out=None,
+    skymethod="median",
+    doquality=False,
+    docosmicrays=False,
+    cache=None,
 ):
+    """
+    Bake a raw FITS file into calibrated data.
+
+    By default, saturated pixels and pixels where the flat is bad are set to
+    nan. If ``doquality`` is true, the data are instead left finite and a
+    quality plane from :mod:`horno.quality` is returned with them, with bits
+    for saturated pixels, pixels where the flat is bad, cosmic rays if
+    ``docosmicrays`` is true, pixels outside the trim region if the data are
+    not trimmed, and any other pixels that are not finite, which are set to
+    0. The sky is then estimated from the good pixels alone.
+
+    If ``cache`` is a :class:`horno.framecache.FrameCache`, the result is
+    taken from it if the same raw file has already been baked with the same
+    masters and options, without reading the data, and is otherwise added to
+    it. The arrays of a cached result are memory-mapped copy-on-write.
+
+    :return: ``(header, data)``, or ``(header, data, quality)`` if
+        ``doquality`` is true.
+    """
+
+    if docosmicrays and not doquality:
+        raise RuntimeError("docosmicrays requires doquality.")
+
+    with horno.profiling.stage("bake", frame=os.path.basename(fitspath)):
+
+        # With a cache, look for the frame before reading its data. The key
+        # depends on the masters, which are chosen from the header alone.
+        if cache is not None:
+            with horno.profiling.stage("cache"):
+                arguments = locals()
+                cachekey = _cachekey(
+                    cache,
+                    fitspath,
+                    raw[0] if raw is not None else horno.fits.readrawheader(fitspath),
+                    calibration,
+                    {option: arguments[option] for option in _cacheoptions},
+                )
+                result = cache.get(cachekey)
+            if result is not None:
+                horno.log.info("%s: using cached %s.", name, os.path.basename(fitspath))
+                return result
+
+        if raw is None:
+            horno.log.info("%s: reading %s.", name, os.path.basename(fitspath))
+            header, data = horno.fits.readraw(fitspath, dotrim=dotrim, out=out)
+        else:
+            horno.log.info("%s: using prefetched %s.", name, os.path.basename(fitspath))
+            header, data = raw
+
+        darkdata, darkmodeldata, flatdata, flatmaskdata = _masters(
+            header, calibration, dodark, doflat, doquality
+        )
+        if darkmodeldata is not None:
+            exposuretime = horno.instrument.exposuretime(header)
+
+        trimyslice = horno.instrument.trimyslice(header)
+        trimxslice = horno.instrument.trimxslice(header)
+        if dotrim and trimyslice is not None and trimxslice is not None:
+            yslice = trimyslice
+            xslice = trimxslice
+        else:
+            dotrim = False
+            yslice = slice(None)
+            xslice = slice(None)
+
+        # Data read here have already been trimmed and converted to float32,
+        # and are calibrated in place.
+        if raw is None:
+            datayslice = slice(None)
+            dataxslice = slice(None)
+            out = data
+        else:
+            datayslice = yslice
+            dataxslice = xslice
+
+        if doquality:
+            quality = horno.quality.newquality(data[datayslice, dataxslice].shape)
+            if not dotrim and trimyslice is not None and trimxslice is not None:
+                horno.quality.markofftrim(quality, trimyslice, trimxslice)
+        else:
+            quality = None
+
+        if dofused:
+
+            if dotrim:
+                horno.log.info("%s: trimming.", name)
+            if darkdata is not None:
+                horno.log.info("%s: subtracting dark.", name)
+            if darkmodeldata is not None:
+                horno.log.info(
+                    "%s: subtracting dark synthesized for %.0f seconds.",
+                    name,
+                    exposuretime,
+                )
+            if flatdata is not None:
+                horno.log.info("%s: dividing by flat.", name)
+            with horno.profiling.stage("calibrate"):
+                data = _fusedcalibrate(
+                    data,
+                    horno.instrument.datamax(header),
+                    datayslice,
+                    dataxslice,
+                    darkdata,
+                    flatdata,
+                    out=out,
+                    darkmodeldata=darkmodeldata,
+                    exposuretime=exposuretime if darkmodeldata is not None else None,
+                    quality=quality,
+                    flatmaskdata=flatmaskdata,
+                )
+
+        else:
+
+            with horno.profiling.stage("convert"):
+                data = np.asarray(data, dtype=np.float32)
+
+                # Set invalid pixels to nan or mark them in the quality plane.
+                if quality is None:
+                    data[np.where(data == horno.instrument.datamax(header))] = np.nan
+                else:
+                    horno.quality.setbit(
+                        quality,
+                        horno.quality.SATURATED,
+                        data[datayslice, dataxslice]
+                        == horno.instrument.datamax(header),
+                    )
+
+            if dotrim:
+                horno.log.info("%s: trimming.", name)
+                data = data[datayslice, dataxslice]
+
+            if darkdata is not None:
+                horno.log.info("%s: subtracting dark.", name)
+                with horno.profiling.stage("dark"):
+                    data -= darkdata
+
+            if darkmodeldata is not None:
+                horno.log.info(
+                    "%s: subtracting dark synthesized for %.0f seconds.",
+                    name,
+                    exposuretime,
+                )
+                with horno.profiling.stage("dark"):
+                    data -= (
+                        darkmodeldata[1] * np.float32(exposuretime) + darkmodeldata[0]
+                    )
+
+            if flatdata is not None:
+                horno.log.info("%s: dividing by flat.", name)
+                with horno.profiling.stage("flat"):
+                    if flatmaskdata is None:
+                        data /= flatdata
+                    else:
+                        np.divide(data, flatdata, out=data, where=~flatmaskdata)
+                        horno.quality.setbit(
+                            quality, horno.quality.FLATBAD, flatmaskdata
+                        )
+
+            if quality is not None:
+                invalid = ~np.isfinite(data)
+                data[invalid] = 0
+                horno.quality.setbit(quality, horno.quality.INVALID, invalid)
+
+        if docosmicrays:
+            with horno.profiling.stage("cosmicrays"):
+                horno.quality.markcosmicrays(data, quality, name=name)
+
+        if dosky:
+            with horno.profiling.stage("sky"):
+                sky = horno.sky.sky(data, method=skymethod, mask=quality)
+                if np.ndim(sky) == 0:
+                    horno.log.info("%s: subtracting sky of %.1f DN.", name, sky)
+                else:
+                    horno.log.info(
+                        "%s: subtracting sky map with median %.1f DN.",
+                        name,
+                        np.nanmedian(sky),
+                    )
+                data -= sky
+
+        # The counts are only calculated if they are logged, and are logged
+        # at the debug level, as in a stack the callers log their totals.
+        if quality is not None and horno.log.isenabled(horno.log.DEBUG):
+            horno.quality.describe(quality, name=name, level=horno.log.DEBUG)
+
+        if dorotate:
+            horno.log.info("%s: rotating to standard orientation.", name)
+            with horno.profiling.stage("rotate"):
+                data = horno.instrument.dorotate(header, data)
+                if quality is not None:
+                    quality = horno.instrument.dorotate(header, quality)
+
+        if nwindow is not None:
+
+            horno.log.info("%s: windowing to %d by %d.", name, nwindow, nwindow)
+
+            assert nwindow <= data.shape[0]
+            assert nwindow <= data.shape[1]
+            ylo = int((data.shape[0] - nwindow) / 2)
+            yhi = ylo + nwindow
+            xlo = int((data.shape[1] - nwindow) / 2)
+            xhi = xlo + nwindow
+            with horno.profiling.stage("window"):
+                data = data[ylo:yhi, xlo:xhi].copy()
+                if quality is not None:
+                    quality = quality[ylo:yhi, xlo:xhi].copy()
+
+    if quality is not None:
+        result = (header, data, quality)
+    else:
+        result = (header, data)
+
+    if cache is not None:
+        with horno.profiling.stage("cache"):
+            cache.put(cachekey, result)
+
+    return result
+
+
+def _cachekey(cache, fitspath, header, calibration, options):
+    # Return the key in a frame cache of a raw file baked with the given
+    # options of bake, by name.
+    return cache.key(
+        fitspath,
+        _masters(
+            header,
+            calibration,
+            options["dodark"],
+            options["doflat"],
+            options["doquality"],
+        ),
+        options,
+    )
+
 
-    print("%s: reading %s." % (name, os.path.basename(fitspath)))
-    header, data = horno.fits.readraw(fitspath)
+def _cachedresult(fitspath, kwargs):
+    # Return the result of bake(fitspath, **kwargs) from its frame cache,
+    # reading only the header, or None if it is not in the cache.
+    arguments = inspect.signature(bake).bind(fitspath, **kwargs)
+    arguments.apply_defaults()
+    arguments = arguments.arguments
+    cache = arguments["cache"]
+    with horno.profiling.stage("cache"):
+        return cache.get(
+            _cachekey(
+                cache,
+                fitspath,
+                horno.fits.readrawheader(fitspath),
+                arguments["calibration"],
+                {option: arguments[option] for option in _cacheoptions},
+            )
+        )
 
-    # Set invalid pixels to nan.
-    data[np.where(data == horno.instrument.datamax(header))] = np.nan
 
+def _masters(header, calibration, dodark, doflat, doquality):
+    # Return the master dark, dark model, and flat, and the mask of the bad
+    # pixels of the flat, for a raw frame, or None for each that is not used.
+    # The masters are taken from the calibration store if there is one, and
+    # otherwise from the current dark and flat. The dark is synthesized from
+    # the dark model if the store has dark models or, without a store, if
+    # there is a current dark model but no current dark. The mask of the bad
+    # pixels of the flat is only needed for the quality plane.
+    darkdata = None
+    darkmodeldata = None
+    flatmaskdata = None
+    if calibration is not None:
+        if dodark:
+            darkmodeldata = calibration.darkmodel(header)
+            if darkmodeldata is None:
+                darkdata = calibration.dark(header)
+        flatdata = calibration.flat(header) if doflat else None
+        if flatdata is not None and doquality:
+            flatmaskdata = calibration.flatmask(header)
+    else:
+        if dodark:
+            if _darkdata is None and _darkmodeldata is not None:
+                darkmodeldata = _darkmodeldata
+            else:
+                darkdata = _darkdata
+        flatdata = _flatdata if doflat else None
+        if flatdata is not None and doquality:
+            flatmaskdata = _flatmaskdata
+            if flatmaskdata is None:
+                flatmaskdata = horno.quality.flatbadmask(flatdata)
+    return darkdata, darkmodeldata, flatdata, flatmaskdata
+
+
+def _fusedcalibrate(
+    rawdata,
+    datamax,
+    yslice,
+    xslice,
+    darkdata,
+    flatdata,
+    out=None,
+    nblock=64,
+    darkmodeldata=None,
+    exposuretime=None,
+    quality=None,
+    flatmaskdata=None,
+):
+    """
+    Return calibrated float32 data from raw data in a single pass.
+
+    Only the region of the raw data given by ``yslice`` and ``xslice`` is
+    converted to float32, directly into ``out``. The saturated pixels are set
+    to nan, the dark is subtracted, and the data are divided by the flat, all
+    in blocks of ``nblock`` rows, so that each block is still in the cache for
+    every step and the only temporary arrays are the size of a block. If a
+    dark model is given, the dark is synthesized block by block from its
+    offset and rate planes for the exposure time, so the full dark is never
+    formed.
+
+    If a quality plane is given, the saturated pixels are instead marked in
+    it and left finite. Likewise, if the mask of the bad pixels of the flat
+    is given, those pixels are marked in the quality plane and are not
+    divided by the flat. Any other pixels that are not finite are marked as
+    invalid and set to 0.
+
+    :param rawdata: The raw data, in any numeric type. This may be ``out``
+        itself, in which case the data are calibrated in place.
+    :param datamax: The value of saturated raw pixels.
+    :param yslice: The slice of rows to calibrate.
+    :param xslice: The slice of columns to calibrate.
+    :param darkdata: The dark, or ``None`` to not subtract a dark.
+    :param flatdata: The flat, or ``None`` to not divide by a flat.
+    :param out: A float32 array in which to return the calibrated data, or
+        ``None`` to allocate one. If it does not have the shape of the region,
+        a new array is allocated instead. Defaults to ``None``.
+    :param nblock: The number of rows in each block. Defaults to 64.
+    :param darkmodeldata: The dark model, with shape ``(2, ny, nx)``, or
+        ``None`` to not subtract a synthesized dark. Defaults to ``None``.
+    :param exposuretime: The exposure time for the dark model. Defaults to
+        ``None``.
+    :param quality: A quality plane with the shape of the region, which is
+        updated in place, or ``None``. Defaults to ``None``.
+    :param flatmaskdata: The mask of the bad pixels of the flat, or ``None``.
+        This is only used with a quality plane. Defaults to ``None``.
+    :return: The calibrated data.
+    """
+
+    rawdata = rawdata[yslice, xslice]
     if (
-        dotrim
-        and horno.instrument.trimyslice(header) is not None
-        and horno.instrument.trimxslice(header) is not None
+        out is None
+        or out.shape != rawdata.shape
+        or out.dtype != np.float32
+        or not out.flags.writeable
     ):
-        print("%s: trimming." % (name))
-        data = data[
-            horno.instrument.trimyslice(header), horno.instrument.trimxslice(header)
-        ]
-
-    if dodark and _darkdata is not None:
-        print("%s: subtracting dark." % (name))
-        data -= _darkdata
-
-    if doflat and _flatdata is not None:
-        print("%s: dividing by flat." % (name))
-        data /= _flatdata
+        out = np.empty(rawdata.shape, dtype=np.float32)
+    if darkmodeldata is not None:
+        darkblock = np.empty((nblock, rawdata.shape[1]), dtype=np.float32)
+        exposuretime = np.float32(exposuretime)
+
+    for iy in range(0, rawdata.shape[0], nblock):
+        rows = slice(iy, iy + nblock)
+        rawblock = rawdata[rows]
+        outblock = out[rows]
+        saturated = rawblock == datamax
+        np.copyto(outblock, rawblock, casting="unsafe")
+        if darkdata is not None:
+            np.subtract(outblock, darkdata[rows], out=outblock)
+        if darkmodeldata is not None:
+            block = darkblock[: outblock.shape[0]]
+            np.multiply(darkmodeldata[1, rows], exposuretime, out=block)
+            np.add(block, darkmodeldata[0, rows], out=block)
+            np.subtract(outblock, block, out=outblock)
+        if quality is None:
+            if flatdata is not None:
+                np.divide(outblock, flatdata[rows], out=outblock)
+            outblock[saturated] = np.nan
+        else:
+            qualityblock = quality[rows]
+            if flatdata is not None and flatmaskdata is not None:
+                flatbad = flatmaskdata[rows]
+                np.divide(outblock, flatdata[rows], out=outblock, where=~flatbad)
+                horno.quality.setbit(qualityblock, horno.quality.FLATBAD, flatbad)
+            elif flatdata is not None:
+                np.divide(outblock, flatdata[rows], out=outblock)
+            horno.quality.setbit(qualityblock, horno.quality.SATURATED, saturated)
+            invalid = ~np.isfinite(outblock)
+            outblock[invalid] = 0
+            horno.quality.setbit(qualityblock, horno.quality.INVALID, invalid)
+
+    return out
+
+
+def _initbakeworker(
+    darkpath,
+    flatpath,
+    calibration,
+    loglevel,
+    profiling,
+    darkmodelpath=None,
+    flatmaskpath=None,
+):
+    # Map the master dark, dark model, and flat, and the mask of the flat,
+    # read-only in each worker process, so that they are shared through the
+    # page cache rather than pickled per task.
+    # Likewise, each worker keeps one calibration store for all of its tasks.
+    # The log level and profiling follow those of the parent; profiling is
+    # None if it is disabled and otherwise whether to record memory.
+    global _darkdata
+    global _darkmodeldata
+    global _flatdata
+    global _flatmaskdata
+    global _workercalibration
+    _darkdata = None if darkpath is None else np.load(darkpath, mmap_mode="r")
+    _darkmodeldata = (
+        None if darkmodelpath is None else np.load(darkmodelpath, mmap_mode="r")
+    )
+    _flatdata = None if flatpath is None else np.load(flatpath, mmap_mode="r")
+    _flatmaskdata = (
+        None if flatmaskpath is None else np.load(flatmaskpath, mmap_mode="r")
+    )
+    _workercalibration = calibration
+    horno.log.setlevel(loglevel)
+    if profiling is not None:
+        horno.profiling.enable(domemory=profiling)
+
+
+def _bakeworker(fitspath, kwargs):
+    # Capture the messages from bake so that the parent can print them in the
+    # order of the files rather than the order in which the workers finish.
+    # Likewise, return the profiling records so that the parent can add them
+    # to its own.
+    horno.profiling.reset()
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        result = bake(fitspath, calibration=_workercalibration, **kwargs)
+    return log.getvalue(), horno.profiling.records(), result
+
+
+def bakelist(fitspathlist, workers=None, prefetch=0, reuse=False, **kwargs):
+    """
+    Bake a list of FITS files, yielding ``(header, data)``, or ``(header,
+    data, quality)`` if ``doquality`` is true, for each in order.
+
+    If ``workers`` is ``None``, the files are baked one after another in this
+    process. In this case, if ``prefetch`` is positive, up to ``prefetch``
+    of the following files are read on a background thread while the current
+    file is being baked, so that reading overlaps with calibration. Also, if
+    ``reuse`` is true, the data array yielded for each file is reused as the
+    output buffer for the next file, so the caller must have finished with it
+    before asking for the next file. Otherwise, they are baked by a pool of
+    ``workers`` processes. The current master dark, dark model, and flat, and
+    the mask of the flat, are saved once to temporary files that each worker
+    maps read-only, at most ``2 * workers`` files are in flight at any time,
+    and the messages from each worker are printed in the order of the files.
+
+    If a frame cache is passed to :func:`bake` in ``kwargs``, files that are
+    already in the cache are not read, not even to prefetch them.
+
+    :param fitspathlist: The list of FITS paths.
+    :param workers: The number of worker processes or ``None``. Defaults to
+        ``None``.
+    :param prefetch: The number of files to read ahead when ``workers`` is
+        ``None``. Defaults to 0.
+    :param reuse: Whether to reuse the yielded data arrays when ``workers`` is
+        ``None``. Defaults to ``False``.
+    :param kwargs: The keyword arguments passed to :func:`bake`.
+    :return: An iterator over the results of :func:`bake` for each file in
+        order.
+    """
+
+    if workers is None and prefetch == 0:
+        out = None
+        for fitspath in fitspathlist:
+            result = bake(fitspath, out=out, **kwargs)
+            yield result
+            if reuse:
+                out = result[1]
+        return
 
-    if dosky:
-        median = np.nanmedian(data)
-        print("%s: subtracting median sky of %.1f DN." % (name, median))
-        # data -= np.nanmedian(data, axis=0, keepdims=True)
-        # data -= np.nanmedian(data, axis=1, keepdims=True)
-        data -= np.nanmedian(data, keepdims=True)
+    if workers is None:
+        reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            fitspathiter = iter(fitspathlist)
+            futures = collections.deque()
+
+            # With a frame cache, each file is looked up before it is read, and
+            # files that are in the cache are not read at all.
+            def submit():
+                fitspath = next(fitspathiter, None)
+                if fitspath is None:
+                    return
+                if kwargs.get("cache") is not None:
+                    result = _cachedresult(fitspath, kwargs)
+                    if result is not None:
+                        futures.append((fitspath, None, result))
+                        return
+                futures.append(
+                    (fitspath, reader.submit(horno.fits.readrawnative, fitspath), None)
+                )
+
+            for i in range(1 + prefetch):
+                submit()
+            out = None
+            while len(futures) > 0:
+                fitspath, future, result = futures.popleft()
+                submit()
+                if result is None:
+                    raw = future.result()
+                    result = bake(fitspath, raw=raw, out=out, **kwargs)
+                else:
+                    horno.log.info(
+                        "%s: using cached %s.",
+                        kwargs.get("name", "bake"),
+                        os.path.basename(fitspath),
+                    )
+                yield result
+                if reuse:
+                    out = result[1]
+        finally:
+            reader.shutdown(cancel_futures=True)
+        return
 
-    if dorotate:
-        print("%s: rotating to standard orientation." % (name))
-        data = horno.instrument.dorotate(header, data)
+    tmpdir = tempfile.mkdtemp(prefix="horno-")
+    darkpath = None
+    darkmodelpath = None
+    flatpath = None
+    flatmaskpath = None
+    if _darkdata is not None:
+        darkpath = os.path.join(tmpdir, "dark.npy")
+        np.save(darkpath, _darkdata)
+    if _darkmodeldata is not None:
+        darkmodelpath = os.path.join(tmpdir, "darkmodel.npy")
+        np.save(darkmodelpath, _darkmodeldata)
+    if _flatdata is not None:
+        flatpath = os.path.join(tmpdir, "flat.npy")
+        np.save(flatpath, _flatdata)
+    if _flatmaskdata is not None:
+        flatmaskpath = os.path.join(tmpdir, "flatmask.npy")
+        np.save(flatmaskpath, _flatmaskdata)
+
+    kwargs = dict(kwargs)
+    calibration = kwargs.pop("calibration", None)
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_initbakeworker,
+        initargs=(
+            darkpath,
+            flatpath,
+            calibration,
+            horno.log.level,
+            horno.profiling.ismemoryenabled() if horno.profiling.isenabled() else None,
+            darkmodelpath,
+            flatmaskpath,
+        ),
+    )
 
-    if nwindow is not None:
+    try:
+        fitspathiter = iter(fitspathlist)
+        futures = collections.deque()
 
-        print("%s: windowing to %d by %d." % (name, nwindow, nwindow))
+        def submit():
+            fitspath = next(fitspathiter, None)
+            if fitspath is not None:
+                futures.append(executor.submit(_bakeworker, fitspath, kwargs))
 
-        assert nwindow <= data.shape[0]
-        assert nwindow <= data.shape[1]
-        ylo = int((data.shape[0] - nwindow) / 2)
-        yhi = ylo + nwindow
-        xlo = int((data.shape[1] - nwindow) / 2)
-        xhi = xlo + nwindow
-        data = data[ylo:yhi, xlo:xhi].copy()
+        for i in range(2 * workers):
+            submit()
+        while len(futures) > 0:
+            log, records, result = futures.popleft().result()
+            sys.stdout.write(log)
+            horno.profiling.addrecords(records)
+            submit()
+            yield result
 
-    return header, data
+    finally:
+        executor.shutdown(cancel_futures=True)
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def usefakebias():
@@ -119,231 +705,799 @@ def usefakebias():
 
 def usefakedark():
     global _darkdata
+    global _darkmodeldata
     _darkdata = None
+    _darkmodeldata = None
     return _darkdata
 
 
 def usefakeflat():
     global _flatdata
+    global _flatmaskdata
     _flatdata = None
+    _flatmaskdata = None
     return _flatdata
 
 
 def makedark(
-    fitspaths, exposuretime, darkpath="dark-{exposuretime}.fits", fitspathsslice=None
+    fitspaths,
+    exposuretime,
+    darkpath="dark-{exposuretime}.fits",
+    fitspathsslice=None,
+    stackpath=None,
+    workers=None,
+    indexpath=None,
 ):
 
-    print("makedark: making %.0f second dark from %s." % (exposuretime, fitspaths))
+    horno.log.info(
+        "makedark: making %.0f second dark from %s.", exposuretime, fitspaths
+    )
 
     fitspathlist = horno.path.getrawfitspaths(
-        fitspaths, exposuretime=exposuretime, fitspathsslice=fitspathsslice
+        fitspaths,
+        exposuretime=exposuretime,
+        fitspathsslice=fitspathsslice,
+        indexpath=indexpath,
     )
 
     if len(fitspathlist) == 0:
-        print("ERROR: no dark files found.")
+        horno.log.error("ERROR: no dark files found.")
         return
 
+    if stackpath is not None:
+        stackpath = stackpath.format(exposuretime=exposuretime)
+
     headerlist = []
-    datalist = []
-    for fitspath in fitspathlist:
-        header, data = bake(fitspath, name="makedark", dotrim=True)
+    stack = None
+    nstack = 0
+    for header, data in bakelist(
+        fitspathlist, workers=workers, reuse=True, name="makedark", dotrim=True
+    ):
+        if stack is None:
+            stack = horno.stack.newstack(
+                len(fitspathlist), data.shape, path=stackpath, name="makedark"
+            )
         headerlist.append(header)
-        datalist.append(data)
+        stack[nstack] = data
+        nstack += 1
 
-    print("makedark: averaging %d darks with rejection." % len(datalist))
+    horno.log.info("makedark: averaging %d darks with rejection.", nstack)
     global _darkdata
-    _darkdata, darksigma = horno.image.clippedmeanandsigma(datalist, sigma=3, axis=0)
+    _darkdata, darksigma = horno.image.clippedmeanandsigma(
+        stack[:nstack], sigma=3, axis=0
+    )
+    horno.stack.closestack(stack, name="makedark")
+    stack = None
 
     mean, sigma = horno.image.clippedmeanandsigma(_darkdata, sigma=5)
-    print("makedark: dark is %.2f ± %.2f DN." % (mean, sigma))
+    horno.log.info("makedark: dark is %.2f ± %.2f DN.", mean, sigma)
+    sigma = horno.image.clippedmean(darksigma, sigma=5) / math.sqrt(nstack)
+    horno.log.info("makedark: estimated noise in dark is %.2f DN.", sigma)
 
-    sigma = horno.image.clippedmean(darksigma, sigma=5) / math.sqrt(len(datalist))
-    print("makedark: estimated noise in dark is %.2f DN." % sigma)
-
-    horno.image.show(_darkdata, zscale=True)
+    horno.display.show(_darkdata, zscale=True)
 
     writedark(darkpath, exposuretime=exposuretime, name="makedark")
 
-    print("makedark: finished.")
+    horno.log.info("makedark: finished.")
 
     return
 
 
-def makeflat(fitspaths, flatpath="flat.fits", fitspathsslice=None):
+def updatedark(
+    fitspaths,
+    exposuretime,
+    darkpath="dark-{exposuretime}.fits",
+    statepath="dark-{exposuretime}.npz",
+    fitspathsslice=None,
+    workers=None,
+    indexpath=None,
+):
+    """
+    Make or update a master dark incrementally.
+
+    The first time, all of the darks are stacked and combined with rejection
+    as in :func:`makedark`, and the clipping bounds and clipped sums for each
+    pixel are saved in ``statepath`` by :mod:`horno.accumulate`. Subsequently,
+    only the darks that are not already in the state are baked and added, so
+    the cost is proportional to the number of new darks, and the master dark is
+    written again from the updated sums.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob`.
+    :param exposuretime: The exposure time of the darks.
+    :param darkpath: The path of the master dark. Defaults to
+        ``"dark-{exposuretime}.fits"``.
+    :param statepath: The path of the state. Defaults to
+        ``"dark-{exposuretime}.npz"``.
+    :param fitspathsslice: As for :func:`makedark`. Defaults to ``None``.
+    :param workers: As for :func:`makedark`. Defaults to ``None``.
+    :param indexpath: As for :func:`makedark`. Defaults to ``None``.
+    """
+
+    horno.log.info(
+        "updatedark: updating %.0f second dark from %s.", exposuretime, fitspaths
+    )
 
-    ############################################################################
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths,
+        exposuretime=exposuretime,
+        fitspathsslice=fitspathsslice,
+        indexpath=indexpath,
+    )
 
-    print("makeflat: making flat %s." % fitspaths)
+    statepath = statepath.format(exposuretime=exposuretime)
+    state = horno.accumulate.readstate(statepath, name="updatedark")
+
+    if state is not None:
+        fitspathlist = [
+            fitspath for fitspath in fitspathlist if fitspath not in state["paths"]
+        ]
+        horno.log.info("updatedark: %d new darks.", len(fitspathlist))
+        if len(fitspathlist) == 0:
+            horno.log.info("updatedark: finished.")
+            return
+        for fitspath, (header, data) in zip(
+            fitspathlist,
+            bakelist(
+                fitspathlist,
+                workers=workers,
+                reuse=True,
+                name="updatedark",
+                dotrim=True,
+            ),
+        ):
+            horno.accumulate.addframe(state, data, path=fitspath)
+    else:
+        if len(fitspathlist) == 0:
+            horno.log.error("ERROR: no dark files found.")
+            return
+        stack = None
+        nstack = 0
+        for header, data in bakelist(
+            fitspathlist, workers=workers, reuse=True, name="updatedark", dotrim=True
+        ):
+            if stack is None:
+                stack = horno.stack.newstack(
+                    len(fitspathlist), data.shape, name="updatedark"
+                )
+            stack[nstack] = data
+            nstack += 1
+        horno.log.info("updatedark: averaging %d darks with rejection.", nstack)
+        state = horno.accumulate.newstate(stack[:nstack], sigma=3, paths=fitspathlist)
+        stack = None
+
+    global _darkdata
+    _darkdata, darksigma = horno.accumulate.meanandsigma(state)
+
+    nstack = len(state["paths"])
+    mean, sigma = horno.image.clippedmeanandsigma(_darkdata, sigma=5)
+    horno.log.info(
+        "updatedark: dark from %d darks is %.2f ± %.2f DN.", nstack, mean, sigma
+    )
+    writedark(darkpath, exposuretime=exposuretime, name="updatedark")
+    horno.accumulate.writestate(statepath, state, name="updatedark")
+
+    horno.log.info("updatedark: finished.")
+
+    return
 
-    ############################################################################
 
-    print("makeflat: making flat without mask.")
+def makedarkmodel(
+    fitspaths,
+    darkmodelpath="darkmodel.fits",
+    fitspathsslice=None,
+    workers=None,
+    indexpath=None,
+    docliprejection=True,
+    sigma=3.0,
+):
+    """
+    Make a dark model from darks of any exposure times.
+
+    For each pixel, the offset, which is the bias, and the rate, which is the
+    dark current in DN per second, are fitted to the darks by linear
+    regression on their exposure times. The regression is streaming: each dark
+    is baked and added to per-pixel sums of the exposure times, the values,
+    and their products, so only one dark is in memory at any time, however
+    many there are. Saturated pixels are excluded from the sums.
+
+    If ``docliprejection`` is true, the darks are baked a second time and the
+    values more than ``sigma`` times the residual standard deviation of each
+    pixel from the first fit are rejected before the fit is made again. This
+    removes cosmic rays.
+
+    The model is written as a product with two planes, the offset and the
+    rate, and is the current dark model for :func:`bake`. The dark for any
+    exposure time is then synthesized as the offset plus the exposure time
+    times the rate, so no master dark is needed for each exposure time.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob`.
+    :param darkmodelpath: The path of the dark model. Defaults to
+        ``"darkmodel.fits"``.
+    :param fitspathsslice: As for :func:`makedark`. Defaults to ``None``.
+    :param workers: As for :func:`makedark`. Defaults to ``None``.
+    :param indexpath: As for :func:`makedark`. Defaults to ``None``.
+    :param docliprejection: Whether to reject outliers in a second pass.
+        Defaults to ``True``.
+    :param sigma: The rejection limit in standard deviations. Defaults to 3.
+    """
+
+    horno.log.info("makedarkmodel: making dark model from %s.", fitspaths)
 
-    fitspathlist = horno.path.getrawfitspaths(fitspaths, fitspathsslice=fitspathsslice)
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths, fitspathsslice=fitspathsslice, indexpath=indexpath
+    )
 
     if len(fitspathlist) == 0:
-        print("ERROR: no flat files found.")
+        horno.log.error("ERROR: no dark files found.")
         return
 
-    headerlist = []
-    datalist = []
-    for fitspath in fitspathlist:
-        header, data = bake(
-            fitspath,
-            name="makeflat",
+    def solve(sums):
+        # Return the least-squares offset and rate and the residual standard
+        # deviation for each pixel, or nan where they are not determined.
+        n = np.asarray(sums["n"], dtype="float64")
+        t = np.asarray(sums["t"], dtype="float64")
+        tt = np.asarray(sums["tt"], dtype="float64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            determinant = n * tt - t * t
+            rate = (n * sums["tx"] - t * sums["x"]) / determinant
+            offset = (sums["x"] - rate * t) / n
+            residual = sums["xx"] - offset * sums["x"] - rate * sums["tx"]
+            sigma = np.sqrt(np.maximum(residual, 0) / (n - 2))
+        isvalid = determinant > 1e-6 * np.maximum(n * tt, 1)
+        offset[~isvalid] = np.nan
+        rate[~isvalid] = np.nan
+        return offset, rate, sigma
+
+    def accumulate(previous=None):
+        # Return the sums over the darks for each pixel. If the sums of a
+        # previous pass are given, each value is rejected if it lies more than
+        # sigma residual standard deviations from the fit to the other darks,
+        # which is found by removing the value from the previous sums. So an
+        # outlier does not inflate its own limit, which matters for the small
+        # numbers of darks typically fitted.
+        sums = None
+        exposuretimes = set()
+        for header, data in bakelist(
+            fitspathlist,
+            workers=workers,
+            reuse=True,
+            name="makedarkmodel",
             dotrim=True,
-            dodark=True,
-        )
-        centeryslice = slice(int(data.shape[0] * 1 / 4), int(data.shape[0] * 3 / 4))
-        centerxslice = slice(int(data.shape[1] * 1 / 4), int(data.shape[1] * 3 / 4))
-        if np.isnan(data[centeryslice, centerxslice]).all():
-            print(
-                "makedark: rejected %s: no valid data in center."
-                % os.path.basename(fitspath)
-            )
-            continue
-        median = np.nanmedian(data[centeryslice, centerxslice])
-        print("makeflat: median in center is %.2f DN." % median)
-        if median > horno.instrument.flatmax(header):
-            print("makeflat: rejecting image: median in center is too high.")
-            continue
-        print("makeflat: accepted %s." % os.path.basename(fitspath))
+        ):
+            exposuretime = horno.instrument.exposuretime(header)
+            exposuretimes.add(exposuretime)
+            if sums is None:
+                sums = {
+                    "n": np.zeros(data.shape, dtype="int32"),
+                    "t": np.zeros(data.shape, dtype="float32"),
+                    "tt": np.zeros(data.shape, dtype="float32"),
+                    "x": np.zeros(data.shape, dtype="float64"),
+                    "tx": np.zeros(data.shape, dtype="float64"),
+                    "xx": np.zeros(data.shape, dtype="float64"),
+                }
+            isvalid = np.isfinite(data)
+            value = np.where(isvalid, data, 0).astype("float64")
+            terms = {
+                "n": isvalid,
+                "t": np.float32(exposuretime) * isvalid,
+                "tt": np.float32(exposuretime * exposuretime) * isvalid,
+                "x": value,
+                "tx": exposuretime * value,
+                "xx": value * value,
+            }
+            if previous is not None:
+                others = {key: previous[key] - terms[key] for key in terms}
+                offset, rate, residualsigma = solve(others)
+                with np.errstate(invalid="ignore"):
+                    isvalid &= (others["n"] < 3) | (
+                        np.abs(value - (offset + exposuretime * rate))
+                        <= sigma * residualsigma
+                    )
+                for key in terms:
+                    terms[key] = np.where(isvalid, terms[key], 0)
+            for key in terms:
+                sums[key] += terms[key]
+        return sums, exposuretimes
+
+    sums, exposuretimes = accumulate()
+    if len(exposuretimes) < 2:
+        raise RuntimeError("dark model needs darks with at least two exposure times.")
+    horno.log.info(
+        "makedarkmodel: fitting %d darks with exposure times of %s seconds.",
+        len(fitspathlist),
+        ", ".join("%.0f" % exposuretime for exposuretime in sorted(exposuretimes)),
+    )
 
-        centeryslice = slice(
-            int(data.shape[0] / 2 * 1 / 4), int(data.shape[0] / 2 * 3 / 4)
-        )
-        centerxslice = slice(
-            int(data.shape[1] / 2 * 1 / 4), int(data.shape[1] / 2 * 3 / 4)
-        )
-        median00 = np.nanmedian(data[0::2, 0::2][centeryslice, centerxslice])
-        median01 = np.nanmedian(data[0::2, 1::2][centeryslice, centerxslice])
-        median10 = np.nanmedian(data[1::2, 0::2][centeryslice, centerxslice])
-        median11 = np.nanmedian(data[1::2, 1::2][centeryslice, centerxslice])
-
-        print(
-            "makeflat: normalizing 00, 01, 10, and 11 pixels by %.1f, %.1f, %.1f, and %.1f."
-            % (median00, median01, median10, median11)
+    if docliprejection:
+        horno.log.info(
+            "makedarkmodel: rejecting values beyond %.1f sigma and fitting again.",
+            sigma,
         )
+        sums, exposuretimes = accumulate(sums)
 
-        meanmedian = 0.25 * (median00 + median01 + median10 + median11)
-        q = (median00 - median11) / meanmedian
-        u = (median01 - median10) / meanmedian
-        print(
-            "makeflat: apparent polarization in flat is q = %+.3f u = %+.3f." % (q, u)
-        )
+    offset, rate, residualsigma = solve(sums)
+    sums = None
 
-        data[0::2, 0::2] /= median00
-        data[0::2, 1::2] /= median01
-        data[1::2, 0::2] /= median10
-        data[1::2, 1::2] /= median11
+    global _darkmodeldata
+    _darkmodeldata = np.stack([offset, rate]).astype("float32")
 
-        headerlist.append(header)
-        datalist.append(data)
+    mean, sigma = horno.image.clippedmeanandsigma(_darkmodeldata[0], sigma=5)
+    horno.log.info("makedarkmodel: offset is %.2f ± %.2f DN.", mean, sigma)
+    mean, sigma = horno.image.clippedmeanandsigma(_darkmodeldata[1], sigma=5)
+    horno.log.info("makedarkmodel: rate is %.4f ± %.4f DN/s.", mean, sigma)
+    sigma = horno.image.clippedmean(residualsigma.astype("float32"), sigma=5)
+    horno.log.info("makedarkmodel: residual of fit is %.2f DN.", sigma)
 
-    print("makeflat: averaging %d flats with rejection." % (len(datalist)))
+    writedarkmodel(darkmodelpath, name="makedarkmodel")
 
-    flatdata, flatsigma = horno.image.clippedmeanandsigma(datalist, sigma=3, axis=0)
+    horno.log.info("makedarkmodel: finished.")
+
+    return
 
-    ############################################################################
 
-    print("makeflat: making mask.")
+def makeflatmask(flatdata, medianmethod="tiled", name="makeflatmask"):
+    """
+    Return the bad-pixel mask of a flat.
 
-    maskdata = np.ones(flatdata.shape, dtype="float32")
+    The mask is a boolean array that is true for bad pixels. A pixel is bad
+    if it is nan or inf, if it is globally low, if it is locally high or low
+    with respect to a 7 by 7 median filter, or if it has at least two bad
+    pixels in the 3 by 3 box centered on it.
 
-    print("makeflat: masking nan values.")
-    maskdata[np.isnan(flatdata)] = 0
+    :param flatdata: The flat.
+    :param medianmethod: The method passed to
+        :func:`horno.image.medianfilter`. Defaults to ``"tiled"``.
+    :param name: The name used in messages. Defaults to ``"makeflatmask"``.
+    :return: The mask.
+    """
 
-    print("makeflat: masking inf values.")
-    maskdata[np.isinf(flatdata)] = 0
+    horno.log.info("%s: masking nan values.", name)
+    maskdata = np.isnan(flatdata)
 
-    print("makeflat: masking globally low pixels.")
-    maskdata[np.where(flatdata < 0.80)] = 0
+    horno.log.info("%s: masking inf values.", name)
+    maskdata |= np.isinf(flatdata)
 
-    print("makeflat: masking locally high or low pixels.")
-    low = horno.image.medianfilter(flatdata, 7)
-    high = flatdata / low
-    maskdata[np.where(high < 0.9)] = 0
-    maskdata[np.where(high > 1.1)] = 0
+    horno.log.info("%s: masking globally low pixels.", name)
+    maskdata |= flatdata < 0.80
 
-    print("makeflat: masking pixels with at least two masked neighbors.")
-    # Grow the mask so that any pixel with at least 2 neigboring bad pixels is also bad.
-    grow = horno.image.uniformfilter(maskdata, size=3)
-    maskdata[np.where(grow <= 7 / 9)] = 0
+    horno.log.info("%s: masking locally high or low pixels.", name)
+    low = horno.image.medianfilter(flatdata, 7, method=medianmethod)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        high = flatdata / low
+    maskdata |= high < 0.9
+    maskdata |= high > 1.1
+    del low, high
 
-    print("makeflat: fraction of masked pixels is %.5f." % (1 - np.nanmean(maskdata)))
+    horno.log.info("%s: masking pixels with at least two masked neighbors.", name)
+    maskdata = horno.image.growmask(maskdata, nneighbors=2)
+
+    horno.log.info("%s: fraction of masked pixels is %.5f.", name, np.mean(maskdata))
     centeryslice = slice(int(maskdata.shape[0] * 1 / 4), int(maskdata.shape[0] * 3 / 4))
     centerxslice = slice(int(maskdata.shape[1] * 1 / 4), int(maskdata.shape[1] * 3 / 4))
-    print(
-        "makeflat: fraction of masked pixels in center is %.5f."
-        % (1 - np.nanmean(maskdata[centeryslice, centerxslice]))
+    horno.log.info(
+        "%s: fraction of masked pixels in center is %.5f.",
+        name,
+        np.mean(maskdata[centeryslice, centerxslice]),
+    )
+
+    return maskdata
+
+
+def _normalizeflat(fitspath, header, data, name="makeflat", quality=None):
+    # Normalize a baked flat in place, separately for each of the 00, 01, 10,
+    # and 11 pixels, and return True, or return False if it is rejected. If
+    # the flat has a quality plane, its bad pixels are excluded from the
+    # medians rather than being nan.
+
+    def validmedian(select):
+        # Return the median of the valid pixels of the same view of the data
+        # and the quality plane, or nan if there are none.
+        if quality is None:
+            if np.isnan(select(data)).all():
+                return np.nan
+            return np.nanmedian(select(data))
+        return horno.sky.median(select(data), mask=select(quality))
+
+    centeryslice = slice(int(data.shape[0] * 1 / 4), int(data.shape[0] * 3 / 4))
+    centerxslice = slice(int(data.shape[1] * 1 / 4), int(data.shape[1] * 3 / 4))
+    median = validmedian(lambda a: a[centeryslice, centerxslice])
+    if np.isnan(median):
+        horno.log.info(
+            "%s: rejected %s: no valid data in center.",
+            name,
+            os.path.basename(fitspath),
+        )
+        return False
+    horno.log.info("%s: median in center is %.2f DN.", name, median)
+    if median > horno.instrument.flatmax(header):
+        horno.log.info("%s: rejecting image: median in center is too high.", name)
+        return False
+    horno.log.info("%s: accepted %s.", name, os.path.basename(fitspath))
+
+    centeryslice = slice(int(data.shape[0] / 2 * 1 / 4), int(data.shape[0] / 2 * 3 / 4))
+    centerxslice = slice(int(data.shape[1] / 2 * 1 / 4), int(data.shape[1] / 2 * 3 / 4))
+    median00 = validmedian(lambda a: a[0::2, 0::2][centeryslice, centerxslice])
+    median01 = validmedian(lambda a: a[0::2, 1::2][centeryslice, centerxslice])
+    median10 = validmedian(lambda a: a[1::2, 0::2][centeryslice, centerxslice])
+    median11 = validmedian(lambda a: a[1::2, 1::2][centeryslice, centerxslice])
+
+    horno.log.info(
+        "%s: normalizing 00, 01, 10, and 11 pixels by %.1f, %.1f, %.1f, and %.1f.",
+        name,
+        median00,
+        median01,
+        median10,
+        median11,
+    )
+
+    meanmedian = 0.25 * (median00 + median01 + median10 + median11)
+    q = (median00 - median11) / meanmedian
+    u = (median01 - median10) / meanmedian
+    horno.log.info(
+        "%s: apparent polarization in flat is q = %+.3f u = %+.3f.", name, q, u
+    )
+
+    data[0::2, 0::2] /= median00
+    data[0::2, 1::2] /= median01
+    data[1::2, 0::2] /= median10
+    data[1::2, 1::2] /= median11
+
+    return True
+
+
+def makeflat(
+    fitspaths,
+    flatpath="flat.fits",
+    fitspathsslice=None,
+    stackpath=None,
+    workers=None,
+    indexpath=None,
+    medianmethod="tiled",
+    calibration=None,
+):
+
+    ############################################################################
+
+    horno.log.info("makeflat: making flat %s.", fitspaths)
+
+    ############################################################################
+
+    horno.log.info("makeflat: making flat without mask.")
+
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths, fitspathsslice=fitspathsslice, indexpath=indexpath
     )
 
-    horno.image.show(maskdata, zrange=True)
+    if len(fitspathlist) == 0:
+        horno.log.error("ERROR: no flat files found.")
+        return
+
+    # The flats are baked with quality planes, which are kept in a uint8
+    # stack alongside the data and passed to the clipping as its mask.
+    headerlist = []
+    stack = None
+    qualitystack = None
+    nstack = 0
+    for fitspath, (header, data, quality) in zip(
+        fitspathlist,
+        bakelist(
+            fitspathlist,
+            workers=workers,
+            reuse=True,
+            name="makeflat",
+            dotrim=True,
+            dodark=True,
+            calibration=calibration,
+            doquality=True,
+        ),
+    ):
+        if not _normalizeflat(fitspath, header, data, name="makeflat", quality=quality):
+            continue
+
+        if stack is None:
+            stack = horno.stack.newstack(
+                len(fitspathlist), data.shape, path=stackpath, name="makeflat"
+            )
+            qualitystack = horno.stack.newstack(
+                len(fitspathlist),
+                data.shape,
+                path=(
+                    None
+                    if stackpath is None
+                    else os.path.splitext(stackpath)[0] + "-quality.npy"
+                ),
+                dtype=horno.quality.dtype,
+            )
+        headerlist.append(header)
+        stack[nstack] = data
+        qualitystack[nstack] = quality
+        nstack += 1
+
+    if nstack == 0:
+        horno.log.error("ERROR: no flat files accepted.")
+        return
+
+    horno.log.info("makeflat: averaging %d flats with rejection.", nstack)
+
+    flatdata, flatsigma = horno.image.clippedmeanandsigma(
+        stack[:nstack], sigma=3, axis=0, mask=qualitystack[:nstack]
+    )
 
     ############################################################################
 
-    print("makeflat: making flat with mask.")
+    horno.log.info("makeflat: making mask.")
+
+    maskdata = makeflatmask(flatdata, medianmethod=medianmethod, name="makeflat")
 
-    maskeddatalist = []
-    for data in datalist:
-        data[np.where(maskdata == 0)] = np.nan
-        data / np.nanmedian(data)
-        maskeddatalist.append(data)
+    horno.display.show(np.where(maskdata, 0, 1).astype("float32"), zrange=True)
 
-    print("makeflat: averaging %d flats with rejection." % (len(maskeddatalist)))
+    ############################################################################
+
+    horno.log.info("makeflat: making flat with mask.")
+
+    # Mark the mask in the quality plane of every frame, rather than writing
+    # nan into the stack.
+    horno.quality.setbit(qualitystack[:nstack], horno.quality.FLATBAD, maskdata)
+    horno.quality.describe(qualitystack[:nstack], name="makeflat")
+
+    horno.log.info("makeflat: averaging %d flats with rejection.", nstack)
     flatdata, flatsigma = horno.image.clippedmeanandsigma(
-        maskeddatalist, sigma=3, axis=0
+        stack[:nstack], sigma=3, axis=0, mask=qualitystack[:nstack]
     )
+    horno.stack.closestack(stack, name="makeflat")
+    horno.stack.closestack(qualitystack)
+    stack = None
+    qualitystack = None
 
     mean, sigma = horno.image.clippedmeanandsigma(flatdata, sigma=5)
-    print("makeflat: flat is %.2f ± %.3f." % (mean, sigma))
-
-    sigma = horno.image.clippedmean(flatsigma, sigma=5) / math.sqrt(len(maskeddatalist))
-    print("makeflat: estimated noise in flat is %.4f." % sigma)
+    horno.log.info("makeflat: flat is %.2f ± %.3f.", mean, sigma)
+    sigma = horno.image.clippedmean(flatsigma, sigma=5) / math.sqrt(nstack)
+    horno.log.info("makeflat: estimated noise in flat is %.4f.", sigma)
 
     global _flatdata
+    global _flatmaskdata
     _flatdata = flatdata
-    horno.image.show(_flatdata, zrange=True)
-    writeflat(flatpath, name="makeflat")
+    _flatmaskdata = horno.quality.flatbadmask(flatdata, maskdata)
+    horno.display.show(_flatdata, zrange=True)
+    writeflat(flatpath, name="makeflat", maskdata=maskdata)
 
     ############################################################################
 
-    print("makeflat: finished.")
+    horno.log.info("makeflat: finished.")
 
     return
 
 
+def updateflat(
+    fitspaths,
+    flatpath="flat.fits",
+    statepath="flat.npz",
+    fitspathsslice=None,
+    workers=None,
+    indexpath=None,
+    medianmethod="tiled",
+):
+    """
+    Make or update a master flat incrementally.
+
+    This is the analog of :func:`updatedark` for flats. The flats are
+    baked with quality planes and normalized as in :func:`makeflat`, their
+    bad pixels are not accumulated, and rejected flats are recorded in the
+    state so that they are not baked again. The mask is made from the
+    accumulated mean flat by :func:`makeflatmask` and applied to the master
+    flat. Since the rejection is per pixel, this gives the same flat as
+    masking each frame before combining them.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob`.
+    :param flatpath: The path of the master flat. Defaults to ``"flat.fits"``.
+    :param statepath: The path of the state. Defaults to ``"flat.npz"``.
+    :param fitspathsslice: As for :func:`makeflat`. Defaults to ``None``.
+    :param workers: As for :func:`makeflat`. Defaults to ``None``.
+    :param indexpath: As for :func:`makeflat`. Defaults to ``None``.
+    :param medianmethod: As for :func:`makeflat`. Defaults to ``"tiled"``.
+    """
+
+    horno.log.info("updateflat: updating flat from %s.", fitspaths)
 
-def makeobjects(fitspaths, fitspathsslice=None):
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths, fitspathsslice=fitspathsslice, indexpath=indexpath
+    )
 
-    ############################################################################
+    statepath = statepath.format()
+    state = horno.accumulate.readstate(statepath, name="updateflat")
 
-    print("makeobjects: making objects %s." % fitspaths)
+    if state is not None:
+        fitspathlist = [
+            fitspath for fitspath in fitspathlist if fitspath not in state["paths"]
+        ]
+        horno.log.info("updateflat: %d new flats.", len(fitspathlist))
+        if len(fitspathlist) == 0:
+            horno.log.info("updateflat: finished.")
+            return
+    elif len(fitspathlist) == 0:
+        horno.log.error("ERROR: no flat files found.")
+        return
 
-    ############################################################################
+    # As in makeflat, the flats are baked with quality planes, which are
+    # passed to the accumulation as masks. The first time, they are kept in a
+    # uint8 stack alongside the data.
+    stack = None
+    qualitystack = None
+    nstack = 0
+    for fitspath, (header, data, quality) in zip(
+        fitspathlist,
+        bakelist(
+            fitspathlist,
+            workers=workers,
+            reuse=True,
+            name="updateflat",
+            dotrim=True,
+            dodark=True,
+            doquality=True,
+        ),
+    ):
+        if not _normalizeflat(
+            fitspath, header, data, name="updateflat", quality=quality
+        ):
+            continue
+        if state is not None:
+            horno.accumulate.addframe(state, data, mask=quality)
+            continue
+        if stack is None:
+            stack = horno.stack.newstack(
+                len(fitspathlist), data.shape, name="updateflat"
+            )
+            qualitystack = horno.stack.newstack(
+                len(fitspathlist), data.shape, dtype=horno.quality.dtype
+            )
+        stack[nstack] = data
+        qualitystack[nstack] = quality
+        nstack += 1
+
+    if state is None:
+        if nstack == 0:
+            horno.log.error("ERROR: no flat files accepted.")
+            return
+        horno.log.info("updateflat: averaging %d flats with rejection.", nstack)
+        state = horno.accumulate.newstate(
+            stack[:nstack], sigma=3, mask=qualitystack[:nstack]
+        )
+        horno.stack.closestack(stack, name="updateflat")
+        horno.stack.closestack(qualitystack)
+        stack = None
+        qualitystack = None
+
+    # Record the rejected flats with the accepted ones, so that they are not
+    # baked again.
+    state["paths"].extend(fitspathlist)
+
+    flatdata, flatsigma = horno.accumulate.meanandsigma(state)
+    maskdata = makeflatmask(flatdata, medianmethod=medianmethod, name="updateflat")
+    flatdata[maskdata] = np.nan
+
+    mean, sigma = horno.image.clippedmeanandsigma(flatdata, sigma=5)
+    horno.log.info("updateflat: flat is %.2f ± %.3f.", mean, sigma)
+    global _flatdata
+    global _flatmaskdata
+    _flatdata = flatdata
+    _flatmaskdata = horno.quality.flatbadmask(flatdata, maskdata)
+    writeflat(flatpath, name="updateflat", maskdata=maskdata)
+    horno.accumulate.writestate(statepath, state, name="updateflat")
 
-    fitspathlist = horno.path.getrawfitspaths(fitspaths, fitspathsslice=fitspathsslice)
+    horno.log.info("updateflat: finished.")
+
+    return
+
+
+def iterobjects(
+    fitspaths,
+    fitspathsslice=None,
+    workers=None,
+    prefetch=1,
+    indexpath=None,
+    calibration=None,
+    doquality=False,
+    cache=None,
+):
+    """
+    Bake object files, yielding ``(fitspath, header, data)`` for each in turn.
+
+    This is the streaming form of :func:`makeobjects`. Each frame is yielded
+    as soon as it has been baked, so the first frame is available after one
+    frame's latency and only a bounded number of frames are in memory at any
+    time.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob`.
+    :param fitspathsslice: Passed to :func:`horno.path.getrawfitspaths`.
+        Defaults to ``None``.
+    :param workers: The number of worker processes or ``None``. Defaults to
+        ``None``.
+    :param prefetch: The number of files to read ahead on a background thread
+        when ``workers`` is ``None``. Defaults to 1.
+    :param indexpath: Passed to :func:`horno.path.getrawfitspaths`. Defaults
+        to ``None``.
+    :param calibration: A :class:`horno.calibration.CalibrationStore` from
+        which to take the master dark and flat for each frame, or ``None`` to
+        use the current dark and flat. Defaults to ``None``.
+    :param doquality: Whether to also yield the quality plane of each frame,
+        as ``(fitspath, header, data, quality)``. Defaults to ``False``.
+    :param cache: A :class:`horno.framecache.FrameCache` of baked frames or
+        ``None``. Defaults to ``None``.
+    :return: An iterator over ``(fitspath, header, data)`` for each file.
+    """
+
+    horno.log.info("iterobjects: making objects %s.", fitspaths)
+
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths, fitspathsslice=fitspathsslice, indexpath=indexpath
+    )
 
     if len(fitspathlist) == 0:
-        print("ERROR: no object files found.")
+        horno.log.error("ERROR: no object files found.")
         return
 
-    headerlist = []
-    datalist = []
-    for fitspath in fitspathlist:
-        header, data = bake(
-            fitspath,
-            name="makeobjects",
+    for fitspath, result in zip(
+        fitspathlist,
+        bakelist(
+            fitspathlist,
+            workers=workers,
+            prefetch=prefetch,
+            name="iterobjects",
             dotrim=True,
             dodark=True,
             doflat=True,
-        )
+            calibration=calibration,
+            doquality=doquality,
+            cache=cache,
+        ),
+    ):
+        yield (fitspath,) + result
+
+    horno.log.info("iterobjects: finished.")
+
+    return
+
 
+def makeobjects(
+    fitspaths,
+    fitspathsslice=None,
+    workers=None,
+    indexpath=None,
+    calibration=None,
+    cache=None,
+):
+
+    ############################################################################
+
+    horno.log.info("makeobjects: making objects %s.", fitspaths)
+
+    ############################################################################
+
+    fitspathlist = horno.path.getrawfitspaths(
+        fitspaths, fitspathsslice=fitspathsslice, indexpath=indexpath
+    )
+
+    if len(fitspathlist) == 0:
+        horno.log.error("ERROR: no object files found.")
+        return
+
+    headerlist = []
+    datalist = []
+    for header, data in bakelist(
+        fitspathlist,
+        workers=workers,
+        name="makeobjects",
+        dotrim=True,
+        dodark=True,
+        doflat=True,
+        calibration=calibration,
+        cache=cache,
+    ):
         headerlist.append(header)
         datalist.append(data)
 
     ############################################################################
 
-    print("makeobjects: finished.")
+    horno.log.info("makeobjects: finished.")
 
     return headerlist, datalist
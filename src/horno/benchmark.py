@@ -0,0 +1,741 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import astropy.io.fits
+import numpy as np
+
+import horno.bake
+import horno.calibration
+import horno.display
+import horno.fits
+import horno.image
+import horno.instrument
+import horno.sky
+
+
+def _timeit(function, nrepeat):
+    # Return the median wall time of a function in seconds, discarding its
+    # messages.
+    times = []
+    for i in range(nrepeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            end = time.perf_counter()
+        times.append(end - start)
+    return float(np.median(times))
+
+
+# The bias level of the synthetic raw frames in DN.
+syntheticbias = 100
+
+
+def syntheticraw(
+    shape=(3000, 4112),
+    exposuretime=60.0,
+    imagetype="object",
+    level=None,
+    gradient=0.0,
+    vignetting=0.4,
+    fdefects=0.0,
+    nstars=None,
+    dopolarization=False,
+    doreturnsky=False,
+    seed=0,
+):
+    """
+    Return a synthetic raw header and uint16 data.
+
+    The data follow :mod:`horno.instrument`: they are 12-bit and saturate at
+    :func:`horno.instrument.datamax`, and the trim region is inside the
+    default shape. All types have a bias of :data:`syntheticbias` DN with a
+    read noise of 5 DN, and Poisson noise.
+
+    The sky above the bias is ``level`` DN at the center, with a linear
+    gradient of a fraction ``gradient`` of the level across the frame in x
+    and half that in y. It is multiplied by the flat pattern, which is
+    vignetted by a fraction ``vignetting`` of the level at the center
+    towards the corners, and in which a fraction ``fdefects`` of the pixels
+    have a response low by 20% to 50% and a tenth as many a response high by
+    50%. Objects also have ``nstars`` Gaussian stars with a FWHM of 8 pixels,
+    some of which saturate.
+
+    If ``dopolarization`` is true, the signal above the bias is modulated in
+    the 2 by 2 pattern of the polarizers, with q = 0.05 and u = -0.03 for
+    objects and q = u = 0.01 for flats, so that the 00 and 11 pixels differ
+    by q and the 01 and 10 pixels by u.
+
+    :param shape: The shape of the raw data. Defaults to ``(3000, 4112)``.
+    :param exposuretime: The exposure time. Defaults to 60.
+    :param imagetype: ``"dark"``, ``"flat"``, or ``"object"``. Defaults to
+        ``"object"``.
+    :param level: The sky level in DN, or ``None`` for 0 for darks, 2000 for
+        flats, and 500 for objects, which keeps the flats below
+        :func:`horno.instrument.flatmax`. Defaults to ``None``.
+    :param gradient: The gradient of the sky. Defaults to 0.
+    :param vignetting: The vignetting of the flat pattern. Defaults to 0.4.
+    :param fdefects: The fraction of pixels with a low response in the flat
+        pattern. Defaults to 0.
+    :param nstars: The number of stars in objects, or ``None`` for 200.
+        Defaults to ``None``.
+    :param dopolarization: Whether to apply the polarization pattern.
+        Defaults to ``False``.
+    :param doreturnsky: Whether to also return the noiseless sky above the
+        bias, with the flat pattern and without the stars or polarization.
+        Defaults to ``False``.
+    :param seed: The seed of the random number generator. Defaults to 0.
+    :return: The header and data and, if ``doreturnsky`` is true, the sky.
+    """
+
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+
+    header = astropy.io.fits.Header()
+    header.append(("EXPTIME", exposuretime))
+    header.append(("IMAGETYP", imagetype))
+    header.append(("DATE-OBS", "2024-01-01T00:00:%02d.000" % (seed % 60)))
+
+    if imagetype == "dark":
+        defaultlevel = 0
+        q, u = 0.0, 0.0
+    elif imagetype == "flat":
+        defaultlevel = 2000
+        q, u = 0.01, 0.01
+    elif imagetype == "object":
+        defaultlevel = 500
+        q, u = 0.05, -0.03
+    else:
+        raise RuntimeError("invalid image type %r." % imagetype)
+    if level is None:
+        level = defaultlevel
+    if nstars is None:
+        nstars = 200 if imagetype == "object" else 0
+
+    y, x = np.ogrid[0:ny, 0:nx]
+    r2 = ((y - ny / 2) / ny) ** 2 + ((x - nx / 2) / nx) ** 2
+    response = (1 - vignetting * r2).astype("float32")
+    if fdefects > 0:
+        low = rng.random(shape) < fdefects
+        response[low] *= rng.uniform(0.5, 0.8, size=np.count_nonzero(low))
+        response[rng.random(shape) < fdefects / 10] *= 1.5
+    sky = level * (1 + gradient * (x / nx - 0.5) + 0.5 * gradient * (y / ny - 0.5))
+    sky = (sky * response).astype("float32")
+
+    signal = sky.copy()
+    sigma = 8 / 2.3548
+    nhalf = 16
+    offsets = np.arange(-nhalf, nhalf + 1)
+    for i in range(nstars):
+        ystar = rng.uniform(nhalf, ny - nhalf - 1)
+        xstar = rng.uniform(nhalf, nx - nhalf - 1)
+        iy = int(ystar)
+        ix = int(xstar)
+        profile = np.exp(
+            -0.5
+            * (
+                ((iy + offsets[:, np.newaxis] - ystar) / sigma) ** 2
+                + ((ix + offsets[np.newaxis, :] - xstar) / sigma) ** 2
+            )
+        )
+        signal[iy - nhalf : iy + nhalf + 1, ix - nhalf : ix + nhalf + 1] += (
+            rng.uniform(100, 5000)
+            * profile
+            * response[iy - nhalf : iy + nhalf + 1, ix - nhalf : ix + nhalf + 1]
+        )
+
+    if dopolarization:
+        signal[0::2, 0::2] *= 1 + q
+        signal[1::2, 1::2] *= 1 - q
+        signal[0::2, 1::2] *= 1 + u
+        signal[1::2, 0::2] *= 1 - u
+
+    data = rng.poisson(signal) + rng.normal(syntheticbias, 5, size=shape)
+    data = np.clip(data, 0, horno.instrument.datamax(header)).astype("uint16")
+
+    if doreturnsky:
+        return header, data, sky
+    return header, data
+
+
+def _syntheticcalibrated(shape, finvalid=0.001, seed=0):
+    # Return synthetic calibrated data and the true sky, as an object from
+    # syntheticraw with a sky gradient and 2000 stars in a full frame, without
+    # its bias, and with a fraction finvalid of invalid pixels.
+    nstars = round(2000 * shape[0] * shape[1] / (2997 * 4105))
+    header, data, sky = syntheticraw(
+        shape, gradient=0.1, nstars=nstars, doreturnsky=True, seed=seed
+    )
+    data = data.astype("float32") - syntheticbias
+    data[np.random.default_rng(seed).random(shape) < finvalid] = np.nan
+    return data, sky
+
+
+def benchmarkbake(shape=(3000, 4112), nrepeat=10):
+    """
+    Print and return the per-frame latency of the calibration in :func:`bake`.
+
+    A synthetic raw frame is trimmed, dark-subtracted, and flat-fielded by the
+    original multi-pass calibration and by the fused calibration, with and
+    without reusing the output buffer. No FITS file is read.
+
+    :param shape: The shape of the raw data. Defaults to ``(3000, 4112)``.
+    :param nrepeat: The number of times to time each case. Defaults to 10.
+    :return: A dict mapping each case to its median latency in seconds.
+    """
+
+    header, rawdata = syntheticraw(shape)
+    yslice = horno.instrument.trimyslice(header)
+    xslice = horno.instrument.trimxslice(header)
+    trimshape = rawdata[yslice, xslice].shape
+
+    calibration = horno.calibration.CalibrationStore(darkpath="dark", flatpath="flat")
+    calibration.put("dark", "dark", np.full(trimshape, 100, dtype="float32"))
+    calibration.put("flat", "flat", np.full(trimshape, 1, dtype="float32"))
+
+    def bake(dofused, out=None):
+        return horno.bake.bake(
+            "synthetic",
+            raw=(header, rawdata),
+            dotrim=True,
+            dodark=True,
+            doflat=True,
+            calibration=calibration,
+            dofused=dofused,
+            out=out,
+        )
+
+    out = np.empty(trimshape, dtype="float32")
+    result = {
+        "unfused": _timeit(lambda: bake(False), nrepeat),
+        "fused": _timeit(lambda: bake(True), nrepeat),
+        "fused with reused buffer": _timeit(lambda: bake(True, out=out), nrepeat),
+    }
+    for case, latency in result.items():
+        print("benchmarkbake: %s: %.1f ms per frame." % (case, latency * 1e3))
+
+    return result
+
+
+def benchmarksky(shape=(2997, 4105), nrepeat=3):
+    """
+    Print and return the speed and accuracy of the sky estimators.
+
+    Each estimator in :data:`horno.sky.methods` is applied to a synthetic
+    object from :func:`syntheticraw`, with a sky gradient and 2000 stars in a
+    full frame, without its bias, and with 0.1% invalid pixels. The accuracy
+    is given as the difference from the exact median and, for all
+    estimators, as the RMS difference from the true sky.
+
+    :param shape: The shape of the data. Defaults to ``(2997, 4105)``.
+    :param nrepeat: The number of times to time each estimator. Defaults to 3.
+    :return: A dict mapping each estimator to a dict with its time in seconds,
+        its difference from the exact median, and its RMS error.
+    """
+
+    data, truesky = _syntheticcalibrated(shape)
+    exact = horno.sky.median(data)
+
+    result = {}
+    for method in horno.sky.methods:
+        latency = _timeit(lambda: horno.sky.sky(data, method=method), nrepeat)
+        sky = horno.sky.sky(data, method=method)
+        result[method] = {
+            "time": latency,
+            "median error": float(np.nanmedian(sky)) - exact,
+            "rms error": float(np.sqrt(np.mean(np.square(sky - truesky)))),
+        }
+        print(
+            "benchmarksky: %s: %.1f ms, %+.2f DN from median, %.2f DN RMS error."
+            % (
+                method,
+                latency * 1e3,
+                result[method]["median error"],
+                result[method]["rms error"],
+            )
+        )
+
+    return result
+
+
+def _originalflatmask(flatdata):
+    # The mask as originally made in makeflat, as a float32 array that is 0 for
+    # bad pixels, with an exact median filter and a float32 uniform filter.
+    maskdata = np.ones(flatdata.shape, dtype="float32")
+    maskdata[np.isnan(flatdata)] = 0
+    maskdata[np.isinf(flatdata)] = 0
+    maskdata[np.where(flatdata < 0.80)] = 0
+    low = horno.image.medianfilter(flatdata, 7, method="exact")
+    high = flatdata / low
+    maskdata[np.where(high < 0.9)] = 0
+    maskdata[np.where(high > 1.1)] = 0
+    grow = horno.image.uniformfilter(maskdata, size=3)
+    maskdata[np.where(grow <= 7 / 9)] = 0
+    return maskdata
+
+
+def benchmarkflatmask(shape=(2997, 4105), methods=None):
+    """
+    Print and return the speed and agreement of the flat mask methods.
+
+    The bad-pixel mask of a synthetic flat from :func:`syntheticraw`, with
+    0.1% defective pixels, normalized, and with a few invalid pixels, is made
+    as originally in :func:`horno.bake.makeflat` and by
+    :func:`horno.bake.makeflatmask` with each median filter method. The
+    agreement is the number of pixels whose mask differs from the original.
+
+    :param shape: The shape of the flat. Defaults to ``(2997, 4105)``.
+    :param methods: The median filter methods, or ``None`` for ``"exact"``,
+        ``"tiled"``, ``"separable"``, and ``"downsample"``. Defaults to
+        ``None``.
+    :return: A dict mapping each method to a dict with its time in seconds
+        and its number of differing pixels.
+    """
+
+    if methods is None:
+        methods = ["exact", "tiled", "separable", "downsample"]
+
+    header, data = syntheticraw(shape, imagetype="flat", fdefects=0.001)
+    flatdata = data.astype("float32") - syntheticbias
+    flatdata /= np.median(flatdata)
+    flatdata[np.random.default_rng(0).random(shape) < 0.00001] = np.nan
+
+    start = time.perf_counter()
+    original = _originalflatmask(flatdata) == 0
+    latency = time.perf_counter() - start
+    print(
+        "benchmarkflatmask: original: %.2f s, %d masked pixels."
+        % (latency, np.count_nonzero(original))
+    )
+
+    result = {"original": {"time": latency, "differences": 0}}
+    for method in methods:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            maskdata = horno.bake.makeflatmask(flatdata, medianmethod=method)
+            latency = time.perf_counter() - start
+        differences = int(np.count_nonzero(maskdata != original))
+        result[method] = {"time": latency, "differences": differences}
+        print(
+            "benchmarkflatmask: %s: %.2f s, %d pixels differ from original."
+            % (method, latency, differences)
+        )
+
+    return result
+
+
+def writesyntheticframes(
+    directory,
+    imagetype="object",
+    nframes=4,
+    docompress=False,
+    shape=(3000, 4112),
+    exposuretime=60.0,
+    dopolarization=False,
+):
+    """
+    Write synthetic raw frames from :func:`syntheticraw` as FITS files.
+
+    The files are named ``{imagetype}-{i:04d}.fits``, or
+    ``{imagetype}-{i:04d}.fits.fz`` if ``docompress`` is true, in which case
+    the data are Rice-compressed in HDU 1, as by fpack. Frame ``i`` uses seed
+    ``i``, so the files are the same on every machine.
+
+    :param directory: The directory.
+    :param imagetype: As for :func:`syntheticraw`. Defaults to ``"object"``.
+    :param nframes: The number of frames. Defaults to 4.
+    :param docompress: Whether to write compressed files. Defaults to
+        ``False``.
+    :param shape: As for :func:`syntheticraw`. Defaults to
+        ``(3000, 4112)``.
+    :param exposuretime: As for :func:`syntheticraw`. Defaults to 60.
+    :param dopolarization: As for :func:`syntheticraw`. Defaults to
+        ``False``.
+    :return: The glob pattern of the files.
+    """
+    suffix = ".fits.fz" if docompress else ".fits"
+    for i in range(nframes):
+        header, data = syntheticraw(
+            shape=shape,
+            imagetype=imagetype,
+            exposuretime=exposuretime,
+            dopolarization=dopolarization,
+            seed=i,
+        )
+        path = os.path.join(directory, "%s-%04d%s" % (imagetype, i, suffix))
+        if docompress:
+            hdu = astropy.io.fits.CompImageHDU(data, header)
+        else:
+            hdu = astropy.io.fits.PrimaryHDU(data, header)
+        hdu.writeto(path, overwrite=True)
+    return os.path.join(directory, "%s-*%s" % (imagetype, suffix))
+
+
+def _peakrss():
+    # Return the peak resident set size in MB of this process and of its
+    # terminated children, such as the worker processes. On Linux, ru_maxrss
+    # is in kB.
+    self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self, children) / 1024
+
+
+def _environment():
+    # Return a description of the code and machine, so that results from
+    # different commits and machines can be told apart.
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "astropy": astropy.__version__,
+        "machine": platform.machine(),
+        "ncpu": os.cpu_count(),
+    }
+
+
+def benchmarksuite(
+    nframeslist=(4, 16),
+    workerslist=(None, 2, 4),
+    docompress=False,
+    dopolarization=True,
+    shape=(3000, 4112),
+    directory=None,
+    resultpath=None,
+):
+    """
+    Print and return the throughput of the main stages on synthetic frames.
+
+    Synthetic darks, flats, and objects are written with
+    :func:`writesyntheticframes` and then :func:`horno.fits.readrawnative`,
+    :func:`horno.bake.bake`, :func:`horno.bake.makedark`,
+    :func:`horno.bake.makeflat`, :func:`horno.bake.makeobjects`, and
+    :func:`horno.image.sigmaclippedstats` are timed for each number of frames
+    and, where they apply, each number of workers. For each case, the result
+    has the wall time, the throughput in frames per second and in MB per
+    second of raw files, or of the stack for sigmaclippedstats, and the peak
+    RSS of this process and its workers so
+    far. The peak RSS only increases during a run, so it is most useful for
+    the first and largest cases. The display is disabled during the suite, so
+    that makedark and makeflat do not plot.
+
+    The frames are the same on every machine, and the results include the
+    commit and a description of the machine, so results from different
+    commits can be compared by appending them to the same ``resultpath``.
+
+    :param nframeslist: The numbers of frames. Defaults to ``(4, 16)``.
+    :param workerslist: The numbers of workers, with ``None`` for serial.
+        Defaults to ``(None, 2, 4)``.
+    :param docompress: Whether to use compressed raw files. Defaults to
+        ``False``.
+    :param dopolarization: Whether the frames have the polarization pattern.
+        Defaults to ``True``.
+    :param shape: The shape of the raw frames. Defaults to ``(3000, 4112)``.
+    :param directory: The directory for the frames and products, or ``None``
+        to use a temporary directory that is removed afterwards. Existing
+        frames are not reused. Defaults to ``None``.
+    :param resultpath: The path of a file to which to append the results as
+        lines of JSON, or ``None``. Defaults to ``None``.
+    :return: A list of dicts, one for each case.
+    """
+
+    environment = _environment()
+    print(
+        "benchmarksuite: commit %s with %d CPUs."
+        % (environment["commit"], environment["ncpu"])
+    )
+
+    nframesmax = max(nframeslist)
+    istemporary = directory is None
+    if istemporary:
+        directory = tempfile.mkdtemp(prefix="horno-benchmark-")
+
+    resultlist = []
+
+    def record(benchmark, nframes, workers, seconds, nbytes):
+        result = dict(environment)
+        result.update(
+            {
+                "benchmark": benchmark,
+                "nframes": nframes,
+                "workers": workers,
+                "compressed": docompress,
+                "seconds": seconds,
+                "framespersecond": nframes / seconds,
+                "mbpersecond": nbytes / 1e6 / seconds,
+                "peakrssmb": _peakrss(),
+            }
+        )
+        resultlist.append(result)
+        print(
+            "benchmarksuite: %s: %d frames with %s workers: "
+            "%.2f s, %.2f frames/s, %.1f MB/s, %.0f MB peak RSS."
+            % (
+                benchmark,
+                nframes,
+                workers,
+                seconds,
+                result["framespersecond"],
+                result["mbpersecond"],
+                result["peakrssmb"],
+            )
+        )
+
+    def timed(function):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            end = time.perf_counter()
+        return end - start
+
+    dodisplay = horno.display.isenabled()
+    horno.display.disable()
+
+    try:
+
+        print("benchmarksuite: writing %d frames of each type." % nframesmax)
+        patterns = {}
+        for imagetype in ["dark", "flat", "object"]:
+            patterns[imagetype] = writesyntheticframes(
+                directory,
+                imagetype,
+                nframes=nframesmax,
+                docompress=docompress,
+                shape=shape,
+                dopolarization=dopolarization,
+            )
+        objectpaths = sorted(
+            os.path.join(directory, path)
+            for path in os.listdir(directory)
+            if path.startswith("object-")
+        )
+        darkpath = os.path.join(directory, "dark-{exposuretime:.0f}.fits")
+        flatpath = os.path.join(directory, "flat.fits")
+
+        for nframes in nframeslist:
+
+            fitspathsslice = slice(0, nframes)
+            nbytes = sum(os.path.getsize(path) for path in objectpaths[:nframes])
+
+            seconds = timed(
+                lambda: [
+                    horno.fits.readrawnative(path) for path in objectpaths[:nframes]
+                ]
+            )
+            record("readraw", nframes, None, seconds, nbytes)
+
+            for workers in workerslist:
+
+                seconds = timed(
+                    lambda: horno.bake.makedark(
+                        patterns["dark"],
+                        60.0,
+                        darkpath=darkpath,
+                        fitspathsslice=fitspathsslice,
+                        workers=workers,
+                    )
+                )
+                record("makedark", nframes, workers, seconds, nbytes)
+
+                seconds = timed(
+                    lambda: horno.bake.makeflat(
+                        patterns["flat"],
+                        flatpath=flatpath,
+                        fitspathsslice=fitspathsslice,
+                        workers=workers,
+                    )
+                )
+                record("makeflat", nframes, workers, seconds, nbytes)
+
+                seconds = timed(
+                    lambda: list(
+                        horno.bake.bakelist(
+                            objectpaths[:nframes],
+                            workers=workers,
+                            dotrim=True,
+                            dodark=True,
+                            doflat=True,
+                        )
+                    )
+                )
+                record("bake", nframes, workers, seconds, nbytes)
+
+                seconds = timed(
+                    lambda: horno.bake.makeobjects(
+                        patterns["object"],
+                        fitspathsslice=fitspathsslice,
+                        workers=workers,
+                    )
+                )
+                record("makeobjects", nframes, workers, seconds, nbytes)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                stack = np.array(
+                    [
+                        data
+                        for header, data in horno.bake.bakelist(
+                            objectpaths[:nframes], dotrim=True, dodark=True, doflat=True
+                        )
+                    ]
+                )
+            seconds = timed(lambda: horno.image.sigmaclippedstats(stack, axis=0))
+            record("sigmaclippedstats", nframes, None, seconds, stack.nbytes)
+            stack = None
+
+    finally:
+        if dodisplay:
+            horno.display.enable()
+        if istemporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if resultpath is not None:
+        print("benchmarksuite: appending results to %s." % resultpath)
+        with open(resultpath, "a") as f:
+            for result in resultlist:
+                f.write(json.dumps(result) + "\n")
+
+    return resultlist
+
+
+def compareresults(resultpath, benchmark=None):
+    """
+    Print the results of :func:`benchmarksuite` for different commits.
+
+    For each benchmark, number of frames, number of workers, and compression,
+    the throughput in frames per second is printed for each commit in the
+    order in which they appear in the file.
+
+    :param resultpath: The path of the file of results.
+    :param benchmark: The name of a benchmark to print, or ``None`` for all.
+        Defaults to ``None``.
+    :return: A dict mapping each case to a dict mapping each commit to the
+        throughput in frames per second.
+    """
+    comparison = {}
+    with open(resultpath) as f:
+        for line in f:
+            result = json.loads(line)
+            if benchmark is not None and result["benchmark"] != benchmark:
+                continue
+            case = (
+                result["benchmark"],
+                result["nframes"],
+                result["workers"],
+                result["compressed"],
+            )
+            comparison.setdefault(case, {})[result["commit"]] = result[
+                "framespersecond"
+            ]
+    for case, commits in comparison.items():
+        print(
+            "compareresults: %s: %d frames with %s workers%s: %s."
+            % (
+                case[0],
+                case[1],
+                case[2],
+                " compressed" if case[3] else "",
+                ", ".join(
+                    "%s %.2f frames/s" % (commit, framespersecond)
+                    for commit, framespersecond in commits.items()
+                ),
+            )
+        )
+    return comparison
+
+
+def benchmarkwrite(shape=(2997, 4105), cases=None, nrepeat=3, directory=None):
+    """
+    Print and return the speed and compression of product writes.
+
+    Synthetic calibrated data, as for :func:`benchmarksky`, are written by
+    :func:`horno.fits.writeproduct` with each case, with a mask of the
+    invalid pixels. Each case is uncompressed or a compression type with a
+    quantization level. The asynchronous case times only the call, which
+    returns while the data are compressed and written on a background
+    thread. The error is the RMS difference between the data read back and
+    the original data, which can be compared to the noise of about 23 DN.
+
+    :param shape: The shape of the data. Defaults to ``(2997, 4105)``.
+    :param cases: A list of ``(compression, quantizelevel, doasync)``, with
+        ``compression`` of ``None`` for uncompressed, or ``None`` for a
+        default set of cases. Defaults to ``None``.
+    :param nrepeat: The number of times to time each case. Defaults to 3.
+    :param directory: The directory for the files, or ``None`` for a
+        temporary directory that is removed afterwards. Defaults to ``None``.
+    :return: A dict mapping each case to a dict with its time in seconds, its
+        size in MB, its compression ratio, and its RMS error.
+    """
+
+    if cases is None:
+        cases = [
+            (None, None, False),
+            ("RICE_1", 16, False),
+            ("RICE_1", 4, False),
+            ("GZIP_2", 16, False),
+            ("GZIP_2", 0, False),
+            ("RICE_1", 16, True),
+        ]
+
+    data, truesky = _syntheticcalibrated(shape)
+    maskdata = np.isnan(data)
+
+    istemporary = directory is None
+    if istemporary:
+        directory = tempfile.mkdtemp(prefix="horno-benchmark-")
+
+    result = {}
+    try:
+        for compression, quantizelevel, doasync in cases:
+            if compression is None:
+                path = os.path.join(directory, "product.fits")
+                kwargs = {}
+            else:
+                path = os.path.join(directory, "product.fits.fz")
+                kwargs = {"compression": compression, "quantizelevel": quantizelevel}
+            latency = _timeit(
+                lambda: horno.fits.writeproduct(
+                    path, data, maskdata=maskdata, doasync=doasync, **kwargs
+                ),
+                nrepeat,
+            )
+            horno.fits.waitforwrites()
+            size = os.path.getsize(path)
+            readdata = horno.fits.readproductdata(path)
+            error = float(np.sqrt(np.nanmean(np.square(readdata - data))))
+            if compression is None:
+                case = "uncompressed"
+            else:
+                case = "%s q=%s" % (compression, quantizelevel)
+            if doasync:
+                case += " async"
+            result[case] = {
+                "time": latency,
+                "size": size / 1e6,
+                "ratio": data.nbytes / size,
+                "rms error": error,
+            }
+            print(
+                "benchmarkwrite: %s: %.2f s, %.1f MB, ratio %.1f, %.3f DN RMS error."
+                % (case, latency, size / 1e6, data.nbytes / size, error)
+            )
+    finally:
+        if istemporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return result
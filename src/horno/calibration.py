@@ -0,0 +1,173 @@
+import collections
+import os.path
+import threading
+
+import horno.fits
+import horno.instrument
+import horno.log
+import horno.quality
+
+
+class CalibrationStore:
+    """
+    A store of master calibration frames.
+
+    The store reads master darks and flats lazily, the first time each is
+    needed, and then keeps them in memory. The master for a frame is chosen
+    from its header: the path templates are formatted with the exposure time
+    (``{exposuretime}``) and the date of the observation (``{date}``, from
+    ``DATE-OBS``), and the formatted path is the key of the master in the
+    store. So, for example, a night with mixed exposure times reads each dark
+    once, however the exposure times are interleaved.
+
+    If ``darkmodelpath`` is given, the darks are instead synthesized for the
+    exposure time of each frame from a dark model made by
+    :func:`horno.bake.makedarkmodel`, so no master dark is needed for each
+    exposure time.
+
+    The masters are kept in least-recently-used order, and the least recently
+    used are evicted when their total size exceeds ``maxbytes``.
+
+    The store can be used from several threads at once. When it is pickled,
+    for example to send it to a worker process, only its configuration is
+    pickled, and each process reads its own masters.
+
+    :param darkpath: The path template of the master darks. Defaults to
+        ``"dark-{exposuretime:.0f}.fits"``.
+    :param flatpath: The path template of the master flats. Defaults to
+        ``"flat.fits"``.
+    :param maxbytes: The maximum total size of the masters kept in memory.
+        Defaults to 1 GiB.
+    :param name: The name used in messages. Defaults to ``"calibration"``.
+    :param darkmodelpath: The path template of the dark models, or ``None``
+        to use master darks. Defaults to ``None``.
+    """
+
+    def __init__(
+        self,
+        darkpath="dark-{exposuretime:.0f}.fits",
+        flatpath="flat.fits",
+        maxbytes=1024**3,
+        name="calibration",
+        darkmodelpath=None,
+    ):
+        self.darkpath = darkpath
+        self.flatpath = flatpath
+        self.maxbytes = maxbytes
+        self.name = name
+        self.darkmodelpath = darkmodelpath
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {
+            "darkpath": self.darkpath,
+            "flatpath": self.flatpath,
+            "maxbytes": self.maxbytes,
+            "name": self.name,
+            "darkmodelpath": self.darkmodelpath,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _path(self, template, header):
+        dateobs = horno.instrument.dateobs(header)
+        return template.format(
+            exposuretime=horno.instrument.exposuretime(header),
+            date=None if dateobs is None else dateobs[:10],
+        )
+
+    def _get(self, kind, path, read=horno.fits.readproductdata):
+        key = (kind, path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if not os.path.exists(path):
+                raise RuntimeError("no %s found." % kind)
+            horno.log.info("%s: reading %s.", self.name, path)
+            data = read(path)
+            data.setflags(write=False)
+            self._cache[key] = data
+            self._evict()
+            return data
+
+    def _evict(self):
+        nbytes = sum(data.nbytes for data in self._cache.values())
+        while nbytes > self.maxbytes and len(self._cache) > 1:
+            (kind, path), data = self._cache.popitem(last=False)
+            horno.log.info("%s: evicting %s.", self.name, path)
+            nbytes -= data.nbytes
+
+    def dark(self, header):
+        """
+        Return the master dark for a raw frame.
+
+        :param header: The raw FITS header of the frame.
+        :return: The master dark data.
+        """
+        return self._get("dark", self._path(self.darkpath, header))
+
+    def darkmodel(self, header):
+        """
+        Return the dark model for a raw frame.
+
+        :param header: The raw FITS header of the frame.
+        :return: The dark model data, with the offset and rate planes, or
+            ``None`` if the store has no dark models.
+        """
+        if self.darkmodelpath is None:
+            return None
+        return self._get("dark model", self._path(self.darkmodelpath, header))
+
+    def flat(self, header):
+        """
+        Return the master flat for a raw frame.
+
+        :param header: The raw FITS header of the frame.
+        :return: The master flat data.
+        """
+        return self._get("flat", self._path(self.flatpath, header))
+
+    def flatmask(self, header):
+        """
+        Return the mask of the bad pixels of the master flat for a raw frame.
+
+        The mask is made by :func:`horno.quality.flatbadmask` from the flat
+        and the mask written with it, and is kept in the store like the
+        masters.
+
+        :param header: The raw FITS header of the frame.
+        :return: A boolean array that is true for the bad pixels of the flat.
+        """
+        path = self._path(self.flatpath, header)
+        flatdata = self._get("flat", path)
+        return self._get(
+            "flat mask",
+            path,
+            lambda path: horno.quality.flatbadmask(
+                flatdata, horno.fits.readproductmask(path)
+            ),
+        )
+
+    def put(self, kind, path, data):
+        """
+        Add a master to the store, for example after it has been made.
+
+        :param kind: The kind of master, either ``"dark"``, ``"dark model"``,
+            ``"flat"``, or ``"flat mask"``.
+        :param path: The formatted path of the master.
+        :param data: The master data.
+        """
+        with self._lock:
+            self._cache[(kind, path)] = data
+            self._cache.move_to_end((kind, path))
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all masters from the store.
+        """
+        with self._lock:
+            self._cache.clear()
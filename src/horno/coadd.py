@@ -0,0 +1,434 @@
+import glob
+import math
+
+import numpy as np
+
+import horno.detection
+import horno.fits
+import horno.image
+import horno.instrument
+import horno.log
+import horno.polarimetry
+
+
+def _bin(data, nbin):
+    # Return the mean of each nbin by nbin block, with invalid pixels replaced
+    # by the median of a sample, dropping any partial last row or column of
+    # blocks.
+    ny = data.shape[0] // nbin * nbin
+    nx = data.shape[1] // nbin * nbin
+    data = np.asarray(data[:ny, :nx], dtype="float32")
+    isvalid = np.isfinite(data)
+    if not isvalid.all():
+        sample = data[::7, ::7][isvalid[::7, ::7]]
+        data = np.where(isvalid, data, np.median(sample) if len(sample) > 0 else 0)
+    return data.reshape(ny // nbin, nbin, nx // nbin, nbin).mean(axis=(1, 3))
+
+
+def _window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype("float32")
+
+
+def _peak(correlation):
+    # Return the position of the maximum of a circular correlation surface,
+    # refined to subpixel precision by fitting a parabola along each axis, as
+    # signed offsets.
+    ny, nx = correlation.shape
+    iy, ix = np.unravel_index(np.argmax(correlation), correlation.shape)
+    offsets = []
+    for i, n, before, center, after in (
+        (
+            iy,
+            ny,
+            correlation[(iy - 1) % ny, ix],
+            correlation[iy, ix],
+            correlation[(iy + 1) % ny, ix],
+        ),
+        (
+            ix,
+            nx,
+            correlation[iy, (ix - 1) % nx],
+            correlation[iy, ix],
+            correlation[iy, (ix + 1) % nx],
+        ),
+    ):
+        denominator = before - 2 * center + after
+        delta = 0.5 * (before - after) / denominator if denominator != 0 else 0.0
+        if i > n // 2:
+            i -= n
+        offsets.append(i + delta)
+    return offsets[0], offsets[1]
+
+
+def _phasecorrelate(data, reference):
+    # Return the offset (dy, dx) of data with respect to reference, both of the
+    # same shape, from the peak of their phase correlation. The images are
+    # tapered with a Hann window to suppress the edges.
+    window = _window(data.shape)
+    data = (data - np.median(data)) * window
+    reference = (reference - np.median(reference)) * window
+    spectrum = np.fft.rfft2(data) * np.conj(np.fft.rfft2(reference))
+    spectrum /= np.maximum(np.abs(spectrum), 1e-20)
+    correlation = np.fft.irfft2(spectrum, s=data.shape)
+    return _peak(correlation)
+
+
+def phaseoffset(data, reference, nbin=8, ncrop=1024):
+    """
+    Return the offset of an image with respect to a reference image, by phase
+    correlation.
+
+    A full-frame cross-correlation of 12 Mpixel images is slow, so the offset
+    is found in two steps:
+
+    - The images are binned by ``nbin`` and phase correlated, which finds
+      offsets of up to half of the binned image.
+    - The central ``ncrop`` by ``ncrop`` pixels of the images binned by 2, so
+      by polarization group, are phase correlated, with the crop of the image
+      displaced by the offset from the first step. This refines the offset to
+      a fraction of a pixel.
+
+    The peaks of the correlations are refined by fitting parabolas.
+
+    :param data: The image.
+    :param reference: The reference image, with the same shape.
+    :param nbin: The binning of the first step. This should be even, to
+        average over the polarization pattern. Defaults to 8.
+    :param ncrop: The size of the crop of the second step in pixels binned by
+        2. Defaults to 1024.
+    :return: The offset ``(dy, dx)``, such that ``data[y + dy, x + dx]``
+        corresponds to ``reference[y, x]``.
+    """
+
+    dy, dx = _phasecorrelate(_bin(data, nbin), _bin(reference, nbin))
+    dy = int(round(dy * nbin / 2))
+    dx = int(round(dx * nbin / 2))
+
+    data = _bin(data, 2)
+    reference = _bin(reference, 2)
+    ny, nx = reference.shape
+    nhalf = min(ncrop, ny - 2 * abs(dy), nx - 2 * abs(dx)) // 2
+    if nhalf < 8:
+        raise RuntimeError("offset is too large to refine.")
+    cy = ny // 2
+    cx = nx // 2
+    finedy, finedx = _phasecorrelate(
+        data[cy + dy - nhalf : cy + dy + nhalf, cx + dx - nhalf : cx + dx + nhalf],
+        reference[cy - nhalf : cy + nhalf, cx - nhalf : cx + nhalf],
+    )
+
+    return 2 * (dy + finedy), 2 * (dx + finedx)
+
+
+def staroffset(data, reference, fwhm=8.0, nmax=100, tolerance=None, catalog=None):
+    """
+    Return the offset of an image with respect to a reference image, by
+    matching the positions of detected stars.
+
+    The ``nmax`` brightest stars are detected in each image with
+    :func:`horno.detection.detect`. The offsets between all pairs of stars in
+    the two images are binned, and the most common offset is taken as a first
+    estimate. The stars are then matched at that offset with
+    :func:`horno.detection.match`, and the offset is the median of the offsets
+    of the matched pairs.
+
+    :param data: The image.
+    :param reference: The reference image.
+    :param fwhm: Passed to :func:`horno.detection.detect`. Defaults to 8.
+    :param nmax: The number of stars to use in each image. Defaults to 100.
+    :param tolerance: The size of the bins of offsets and the radius of the
+        matches, or ``None`` to use ``fwhm``. Defaults to ``None``.
+    :param catalog: The catalog of the reference from
+        :func:`horno.detection.detect`, or ``None`` to detect the stars in
+        ``reference``. Defaults to ``None``.
+    :return: The offset ``(dy, dx)``, such that ``data[y + dy, x + dx]``
+        corresponds to ``reference[y, x]``.
+    """
+
+    if tolerance is None:
+        tolerance = fwhm
+    if catalog is None:
+        catalog = horno.detection.detect(reference, fwhm=fwhm, nmax=nmax)
+    stars = horno.detection.detect(data, fwhm=fwhm, nmax=nmax)
+    if len(stars) < 3 or len(catalog) < 3:
+        raise RuntimeError("too few stars to match.")
+
+    # Vote for the offset with all pairs at once.
+    dy = (stars["y"][:, np.newaxis] - catalog["y"][np.newaxis, :]).ravel()
+    dx = (stars["x"][:, np.newaxis] - catalog["x"][np.newaxis, :]).ravel()
+    votes = np.column_stack([np.round(dy / tolerance), np.round(dx / tolerance)])
+    bins, counts = np.unique(votes, axis=0, return_counts=True)
+    dy, dx = bins[np.argmax(counts)] * tolerance
+
+    shifted = stars.copy()
+    shifted["y"] -= dy
+    shifted["x"] -= dx
+    imatch, distance = horno.detection.match(shifted, catalog, radius=tolerance)
+    ismatched = imatch >= 0
+    if np.count_nonzero(ismatched) < 3:
+        raise RuntimeError("too few stars matched.")
+    dy = np.median(stars["y"][ismatched] - catalog["y"][imatch[ismatched]])
+    dx = np.median(stars["x"][ismatched] - catalog["x"][imatch[ismatched]])
+
+    return float(dy), float(dx)
+
+
+def _shiftinteger(data, dy, dx):
+    # Return data shifted so that result[y, x] = data[y + dy, x + dx], with nan
+    # where there are no data.
+    ny, nx = data.shape[-2:]
+    result = np.full(data.shape, np.nan, dtype="float32")
+    if abs(dy) >= ny or abs(dx) >= nx:
+        return result
+    result[..., max(0, -dy) : min(ny, ny - dy), max(0, -dx) : min(nx, nx - dx)] = data[
+        ..., max(0, dy) : min(ny, ny + dy), max(0, dx) : min(nx, nx + dx)
+    ]
+    return result
+
+
+def shift(data, dy, dx, method="even"):
+    """
+    Return an image shifted by an offset.
+
+    The methods are:
+
+    - ``"even"``: the offset is rounded to the nearest even number of pixels in
+      each direction, so that each pixel keeps its polarization channel. This
+      is the default, since the 2 by 2 pattern of polarizers would otherwise be
+      mixed.
+    - ``"integer"``: the offset is rounded to the nearest number of pixels.
+      This mixes the polarization channels for odd offsets, so it is only
+      suitable for images of intensity.
+    - ``"subpixel"``: each polarization channel is shifted by half of the
+      offset in its own pixels, by bilinear interpolation, so the channels
+      are not mixed.
+
+    Pixels with no data after the shift are nan.
+
+    :param data: The image.
+    :param dy: The offset in y.
+    :param dx: The offset in x.
+    :param method: The method. Defaults to ``"even"``.
+    :return: The shifted image, as a new float32 array, such that
+        ``result[y, x]`` corresponds to ``data[y + dy, x + dx]``.
+    """
+
+    if method == "even":
+
+        return _shiftinteger(data, 2 * int(round(dy / 2)), 2 * int(round(dx / 2)))
+
+    elif method == "integer":
+
+        return _shiftinteger(data, int(round(dy)), int(round(dx)))
+
+    elif method == "subpixel":
+
+        result = np.full(data.shape, np.nan, dtype="float32")
+        channels = horno.polarimetry.channelview(data)
+        resultchannels = horno.polarimetry.channelview(result)
+        dy = dy / 2
+        dx = dx / 2
+        iy = math.floor(dy)
+        ix = math.floor(dx)
+        fy = dy - iy
+        fx = dx - ix
+        # Interpolate all four channels at once between the nearest whole-pixel
+        # shifts, skipping those with no weight so that they do not extend the
+        # invalid edges.
+        interpolated = 0
+        for weight, shifty, shiftx in (
+            ((1 - fy) * (1 - fx), iy, ix),
+            ((1 - fy) * fx, iy, ix + 1),
+            (fy * (1 - fx), iy + 1, ix),
+            (fy * fx, iy + 1, ix + 1),
+        ):
+            if weight > 0:
+                interpolated = interpolated + weight * _shiftinteger(
+                    channels, shifty, shiftx
+                )
+        resultchannels[...] = interpolated
+        return result
+
+    else:
+
+        raise RuntimeError("invalid method %r." % method)
+
+
+def _weight(data):
+    # Return the inverse variance of the background of an image, from every
+    # fourth pixel in each direction.
+    sigma = horno.image.clippedsigma(data[::4, ::4], sigma=3.0)
+    if not np.isfinite(sigma) or sigma <= 0:
+        return 0.0
+    return 1 / sigma**2
+
+
+def coadd(
+    fitspaths,
+    productpath=None,
+    exposurepath=None,
+    offsetmethod="phase",
+    shiftmethod="even",
+    docliprejection=True,
+    sigma=3.0,
+    doweight=True,
+    fwhm=8.0,
+    name="coadd",
+):
+    """
+    Register reduced object frames and co-add them by shift and add.
+
+    The offset of each frame with respect to the first is found with
+    :func:`phaseoffset` or :func:`staroffset`, and the frame is shifted onto
+    the first with :func:`shift`. The shifted frames are accumulated one at a
+    time, so only one frame and a few accumulator images are in memory at any
+    time, however many frames there are.
+
+    Each frame is weighted by the inverse variance of its background, if
+    ``doweight`` is true, and otherwise equally. The result is the weighted
+    mean of the frames. If ``docliprejection`` is true, the frames are read a
+    second time, with the offsets from the first pass, and each value is
+    rejected if it lies more than ``sigma`` standard deviations from the
+    weighted mean of the other frames. The mean and standard deviation of the
+    other frames are found by removing the value from the sums of the first
+    pass, so an outlier does not inflate its own bounds, which matters for the
+    small numbers of frames typically co-added. This removes cosmic rays and
+    satellite trails. Pixels with fewer than 3 other frames are not rejected.
+
+    The exposure map is the sum of the exposure times of the frames that
+    contribute to each pixel.
+
+    :param fitspaths: The reduced object frames, as a pattern to be expanded
+        by :func:`glob.glob` or as a list of paths.
+    :param productpath: The path of the product of the co-added image, or
+        ``None`` to not write it. Defaults to ``None``.
+    :param exposurepath: The path of the product of the exposure map, or
+        ``None`` to not write it. Defaults to ``None``.
+    :param offsetmethod: ``"phase"`` for :func:`phaseoffset` or ``"stars"``
+        for :func:`staroffset`. Defaults to ``"phase"``.
+    :param shiftmethod: Passed as ``method`` to :func:`shift`. Defaults to
+        ``"even"``.
+    :param docliprejection: Whether to reject outliers in a second pass.
+        Defaults to ``True``.
+    :param sigma: The rejection limit in standard deviations. Defaults to 3.
+    :param doweight: Whether to weight the frames by the inverse variance of
+        their backgrounds. Defaults to ``True``.
+    :param fwhm: Passed to :func:`staroffset`. Defaults to 8.
+    :param name: The name used in messages. Defaults to ``"coadd"``.
+    :return: The co-added image, the exposure map, and a list of the offsets
+        ``(dy, dx)`` of the frames.
+    """
+
+    horno.log.info("%s: co-adding %s.", name, fitspaths)
+
+    if isinstance(fitspaths, str):
+        fitspathlist = sorted(glob.glob(fitspaths))
+    else:
+        fitspathlist = list(fitspaths)
+    if len(fitspathlist) == 0:
+        raise RuntimeError("no frames found.")
+
+    def frames():
+        for fitspath in fitspathlist:
+            yield fitspath, horno.fits.readproduct(fitspath, name=name)
+
+    offsetlist = []
+    weightlist = []
+    exposuretimelist = []
+
+    for fitspath, (header, data) in frames():
+
+        if len(offsetlist) == 0:
+            referenceheader = header
+            reference = data
+            catalog = None
+            if offsetmethod == "stars":
+                catalog = horno.detection.detect(reference, fwhm=fwhm, nmax=100)
+            shape = data.shape
+            sumw = np.zeros(shape, dtype="float64")
+            sumwx = np.zeros(shape, dtype="float64")
+            sumwxx = np.zeros(shape, dtype="float64")
+            n = np.zeros(shape, dtype="int32")
+            exposure = np.zeros(shape, dtype="float32")
+
+        if data.shape != shape:
+            raise RuntimeError("%s has a different shape." % fitspath)
+
+        if offsetmethod == "phase":
+            dy, dx = phaseoffset(data, reference)
+        elif offsetmethod == "stars":
+            dy, dx = staroffset(data, reference, fwhm=fwhm, catalog=catalog)
+        else:
+            raise RuntimeError("invalid offset method %r." % offsetmethod)
+        horno.log.info("%s: offset is dy = %+.2f dx = %+.2f.", name, dy, dx)
+
+        weight = _weight(data) if doweight else 1.0
+        exposuretime = header.get("EXPTIME", 0.0)
+        offsetlist.append((dy, dx))
+        weightlist.append(weight)
+        exposuretimelist.append(exposuretime)
+
+        data = shift(data, dy, dx, method=shiftmethod)
+        isvalid = np.isfinite(data)
+        data[~isvalid] = 0
+        sumw += weight * isvalid
+        sumwx += weight * data
+        sumwxx += weight * data * data
+        n += isvalid
+        if not docliprejection:
+            exposure += exposuretime * isvalid
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sumwx / sumw
+
+    if docliprejection:
+
+        horno.log.info("%s: rejecting values beyond %.1f sigma.", name, sigma)
+        keptsumw = np.zeros(shape, dtype="float64")
+        keptsumwx = np.zeros(shape, dtype="float64")
+        for (fitspath, (header, data)), (dy, dx), weight, exposuretime in zip(
+            frames(), offsetlist, weightlist, exposuretimelist
+        ):
+            data = shift(data, dy, dx, method=shiftmethod)
+            isvalid = np.isfinite(data)
+            data[~isvalid] = 0
+            with np.errstate(divide="ignore", invalid="ignore"):
+                othersumw = sumw - weight * isvalid
+                othermean = (sumwx - weight * data) / othersumw
+                othervariance = (
+                    sumwxx - weight * data * data
+                ) / othersumw - othermean * othermean
+                isvalid &= (n - isvalid < 3) | (
+                    np.abs(data - othermean)
+                    <= sigma * np.sqrt(np.maximum(othervariance, 0))
+                )
+            data[~isvalid] = 0
+            keptsumw += weight * isvalid
+            keptsumwx += weight * data
+            exposure += exposuretime * isvalid
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = keptsumwx / keptsumw
+
+    data = mean.astype("float32")
+    horno.log.info(
+        "%s: co-added %d frames with a total exposure time of %.0f s.",
+        name,
+        len(offsetlist),
+        sum(exposuretimelist),
+    )
+
+    if productpath is not None:
+        horno.fits.writeproduct(
+            productpath,
+            data,
+            name=name,
+            filter=horno.instrument.filter(referenceheader),
+            exposuretime=float(np.max(exposure)),
+            maskdata=~np.isfinite(data),
+        )
+    if exposurepath is not None:
+        horno.fits.writeproduct(exposurepath, exposure, name=name)
+
+    horno.log.info("%s: finished.", name)
+
+    return data, exposure, offsetlist
@@ -0,0 +1,154 @@
+import numpy as np
+
+import horno.sky
+
+# scipy is imported in the functions that use it, so that importing this
+# module through horno.bake does not import it.
+
+# The data type of the catalogs of detected sources.
+dtype = np.dtype(
+    [
+        ("x", "f8"),
+        ("y", "f8"),
+        ("peak", "f4"),
+        ("flux", "f4"),
+        ("snr", "f4"),
+    ]
+)
+
+
+def detect(data, fwhm=8.0, nsigma=5.0, nmesh=128, nbox=None, nmax=None):
+    """
+    Return a catalog of the sources detected in an image.
+
+    The steps are:
+
+    - The background is estimated on a coarse mesh with
+      :func:`horno.sky.meshbackground` and subtracted.
+    - The image is convolved with a Gaussian of the given FWHM, as two
+      one-dimensional passes, which is the matched filter for a star.
+    - The local maxima of the filtered image that are more than ``nsigma``
+      times its robust standard deviation are found in one vectorized
+      comparison with a maximum filter.
+    - The position and flux of each source are measured from the
+      background-subtracted image in a box of ``nbox`` pixels around the
+      maximum, for all sources at once.
+
+    Invalid pixels are treated as background. Sources whose box extends
+    beyond the image are dropped.
+
+    :param data: The image, normally a mean image.
+    :param fwhm: The FWHM of the stars in pixels. Defaults to 8.
+    :param nsigma: The detection threshold in standard deviations of the
+        filtered image. Defaults to 5.
+    :param nmesh: The size of the background mesh. Defaults to 128.
+    :param nbox: The size of the box used for the centroids, or ``None`` to
+        use the odd number nearest to ``fwhm``. It is rounded up to an odd
+        number of at least 3. Defaults to ``None``.
+    :param nmax: The maximum number of sources to return, or ``None``.
+        Defaults to ``None``.
+    :return: A structured array of type :data:`dtype`, sorted by decreasing
+        flux.
+    """
+
+    import scipy.ndimage
+
+    if nbox is None:
+        nbox = 2 * int(round(fwhm / 2)) + 1
+    nhalf = max(nbox // 2, 1)
+    nbox = 2 * nhalf + 1
+
+    data = np.asarray(data, dtype="float32")
+    data = data - horno.sky.meshbackground(data, nmesh=nmesh)
+    data[~np.isfinite(data)] = 0
+
+    filtered = scipy.ndimage.gaussian_filter(data, fwhm / 2.3548, mode="nearest")
+    sample = filtered[::4, ::4]
+    sigma = 1.4826 * np.median(np.abs(sample - np.median(sample)))
+
+    ismaximum = filtered == scipy.ndimage.maximum_filter(
+        filtered, size=nbox, mode="nearest"
+    )
+    ismaximum &= filtered > nsigma * sigma
+    ismaximum[:nhalf, :] = False
+    ismaximum[-nhalf:, :] = False
+    ismaximum[:, :nhalf] = False
+    ismaximum[:, -nhalf:] = False
+    iy, ix = np.nonzero(ismaximum)
+
+    # Take the boxes around all of the maxima at once, with shape (nsources,
+    # nbox, nbox), and calculate the centroids from the positive pixels.
+    offsets = np.arange(-nhalf, nhalf + 1)
+    boxes = data[
+        iy[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis],
+        ix[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :],
+    ]
+    weights = np.clip(boxes, 0, None)
+    total = weights.sum(axis=(1, 2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dy = np.einsum("syx,y->s", weights, offsets) / total
+        dx = np.einsum("syx,x->s", weights, offsets) / total
+    dy = np.nan_to_num(dy)
+    dx = np.nan_to_num(dx)
+
+    catalog = np.zeros(len(iy), dtype=dtype)
+    catalog["x"] = ix + dx
+    catalog["y"] = iy + dy
+    catalog["peak"] = data[iy, ix]
+    catalog["flux"] = boxes.sum(axis=(1, 2))
+    catalog["snr"] = filtered[iy, ix] / sigma
+
+    catalog = catalog[np.argsort(-catalog["flux"])]
+    if nmax is not None:
+        catalog = catalog[:nmax]
+
+    return catalog
+
+
+def positions(catalog):
+    """
+    Return the positions of the sources in a catalog.
+
+    :param catalog: The catalog.
+    :return: The positions ``(x, y)``, with shape ``(nsources, 2)``.
+    """
+    return np.column_stack([catalog["x"], catalog["y"]])
+
+
+def index(catalog):
+    """
+    Return a spatial index of the sources in a catalog.
+
+    :param catalog: The catalog.
+    :return: A :class:`scipy.spatial.cKDTree` of the positions.
+    """
+    import scipy.spatial
+
+    return scipy.spatial.cKDTree(positions(catalog))
+
+
+def match(catalog, reference, radius=5.0, referenceindex=None):
+    """
+    Match the sources in a catalog to the nearest sources in a reference.
+
+    The nearest neighbors are found with a spatial index of the reference, so
+    the cost is O(n log n) rather than O(n^2).
+
+    :param catalog: The catalog.
+    :param reference: The reference catalog.
+    :param radius: The maximum distance of a match. Defaults to 5.
+    :param referenceindex: A spatial index of the reference from
+        :func:`index`, or ``None`` to build one. Defaults to ``None``.
+    :return: The index in the reference of the match of each source in the
+        catalog, or -1 where there is no match, and the distance of each
+        match.
+    """
+    if len(catalog) == 0 or len(reference) == 0:
+        return np.full(len(catalog), -1, dtype="intp"), np.full(len(catalog), np.inf)
+    if referenceindex is None:
+        referenceindex = index(reference)
+    distance, imatch = referenceindex.query(
+        positions(catalog), k=1, distance_upper_bound=radius
+    )
+    imatch = np.where(np.isfinite(distance), imatch, -1)
+    return imatch, distance
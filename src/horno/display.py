@@ -0,0 +1,130 @@
+import math
+import os
+
+import numpy as np
+
+# Whether images are displayed. When they are not, show returns immediately,
+# and matplotlib, astropy.visualization, and photutils are never imported.
+# Setting HORNO_HEADLESS in the environment disables the display from the
+# start, for example in batch jobs.
+_enabled = "HORNO_HEADLESS" not in os.environ
+
+
+def enable():
+    """
+    Enable the display of images by :func:`show`.
+    """
+    global _enabled
+    _enabled = True
+    return
+
+
+def disable():
+    """
+    Disable the display of images by :func:`show`, so that :func:`show` does
+    nothing. This is the headless mode used by batch jobs and worker
+    processes.
+    """
+    global _enabled
+    _enabled = False
+    return
+
+
+def isenabled():
+    """
+    Return whether images are displayed.
+    """
+    return _enabled
+
+
+def show(
+    data,
+    zrange=False,
+    zscale=False,
+    contrast=0.25,
+    zmin=None,
+    zmax=None,
+    small=False,
+    aperturexy=None,
+    apertureradius=[],
+    aperturecolor="red",
+):
+    """
+    Display an image with matplotlib, if the display is enabled.
+
+    :param data: The image data.
+    :param zrange: Whether to scale from the minimum to the maximum. Defaults to
+        ``False``.
+    :param zscale: Whether to use the zscale algorithm. This is the default if
+        neither ``zrange`` nor ``zmin`` and ``zmax`` are given. Defaults to
+        ``False``.
+    :param contrast: The contrast for the zscale algorithm. Defaults to 0.25.
+    :param zmin: The minimum of the scale, or ``None``. Defaults to ``None``.
+    :param zmax: The maximum of the scale, or ``None``. Defaults to ``None``.
+    :param small: Whether to make a small figure. Defaults to ``False``.
+    :param aperturexy: The positions of apertures to draw, or ``None``.
+        Defaults to ``None``.
+    :param apertureradius: The radius or radii of the apertures. Defaults to
+        ``[]``.
+    :param aperturecolor: The color of the apertures. Defaults to ``"red"``.
+    """
+
+    if not _enabled:
+        return
+
+    import astropy.visualization
+    import matplotlib.pyplot as plt
+
+    if zmin is not None and zmax is not None:
+        interval = astropy.visualization.ManualInterval(zmin, zmax)
+    elif zrange:
+        interval = astropy.visualization.MinMaxInterval()
+    else:
+        interval = astropy.visualization.ZScaleInterval(contrast=contrast)
+    stretch = astropy.visualization.LinearStretch()
+    norm = astropy.visualization.ImageNormalize(
+        data, interval=interval, stretch=stretch
+    )
+
+    ny = data.shape[0]
+    nx = data.shape[1]
+    nmax = max(ny, nx)
+
+    if np.max(data.shape) > 1000:
+        tickinterval = 100
+    else:
+        tickinterval = int(math.pow(2, int(math.log2(nmax / 16))))
+    ticks = list(
+        np.linspace(
+            -tickinterval * (nmax // 2 // tickinterval),
+            +tickinterval * (nmax // 2 // tickinterval),
+            1 + 2 * (nmax // 2 // tickinterval),
+        )
+    )
+
+    if small:
+        plt.figure(figsize=(5, 5))
+    else:
+        plt.figure(figsize=(10, 10))
+    plt.imshow(
+        data,
+        origin="lower",
+        norm=norm,
+    )
+    # plt.xticks(ticks, rotation=90)
+    # plt.yticks(ticks)
+    plt.colorbar(fraction=0.046, pad=0.035)
+
+    if aperturexy is not None:
+        import photutils.aperture
+
+        aperturexy = np.array(aperturexy)
+        if isinstance(apertureradius, (int, float)):
+            apertureradius = [apertureradius]
+        for apertureradius in apertureradius:
+            apertures = photutils.aperture.CircularAperture(
+                aperturexy, r=apertureradius
+            )
+            apertures.plot(color=aperturecolor, lw=1.5, alpha=0.5)
+
+    plt.show()
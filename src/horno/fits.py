@@ -1,8 +1,20 @@
+import collections
+import concurrent.futures
 import numpy as np
 import astropy.io.fits
 import os
 from datetime import datetime
 
+import horno.instrument
+import horno.log
+import horno.profiling
+
+# The maximum number of writes pending on the background thread.
+nmaxpendingwrites = 4
+
+_writer = None
+_pendingwrites = collections.deque()
+
 
 def _ihdu(fitspath):
     """
@@ -18,80 +30,192 @@ def _ihdu(fitspath):
         return 0
 
 
-def readraw(fitspath, name=None):
+def _open(fitspath):
+    # Open a FITS file with the data of uncompressed files memory-mapped and
+    # without scaling, so that a section can be taken without reading or
+    # converting the whole image. The scaling is applied by _decode.
+    return astropy.io.fits.open(fitspath, memmap=True, do_not_scale_image_data=True)
+
+
+def _section(hdu, yslice, xslice):
+    # Return the unscaled data of a section of an HDU. For an uncompressed
+    # image, this is a view of the memory map, so only the pages of the
+    # section are read, when they are decoded. For a compressed image, only
+    # the tiles that overlap the section are decompressed, provided that the
+    # section is less than half of the image; otherwise, decompressing tile
+    # by tile is slower than decompressing the whole image at once.
+    if isinstance(hdu, astropy.io.fits.CompImageHDU):
+        ny, nx = hdu.shape
+        nsection = len(range(*yslice.indices(ny))) * len(range(*xslice.indices(nx)))
+        if nsection < 0.5 * ny * nx:
+            return hdu.section[yslice, xslice]
+    return hdu.data[yslice, xslice]
+
+
+def _decode(rawdata, header, dtype, out=None):
+    """
+    Return scaled data from unscaled data in a single pass.
+
+    :param rawdata: The unscaled data, possibly a view of a memory map.
+    :param header: The header, which gives ``BZERO`` and ``BSCALE``.
+    :param dtype: The type of the result, or ``None`` to keep the type in
+        which astropy would return the scaled data. Unsigned 16-bit data
+        stored with ``BZERO`` of 32768 are returned as uint16.
+    :param out: An array of type ``dtype`` and the shape of the data in which
+        to return the data, or ``None`` to allocate one. If it does not have
+        the right shape and type, a new array is allocated instead. Defaults
+        to ``None``.
+    :return: The data.
+    """
+    bzero = header.get("BZERO", 0)
+    bscale = header.get("BSCALE", 1)
+    if dtype is None:
+        if bscale == 1 and bzero == 32768 and rawdata.dtype.kind == "i":
+            dtype = "uint16"
+        elif bscale == 1 and bzero == 0:
+            dtype = rawdata.dtype.newbyteorder("=")
+        else:
+            dtype = "float32"
+    dtype = np.dtype(dtype)
+    if (
+        out is None
+        or out.shape != rawdata.shape
+        or out.dtype != dtype
+        or not out.flags.writeable
+    ):
+        out = np.empty(rawdata.shape, dtype=dtype)
+    np.copyto(out, rawdata, casting="unsafe")
+    if bscale != 1:
+        out *= dtype.type(bscale)
+    if bzero != 0:
+        # For unsigned 16-bit data, this wraps the signed values around to
+        # the unsigned ones.
+        np.add(out, bzero, out=out, casting="unsafe")
+    return out
+
+
+def _read(fitspath, dodata=True, dtype="float32", dotrim=False, out=None):
+    """
+    Return the header and data of a FITS file from a single open.
+
+    :param fitspath: The path of the FITS file.
+    :param dodata: Whether to read the data. If not, the data are returned as
+        ``None``. Defaults to ``True``.
+    :param dtype: As for :func:`_decode`. Defaults to ``"float32"``.
+    :param dotrim: Whether to read only the trim region given by
+        :func:`horno.instrument.trimyslice` and
+        :func:`horno.instrument.trimxslice`, if the instrument defines one.
+        Defaults to ``False``.
+    :param out: As for :func:`_decode`. Defaults to ``None``.
+    :return: The header and data.
+    """
+    with horno.profiling.stage("read", frame=os.path.basename(fitspath)):
+        hdulist = _open(fitspath)
+        try:
+            hdu = hdulist[_ihdu(fitspath)]
+            header = hdu.header
+            data = None
+            if dodata:
+                yslice = slice(None)
+                xslice = slice(None)
+                if (
+                    dotrim
+                    and horno.instrument.trimyslice(header) is not None
+                    and horno.instrument.trimxslice(header) is not None
+                ):
+                    yslice = horno.instrument.trimyslice(header)
+                    xslice = horno.instrument.trimxslice(header)
+                rawdata = _section(hdu, yslice, xslice)
+                if isinstance(hdu, astropy.io.fits.CompImageHDU):
+                    horno.profiling.addbytes(read=os.path.getsize(fitspath))
+                else:
+                    horno.profiling.addbytes(read=rawdata.nbytes)
+                data = _decode(rawdata, header, dtype, out=out)
+                rawdata = None
+        finally:
+            hdulist.close()
+    return header, data
+
+
+def readraw(fitspath, name=None, dotrim=False, out=None):
+    """
+    Return the header and float32 data of a raw FITS file.
+
+    :param fitspath: The path of the FITS file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :param dotrim: Whether to read only the trim region. Defaults to
+        ``False``.
+    :param out: A float32 array in which to return the data, or ``None``.
+        Defaults to ``None``.
+    :return: The header and data.
+    """
     if name is not None:
-        print(
-            "%s: reading header and data from FITS file %s."
-            % (name, os.path.basename(fitspath))
+        horno.log.debug(
+            "%s: reading header and data from FITS file %s.",
+            name,
+            os.path.basename(fitspath),
         )
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    header = hdu[ihdu].header
-    data = np.array(hdu[ihdu].data, dtype=np.float32)
-    hdu.close()
-    return header, data
+    return _read(fitspath, dotrim=dotrim, out=out)
+
+
+def readrawnative(fitspath, name=None, dotrim=False):
+    """
+    Return the header and data of a raw FITS file, with the data in the type
+    in which astropy returns it, normally uint16, rather than converted to
+    float32.
+    """
+    if name is not None:
+        horno.log.debug(
+            "%s: reading header and data from FITS file %s.",
+            name,
+            os.path.basename(fitspath),
+        )
+    return _read(fitspath, dtype=None, dotrim=dotrim)
 
 
 def readrawheader(fitspath, name=None):
     if name is not None:
-        print(
-            "%s: reading header from raw FITS file %s."
-            % (name, os.path.basename(fitspath))
+        horno.log.debug(
+            "%s: reading header from raw FITS file %s.",
+            name,
+            os.path.basename(fitspath),
         )
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    header = hdu[ihdu].header
-    hdu.close()
+    header, data = _read(fitspath, dodata=False)
     return header
 
 
-def readrawdata(fitspath, name=None):
+def readrawdata(fitspath, name=None, dotrim=False, out=None):
     if name is not None:
-        print("%s: reading data from raw file %s." % (name, os.path.basename(fitspath)))
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    data = np.array(hdu[ihdu].data, dtype=np.float32)
-    hdu.close()
+        horno.log.debug(
+            "%s: reading data from raw file %s.", name, os.path.basename(fitspath)
+        )
+    header, data = _read(fitspath, dotrim=dotrim, out=out)
     return data
 
 
 def readproduct(fitspath, name=None):
     if name is not None:
-        print(
-            "%s: reading header from product file %s."
-            % (name, os.path.basename(fitspath))
+        horno.log.debug(
+            "%s: reading header from product file %s.", name, os.path.basename(fitspath)
         )
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    header = hdu[ihdu].header
-    data = np.array(hdu[ihdu].data, dtype=np.float32)
-    hdu.close()
-    return header, data
+    return _read(fitspath)
 
 
 def readproductheader(fitspath, name=None):
     if name is not None:
-        print(
-            "%s: reading header from product file %s."
-            % (name, os.path.basename(fitspath))
+        horno.log.debug(
+            "%s: reading header from product file %s.", name, os.path.basename(fitspath)
         )
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    header = hdu[ihdu].header
-    hdu.close()
+    header, data = _read(fitspath, dodata=False)
     return header
 
 
 def readproductdata(fitspath, name=None):
     if name is not None:
-        print(
-            "%s: reading data from product file %s."
-            % (name, os.path.basename(fitspath))
+        horno.log.debug(
+            "%s: reading data from product file %s.", name, os.path.basename(fitspath)
         )
-    hdu = astropy.io.fits.open(fitspath)
-    ihdu = _ihdu(fitspath)
-    data = np.array(hdu[ihdu].data, dtype=np.float32)
-    hdu.close()
+    header, data = _read(fitspath)
     return data
 
 
@@ -104,9 +228,58 @@ def writeproduct(
     endtimestamp=None,
     exposuretime=None,
     gain=None,
+    maskdata=None,
+    compression=None,
+    quantizelevel=16,
+    doasync=False,
 ):
+    """
+    Write a product file.
+
+    If the path ends with ``.fz``, the data are tile-compressed in HDU 1, as
+    by fpack, and otherwise they are written uncompressed in HDU 0. Floating
+    point data are compressed by quantizing them to ``1 / quantizelevel`` of
+    the noise in each tile, with subtractive dithering that preserves zeros
+    and with the dither seeded from the data, so that the same data give the
+    same file. Invalid pixels are preserved.
+
+    If ``maskdata`` is given, it is written as a uint8 image, with nonzero
+    values for bad pixels, in an HDU named ``MASK`` after the data, compressed
+    losslessly if the data are compressed. A quality plane from
+    :mod:`horno.quality` is written with its bits.
+
+    If ``doasync`` is true, the data are copied and written on a background
+    thread, so that this returns without waiting for the compression or the
+    disk. At most :data:`nmaxpendingwrites` writes are pending at any time.
+    Call :func:`waitforwrites` to wait for them to finish and to raise any
+    errors. In either case, the file is written to a temporary file which
+    then replaces it, so a partial file never has the final name.
+
+    :param fitspath: The path of the file.
+    :param data: The data.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :param filter: The filter or ``None``. Defaults to ``None``.
+    :param starttimestamp: The start time as a POSIX timestamp or ``None``.
+        Defaults to ``None``.
+    :param endtimestamp: The end time as a POSIX timestamp or ``None``.
+        Defaults to ``None``.
+    :param exposuretime: The exposure time or ``None``. Defaults to ``None``.
+    :param gain: The gain or ``None``. Defaults to ``None``.
+    :param maskdata: A boolean mask of bad pixels, a quality plane, or
+        ``None``. Defaults to ``None``.
+    :param compression: The compression type for ``.fz`` files, one of
+        ``"RICE_1"``, ``"GZIP_1"``, ``"GZIP_2"``, and ``"HCOMPRESS_1"``, or
+        ``None`` for ``"RICE_1"``. Defaults to ``None``.
+    :param quantizelevel: The quantization level for floating point data in
+        ``.fz`` files, or 0 to compress them losslessly, which is only
+        possible with ``"GZIP_1"`` and ``"GZIP_2"``. Defaults to 16.
+    :param doasync: Whether to write on a background thread. Defaults to
+        ``False``.
+    """
     if name is not None:
-        print("%s: writing product file %s." % (name, os.path.basename(fitspath)))
+        horno.log.debug(
+            "%s: writing product file %s.", name, os.path.basename(fitspath)
+        )
     header = astropy.io.fits.Header()
     if filter is not None:
         header.append(("FILTER", filter))
@@ -130,5 +303,131 @@ def writeproduct(
         header.append(("EXPTIME", exposuretime))
     if gain is not None:
         header.append(("GAIN", gain))
-    astropy.io.fits.writeto(fitspath, data, header, overwrite=True)
+    if compression is not None and _ihdu(fitspath) == 0:
+        raise RuntimeError("compressed products must have a .fz suffix.")
+    if compression is None:
+        compression = "RICE_1"
+    if maskdata is not None:
+        maskdata = np.asarray(maskdata, dtype="uint8")
+
+    if not doasync:
+        _writeproduct(fitspath, data, header, maskdata, compression, quantizelevel)
+        return
+
+    global _writer
+    if _writer is None:
+        _writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    while len(_pendingwrites) >= nmaxpendingwrites:
+        _pendingwrites.popleft().result()
+    data = np.array(data, copy=True)
+    if maskdata is not None:
+        maskdata = np.array(maskdata, copy=True)
+    _pendingwrites.append(
+        _writer.submit(
+            _writeproduct,
+            fitspath,
+            data,
+            header,
+            maskdata,
+            compression,
+            quantizelevel,
+        )
+    )
     return
+
+
+def _writeproduct(fitspath, data, header, maskdata, compression, quantizelevel):
+    compressed = astropy.io.fits.hdu.compressed
+    with horno.profiling.stage("writeproduct", frame=os.path.basename(fitspath)):
+        if _ihdu(fitspath) == 1:
+            hdulist = astropy.io.fits.HDUList(
+                [
+                    astropy.io.fits.PrimaryHDU(),
+                    astropy.io.fits.CompImageHDU(
+                        data,
+                        header,
+                        compression_type=compression,
+                        quantize_level=quantizelevel,
+                        quantize_method=compressed.SUBTRACTIVE_DITHER_2,
+                        dither_seed=compressed.DITHER_SEED_CHECKSUM,
+                    ),
+                ]
+            )
+            if maskdata is not None:
+                hdulist.append(
+                    astropy.io.fits.CompImageHDU(
+                        maskdata, name="MASK", compression_type="PLIO_1"
+                    )
+                )
+        else:
+            hdulist = astropy.io.fits.HDUList(
+                [astropy.io.fits.PrimaryHDU(data, header)]
+            )
+            if maskdata is not None:
+                hdulist.append(astropy.io.fits.ImageHDU(maskdata, name="MASK"))
+        tmppath = fitspath + ".tmp"
+        hdulist.writeto(tmppath, overwrite=True)
+        os.replace(tmppath, fitspath)
+        horno.profiling.addbytes(written=os.path.getsize(fitspath))
+    return
+
+
+def waitforwrites():
+    """
+    Wait for the pending writes from :func:`writeproduct` to finish.
+
+    Any error in a write is raised here.
+    """
+    while len(_pendingwrites) > 0:
+        _pendingwrites.popleft().result()
+    return
+
+
+def readproductmask(fitspath, name=None):
+    """
+    Return the mask of a product file, or ``None`` if it has no mask.
+
+    :param fitspath: The path of the product file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: The mask, as a boolean array that is true for bad pixels, or
+        ``None``.
+    """
+    if name is not None:
+        horno.log.debug(
+            "%s: reading mask from product file %s.", name, os.path.basename(fitspath)
+        )
+    hdulist = _open(fitspath)
+    try:
+        if "MASK" not in hdulist:
+            return None
+        return hdulist["MASK"].data != 0
+    finally:
+        hdulist.close()
+
+
+def readproductquality(fitspath, name=None):
+    """
+    Return the mask of a product file as a quality plane, or ``None`` if it
+    has no mask.
+
+    Unlike :func:`readproductmask`, this keeps the bits of a quality plane
+    written by :func:`writeproduct`, so the reason that each pixel is bad can
+    be recovered with :mod:`horno.quality`.
+
+    :param fitspath: The path of the product file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: The quality plane, as a uint8 array, or ``None``.
+    """
+    if name is not None:
+        horno.log.debug(
+            "%s: reading quality from product file %s.",
+            name,
+            os.path.basename(fitspath),
+        )
+    hdulist = _open(fitspath)
+    try:
+        if "MASK" not in hdulist:
+            return None
+        return np.asarray(hdulist["MASK"].data, dtype="uint8")
+    finally:
+        hdulist.close()
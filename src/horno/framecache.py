@@ -0,0 +1,250 @@
+import functools
+import hashlib
+import os
+import shutil
+import weakref
+
+import astropy.io.fits
+import numpy as np
+
+import horno.log
+
+# The version of the layout of the entries and of the keys. Changing it
+# invalidates all existing entries.
+version = 1
+
+# The fingerprints of the masters, by the id of the array, so that each master
+# is hashed once per process however many frames are baked with it. A weak
+# reference to the array detects when an id has been reused.
+_fingerprints = {}
+
+
+def _fingerprint(data):
+    # Return the SHA-256 of the shape, type, and contents of an array, or
+    # "none" if it is None.
+    if data is None:
+        return "none"
+    key = id(data)
+    if key in _fingerprints:
+        reference, fingerprint = _fingerprints[key]
+        if reference() is data:
+            return fingerprint
+    digest = hashlib.sha256()
+    digest.update(repr((data.shape, data.dtype.str)).encode())
+    digest.update(memoryview(np.ascontiguousarray(data)).cast("B"))
+    fingerprint = digest.hexdigest()
+    _fingerprints[key] = (weakref.ref(data), fingerprint)
+    return fingerprint
+
+
+def _identity(value):
+    # Return an identity of an option that is the same in every process.
+    # Functions are identified by their qualified names, and partial functions
+    # also by their arguments. Lambdas and nested functions cannot be
+    # identified by name, since different ones can share a name.
+    if isinstance(value, functools.partial):
+        return (
+            "partial",
+            _identity(value.func),
+            tuple(_identity(arg) for arg in value.args),
+            tuple(sorted((key, _identity(arg)) for key, arg in value.keywords.items())),
+        )
+    if callable(value):
+        module = getattr(value, "__module__", None)
+        qualname = getattr(value, "__qualname__", None)
+        if module is None or qualname is None or "<" in qualname:
+            raise RuntimeError(
+                "cannot cache frames baked with %r: only module-level functions "
+                "and partial functions of them can be identified." % (value,)
+            )
+        return "%s.%s" % (module, qualname)
+    return value
+
+
+def _hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _size(path):
+    # Return the total size of the files of an entry.
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class FrameCache:
+    """
+    An on-disk cache of baked frames.
+
+    Each entry holds the header, the data, and, if there is one, the quality
+    plane returned by :func:`horno.bake.bake` for a raw file. The key of an
+    entry is the SHA-256 of the raw file, identified by its path, size, and
+    modification time or, if ``dohash`` is true, by the hash of its contents;
+    of the fingerprints of the masters used to bake it, which are hashes of
+    their contents, so a remade master gives new keys even if its path is the
+    same; and of the options of :func:`horno.bake.bake` that affect the
+    result.
+
+    Each entry is a directory named by its key, with the data and quality
+    plane as uncompressed ``.npy`` files. A hit maps them copy-on-write
+    rather than reading them, so it costs no decoding or calibration, the
+    pages come from the page cache on a warm rerun, and a caller that
+    modifies the data in place gets private copies of the pages it modifies
+    without changing the entry. An entry is written to a temporary directory
+    which is then renamed, so several processes can share a cache.
+
+    The entries are kept in least-recently-used order, by the modification
+    times of their directories, which are updated on each hit, and the least
+    recently used are evicted when their total size exceeds ``maxbytes``.
+
+    When the cache is pickled, for example to send it to a worker process,
+    only its configuration is pickled.
+
+    :param path: The directory of the cache. Defaults to ``"framecache"``.
+    :param maxbytes: The maximum total size of the entries. Defaults to 16
+        GiB.
+    :param dohash: Whether to identify raw files by the hash of their contents
+        rather than their size and modification time. Defaults to ``False``.
+    :param name: The name used in messages. Defaults to ``"framecache"``.
+    """
+
+    def __init__(
+        self, path="framecache", maxbytes=16 * 1024**3, dohash=False, name="framecache"
+    ):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.dohash = dohash
+        self.name = name
+        os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        return {
+            "path": self.path,
+            "maxbytes": self.maxbytes,
+            "dohash": self.dohash,
+            "name": self.name,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def key(self, fitspath, masters, options):
+        """
+        Return the key of a baked frame.
+
+        :param fitspath: The path of the raw file.
+        :param masters: The masters used to bake it, as a sequence of arrays
+            or ``None``.
+        :param options: A dict of the options of :func:`horno.bake.bake` that
+            affect the result. Functions are identified by their qualified
+            names and partial functions also by their arguments. Other
+            functions, such as lambdas, raise :class:`RuntimeError`, as they
+            cannot be identified.
+        :return: The key, as a hexadecimal string.
+        """
+        if self.dohash:
+            raw = _hash(fitspath)
+        else:
+            stat = os.stat(fitspath)
+            raw = (os.path.abspath(fitspath), stat.st_size, stat.st_mtime_ns)
+        options = sorted((key, _identity(value)) for key, value in options.items())
+        identity = repr(
+            (version, raw, [_fingerprint(master) for master in masters], options)
+        )
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return a cached baked frame.
+
+        :param key: The key, from :meth:`key`.
+        :return: ``(header, data)`` or ``(header, data, quality)``, as returned
+            by :func:`horno.bake.bake`, with the arrays mapped copy-on-write,
+            or ``None`` if there is no entry for the key.
+        """
+        entrypath = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entrypath, "header.txt")) as f:
+                header = astropy.io.fits.Header.fromstring(f.read())
+            data = np.load(os.path.join(entrypath, "data.npy"), mmap_mode="c")
+            qualitypath = os.path.join(entrypath, "quality.npy")
+            if os.path.exists(qualitypath):
+                result = (header, data, np.load(qualitypath, mmap_mode="c"))
+            else:
+                result = (header, data)
+            os.utime(entrypath)
+        except FileNotFoundError:
+            # There is no entry or it has just been evicted.
+            return None
+        return result
+
+    def put(self, key, result):
+        """
+        Add a baked frame to the cache, and evict the least recently used
+        entries if the cache is then too large.
+
+        :param key: The key, from :meth:`key`.
+        :param result: ``(header, data)`` or ``(header, data, quality)``, as
+            returned by :func:`horno.bake.bake`.
+        """
+        entrypath = os.path.join(self.path, key)
+        if os.path.exists(entrypath):
+            return
+        tmppath = "%s.tmp-%d" % (entrypath, os.getpid())
+        shutil.rmtree(tmppath, ignore_errors=True)
+        os.mkdir(tmppath)
+        try:
+            with open(os.path.join(tmppath, "header.txt"), "w") as f:
+                f.write(result[0].tostring())
+            np.save(os.path.join(tmppath, "data.npy"), result[1])
+            if len(result) > 2:
+                np.save(os.path.join(tmppath, "quality.npy"), result[2])
+            os.rename(tmppath, entrypath)
+        except OSError:
+            # Another process has added the same entry first, or the cache
+            # cannot be written, in which case the frame is simply not cached.
+            shutil.rmtree(tmppath, ignore_errors=True)
+            return
+        self._evict(keep=key)
+
+    def _entries(self):
+        # Return the entries, as (mtime, size, key), from the least to the
+        # most recently used.
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_dir() or ".tmp-" in entry.name:
+                continue
+            try:
+                entries.append(
+                    (entry.stat().st_mtime_ns, _size(entry.path), entry.name)
+                )
+            except FileNotFoundError:
+                continue
+        return sorted(entries)
+
+    def _evict(self, keep=None):
+        entries = self._entries()
+        nbytes = sum(size for mtime, size, key in entries)
+        for mtime, size, key in entries:
+            if nbytes <= self.maxbytes:
+                break
+            if key == keep:
+                continue
+            horno.log.info("%s: evicting %s.", self.name, key)
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            nbytes -= size
+
+    def nbytes(self):
+        """
+        Return the total size of the entries.
+        """
+        return sum(size for mtime, size, key in self._entries())
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        for mtime, size, key in self._entries():
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
@@ -1,20 +1,24 @@
-import math
+import concurrent.futures
+import os
 import warnings
 
 import numpy as np
 
-import astropy.stats
-import astropy.visualization
+import horno.display
+import horno.profiling
 
-import photutils.aperture
+# The modules of astropy.stats and scipy.ndimage take most of a second to
+# import, so they are imported in the functions that use them rather than
+# here. This keeps the startup of batch jobs and worker processes short.
 
-import scipy.ndimage
+# The smallest number of frames for which the "auto" method of
+# sigmaclippedstats clips a stack with NumPy rather than astropy. With fewer
+# frames, the fixed costs of each block outweigh the sorting that is saved.
+nframesnumpy = 9
 
-import matplotlib.pyplot as plt
 
-import photutils.aperture
-
-def sigmaclippedstats(data, sigma=3.0, axis=None):
+@horno.profiling.profiled("sigmaclippedstats")
+def sigmaclippedstats(data, sigma=3.0, axis=None, method="auto", nblock=16, mask=None):
     """
     Return sigma-clipped statistics of the given data.
 
@@ -27,12 +31,39 @@ def sigmaclippedstats(data, sigma=3.0, axis=None):
     except that it converts all ndarrays to float32 before returning them.
 
     Furthermore, for the common case of clipping a stack of 2D arrays, it does
-    so row by row, which is much more efficient in terms of memory use.
+    so in blocks of rows, which is much more efficient in terms of memory use.
+    If the stack is already an ndarray, including a memory-mapped stack from
+    :func:`horno.stack.newstack`, the rows are read directly from it without
+    first copying the whole stack.
+
+    If ``method`` is ``"numpy"``, each block of rows is clipped by
+    :func:`_sigmaclippedstatsblock`, which works on the whole block at once
+    with NumPy and gives the same results as astropy to within floating-point
+    rounding. If ``method`` is ``"astropy"``, each row is instead clipped by a
+    separate call to :func:`astropy.stats.sigma_clipped_stats`. The NumPy
+    method sorts the values of each pixel once rather than in each iteration,
+    but has higher fixed costs for each block, so it is only faster from about
+    nine frames. If ``method`` is ``"auto"``, the default, it is used for
+    stacks of at least :data:`nframesnumpy` frames and astropy for smaller
+    stacks.
+
+    If ``mask`` is given, the values for which it is nonzero are ignored
+    instead of invalid values, so the data must be finite apart from the
+    masked values, as they are when they come with a quality plane. This lets
+    the ``"numpy"`` method skip its scan for invalid values. The mask may be a
+    boolean array or a quality plane from :mod:`horno.quality`, and must be
+    broadcastable to the shape of the data, so a single 2D mask can mask the
+    same pixels in every frame of a stack.
 
     :param data: The data of which to calculate the statistics.
     :param sigma: The number of standard deviations for the upper and lower
         clipping limits. Defaults to 3.0
     :param axis: The axis along with to clip the data. Defaults to None.
+    :param method: The method used to clip a stack of 2D arrays, either
+        ``"auto"``, ``"numpy"``, or ``"astropy"``. Defaults to ``"auto"``.
+    :param nblock: The number of rows in each block when clipping a stack of
+        2D arrays with the ``"numpy"`` method. Defaults to 16.
+    :param mask: The mask or ``None``. Defaults to ``None``.
     :return: The mean, median, and standard deviation of the data.
     """
 
@@ -52,18 +83,49 @@ def sigmaclippedstats(data, sigma=3.0, axis=None):
             medianimage = np.full([ny, nx], np.nan, dtype="float32")
             sigmaimage = np.full([ny, nx], np.nan, dtype="float32")
 
-            for iy in range(ny):
-                meanrow, medianrow, sigmarow = astropy.stats.sigma_clipped_stats(
-                    data[:, iy, :],
-                    sigma=sigma,
-                    axis=0,
-                    cenfunc="median",
-                    stdfunc="mad_std",
-                )
+            if method == "auto":
+                method = "numpy" if data.shape[0] >= nframesnumpy else "astropy"
+
+            if method == "numpy":
+
+                for iy in range(0, ny, nblock):
+                    blockslice = slice(iy, min(iy + nblock, ny))
+                    meanblock, medianblock, sigmablock = _sigmaclippedstatsblock(
+                        data[:, blockslice, :],
+                        sigma=sigma,
+                        mask=None if mask is None else mask[..., blockslice, :],
+                    )
+
+                    meanimage[blockslice, :] = meanblock
+                    medianimage[blockslice, :] = medianblock
+                    sigmaimage[blockslice, :] = sigmablock
+
+            elif method == "astropy":
 
-                meanimage[iy, :] = meanrow
-                medianimage[iy, :] = medianrow
-                sigmaimage[iy, :] = sigmarow
+                import astropy.stats
+
+                for iy in range(ny):
+                    meanrow, medianrow, sigmarow = astropy.stats.sigma_clipped_stats(
+                        data[:, iy, :],
+                        mask=(
+                            None
+                            if mask is None
+                            else np.broadcast_to(mask[..., iy, :], data[:, iy, :].shape)
+                            != 0
+                        ),
+                        sigma=sigma,
+                        axis=0,
+                        cenfunc="median",
+                        stdfunc="mad_std",
+                    )
+
+                    meanimage[iy, :] = meanrow
+                    medianimage[iy, :] = medianrow
+                    sigmaimage[iy, :] = sigmarow
+
+            else:
+
+                raise RuntimeError("invalid method %r." % method)
 
             mean = meanimage
             median = medianimage
@@ -71,8 +133,15 @@ def sigmaclippedstats(data, sigma=3.0, axis=None):
 
         else:
 
+            import astropy.stats
+
             mean, median, sigma = astropy.stats.sigma_clipped_stats(
-                data, sigma=sigma, axis=axis, cenfunc="median", stdfunc="mad_std"
+                data,
+                mask=None if mask is None else np.broadcast_to(mask, data.shape) != 0,
+                sigma=sigma,
+                axis=axis,
+                cenfunc="median",
+                stdfunc="mad_std",
             )
 
     if isinstance(mean, np.ndarray):
@@ -85,82 +154,312 @@ def sigmaclippedstats(data, sigma=3.0, axis=None):
     return mean, median, sigma
 
 
-def clippedmean(data, sigma=3.0, axis=None):
+def _sortedmedian(sorteddata, lo, n):
+    """
+    Return the median along the last axis of the elements ``lo`` to ``lo + n -
+    1`` of a 2D array that has been sorted along its last axis. The median is
+    nan where ``n`` is 0.
+    """
+    n = np.maximum(n, 0)
+    ilo = np.minimum(lo + np.maximum(n - 1, 0) // 2, sorteddata.shape[1] - 1)
+    ihi = np.minimum(lo + n // 2, sorteddata.shape[1] - 1)
+    median = 0.5 * (
+        np.take_along_axis(sorteddata, ilo[:, np.newaxis], axis=1)[:, 0]
+        + np.take_along_axis(sorteddata, ihi[:, np.newaxis], axis=1)[:, 0]
+    )
+    median[n == 0] = np.nan
+    return median
+
+
+def _sigmaclippedstatsblock(data, sigma=3.0, maxiters=5, returnbounds=False, mask=None):
+    """
+    Return sigma-clipped statistics along axis 0 of a 3D block of a stack.
+
+    This implements the same iterative clipping as
+    :func:`astropy.stats.sigma_clipped_stats` with ``cenfunc="median"`` and
+    ``stdfunc="mad_std"``, but for all of the pixels in the block at once.
+
+    The block is copied to float64, as astropy does in its C implementation,
+    with the values for each pixel contiguous, and is then sorted once, with
+    invalid values at the end. Since clipping removes values below a lower
+    bound and above an upper bound, the values that survive each iteration
+    are then a contiguous range of the sorted values, so each pixel only needs
+    a pair of indices. Pixels whose bounds have converged drop out of later
+    iterations.
+
+    If a mask is given, the data are assumed to be finite, and the masked
+    values are set to infinity in the copy rather than scanning it for
+    invalid values, so that they sort to the end and are counted from the
+    mask alone.
+
+    :param data: The block, with shape ``(nframes, ny, nx)``.
+    :param sigma: The number of standard deviations for the upper and lower
+        clipping limits. Defaults to 3.0
+    :param maxiters: The maximum number of clipping iterations. Defaults to 5.
+    :param returnbounds: Whether to also return the final lower and upper
+        clipping bounds. Defaults to ``False``.
+    :param mask: An array broadcastable to the shape of the block that is
+        nonzero for the values to ignore, or ``None``. Defaults to ``None``.
+    :return: The mean, median, and standard deviation images of the block
+        and, if ``returnbounds`` is true, the lower and upper bound images, in
+        float64.
+    """
+
+    shape = data.shape[1:]
+
+    sorteddata = np.array(
+        np.reshape(data, (data.shape[0], -1)).T, dtype="float64", order="C"
+    )
+    if mask is None:
+        sorteddata[~np.isfinite(sorteddata)] = np.nan
+    else:
+        mask = np.reshape(np.broadcast_to(mask, data.shape) != 0, (data.shape[0], -1)).T
+        sorteddata[mask] = np.inf
+    sorteddata.sort(axis=1)
+
+    index = np.arange(sorteddata.shape[1])
+    lo = np.zeros(sorteddata.shape[0], dtype="intp")
+    if mask is None:
+        hi = np.count_nonzero(~np.isnan(sorteddata), axis=1)
+    else:
+        hi = sorteddata.shape[1] - np.count_nonzero(mask, axis=1)
+    lowerbound = np.full(sorteddata.shape[0], np.nan)
+    upperbound = np.full(sorteddata.shape[0], np.nan)
+
+    active = np.arange(sorteddata.shape[0])
+    for iteration in range(maxiters):
+
+        activedata = sorteddata[active]
+        activelo = lo[active]
+        activehi = hi[active]
+
+        median = _sortedmedian(activedata, activelo, activehi - activelo)
+
+        deviation = np.abs(activedata - median[:, np.newaxis])
+        deviation[
+            (index < activelo[:, np.newaxis]) | (index >= activehi[:, np.newaxis])
+        ] = np.inf
+        deviation.sort(axis=1)
+        std = 1.482602218505602 * _sortedmedian(
+            deviation, np.zeros_like(activelo), activehi - activelo
+        )
+        del deviation
+
+        lowerbound[active] = median - sigma * std
+        upperbound[active] = median + sigma * std
+
+        newlo = np.count_nonzero(activedata < lowerbound[active, np.newaxis], axis=1)
+        newhi = np.count_nonzero(activedata <= upperbound[active, np.newaxis], axis=1)
+        newlo = np.maximum(activelo, newlo)
+        newhi = np.maximum(np.minimum(activehi, newhi), newlo)
+
+        changed = (newlo != activelo) | (newhi != activehi)
+        lo[active] = newlo
+        hi[active] = newhi
+        active = active[changed]
+        if len(active) == 0:
+            break
+
+    # As in astropy, the final bounds are applied to all of the valid data, so
+    # values clipped in earlier iterations can be restored.
+    lo = np.count_nonzero(sorteddata < lowerbound[:, np.newaxis], axis=1)
+    hi = np.count_nonzero(sorteddata <= upperbound[:, np.newaxis], axis=1)
+    hi = np.maximum(lo, hi)
+
+    n = hi - lo
+    valid = (index >= lo[:, np.newaxis]) & (index < hi[:, np.newaxis])
+
+    median = _sortedmedian(sorteddata, lo, n)
+    mean = np.sum(sorteddata, axis=1, where=valid) / n
+    sigma = np.sqrt(
+        np.sum(np.square(sorteddata - mean[:, np.newaxis]), axis=1, where=valid) / n
+    )
+
+    result = (
+        mean.reshape(shape).astype("float32"),
+        median.reshape(shape).astype("float32"),
+        sigma.reshape(shape).astype("float32"),
+    )
+    if returnbounds:
+        result += (lowerbound.reshape(shape), upperbound.reshape(shape))
+
+    return result
+
+
+def sigmaclippedbounds(data, sigma=3.0, nblock=16, mask=None):
+    """
+    Return the final clipping bounds of a stack of 2D arrays along axis 0.
+
+    A value of the stack is kept by :func:`sigmaclippedstats` with ``axis=0``
+    if and only if it lies between the lower and upper bound of its pixel,
+    inclusive. The bounds are rounded inwards to float32, so that comparing
+    float32 data with them gives exactly the same result as comparing with the
+    float64 bounds used in the clipping. Pixels with no valid values have nan
+    bounds.
+
+    :param data: The stack, with shape ``(nframes, ny, nx)``.
+    :param sigma: The number of standard deviations for the upper and lower
+        clipping limits. Defaults to 3.0
+    :param nblock: The number of rows in each block. Defaults to 16.
+    :param mask: The mask or ``None``, as for :func:`sigmaclippedstats`.
+        Defaults to ``None``.
+    :return: The lower and upper bound images.
+    """
+
+    ny = data.shape[1]
+    nx = data.shape[2]
+    lowerimage = np.full([ny, nx], np.nan, dtype="float32")
+    upperimage = np.full([ny, nx], np.nan, dtype="float32")
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", Warning)
-        mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis)
+        for iy in range(0, ny, nblock):
+            blockslice = slice(iy, min(iy + nblock, ny))
+            mean, median, std, lower, upper = _sigmaclippedstatsblock(
+                data[:, blockslice, :],
+                sigma=sigma,
+                returnbounds=True,
+                mask=None if mask is None else mask[..., blockslice, :],
+            )
+            lowerf = lower.astype("float32")
+            upperf = upper.astype("float32")
+            lowerf = np.where(lowerf < lower, np.nextafter(lowerf, np.inf), lowerf)
+            upperf = np.where(upperf > upper, np.nextafter(upperf, -np.inf), upperf)
+            lowerimage[blockslice, :] = lowerf
+            upperimage[blockslice, :] = upperf
+
+    return lowerimage, upperimage
+
+
+def clippedmean(data, sigma=3.0, axis=None, mask=None):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Warning)
+        mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis, mask=mask)
     return mean
 
 
-def clippedsigma(data, sigma=3.0, axis=None):
+def clippedsigma(data, sigma=3.0, axis=None, mask=None):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", Warning)
-        mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis)
+        mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis, mask=mask)
     return sigma
 
 
-def clippedmeanandsigma(data, sigma=3.0, axis=None):
-    mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis)
+def clippedmeanandsigma(data, sigma=3.0, axis=None, mask=None):
+    mean, median, sigma = sigmaclippedstats(data, sigma=sigma, axis=axis, mask=mask)
     return mean, sigma
 
 
-def medianfilter(data, size):
-    return scipy.ndimage.median_filter(data, size)
+@horno.profiling.profiled("medianfilter")
+def medianfilter(data, size, method="exact", workers=None):
+    """
+    Return the data filtered by a square median filter.
+
+    The methods are:
+
+    - ``"exact"``: :func:`scipy.ndimage.median_filter` on the whole image.
+    - ``"tiled"``: the same, but on bands of rows with halos of ``size // 2``
+      rows, filtered in parallel by ``workers`` threads. The result is
+      identical to ``"exact"``.
+    - ``"separable"``: a median filter along rows followed by one along
+      columns. This approximates the square median, and costs ``2 * size``
+      rather than ``size ** 2`` comparisons per pixel.
+    - ``"downsample"``: the mean of each 2 by 2 block is filtered with a
+      median filter of about half the size, and the result is expanded back to
+      the original size. This approximates the square median for images that
+      vary slowly on the scale of 2 pixels.
+
+    :param data: The data.
+    :param size: The size of the filter.
+    :param method: The method. Defaults to ``"exact"``.
+    :param workers: The number of threads for the ``"tiled"`` method, or
+        ``None`` to use the number of CPUs. Defaults to ``None``.
+    :return: The filtered data.
+    """
+
+    import scipy.ndimage
 
+    if method == "exact":
 
-def uniformfilter(data, size):
-    return scipy.ndimage.filters.uniform_filter(data, size=size, mode="nearest")
+        return scipy.ndimage.median_filter(data, size)
 
+    elif method == "tiled":
 
-def show(
-    data, zrange=False, zscale=False, contrast=0.25, zmin=None, zmax=None, small=False,
-    aperturexy=None, apertureradius=[], aperturecolor="red"
-):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        ny = data.shape[0]
+        nhalo = size // 2
+        ntile = max(1, min(4 * workers, ny // max(4 * size, 1)))
+        result = np.empty_like(data)
 
-    if zmin is not None and zmax is not None:
-        interval = astropy.visualization.ManualInterval(zmin, zmax)
-    elif zrange:
-        interval = astropy.visualization.MinMaxInterval()
-    else:
-        interval = astropy.visualization.ZScaleInterval(contrast=contrast)
-    stretch = astropy.visualization.LinearStretch()
-    norm = astropy.visualization.ImageNormalize(
-        data, interval=interval, stretch=stretch
-    )
+        def filtertile(itile):
+            lo = itile * ny // ntile
+            hi = (itile + 1) * ny // ntile
+            halolo = max(lo - nhalo, 0)
+            halohi = min(hi + nhalo, ny)
+            filtered = scipy.ndimage.median_filter(data[halolo:halohi], size)
+            result[lo:hi] = filtered[lo - halolo : hi - halolo]
 
-    ny = data.shape[0]
-    nx = data.shape[1]
-    nmax = max(ny, nx)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(filtertile, range(ntile)))
 
-    if np.max(data.shape) > 1000:
-        tickinterval = 100
-    else:
-        tickinterval = int(math.pow(2, int(math.log2(nmax / 16))))
-    ticks = list(
-        np.linspace(
-            -tickinterval * (nmax // 2 // tickinterval),
-            +tickinterval * (nmax // 2 // tickinterval),
-            1 + 2 * (nmax // 2 // tickinterval),
+        return result
+
+    elif method == "separable":
+
+        return scipy.ndimage.median_filter(
+            scipy.ndimage.median_filter(data, size=(1, size)), size=(size, 1)
         )
-    )
 
-    if small:
-        plt.figure(figsize=(5, 5))
+    elif method == "downsample":
+
+        ny = data.shape[0] // 2 * 2
+        nx = data.shape[1] // 2 * 2
+        small = data[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2).mean(axis=(1, 3))
+        small = scipy.ndimage.median_filter(small, size // 2 + 1)
+        result = np.empty_like(data)
+        result[:ny, :nx] = np.repeat(np.repeat(small, 2, axis=0), 2, axis=1)
+        # Extend the last row and column for odd shapes.
+        result[ny:, :] = result[ny - 1 : ny, :]
+        result[:, nx:] = result[:, nx - 1 : nx]
+        return result
+
     else:
-        plt.figure(figsize=(10, 10))
-    plt.imshow(
-        data, origin="lower", norm=norm,
+
+        raise RuntimeError("invalid method %r." % method)
+
+
+@horno.profiling.profiled("uniformfilter")
+def uniformfilter(data, size):
+    import scipy.ndimage
+
+    return scipy.ndimage.uniform_filter(data, size=size, mode="nearest")
+
+
+def growmask(mask, nneighbors=2):
+    """
+    Return a boolean mask grown to pixels near masked pixels.
+
+    A pixel is masked in the result if at least ``nneighbors`` of the pixels
+    in the 3 by 3 box centered on it, including itself, are masked. The
+    counts are made in uint8 and the edges are extended.
+
+    :param mask: The mask, with true for masked pixels.
+    :param nneighbors: The number of masked pixels in the box needed to mask a
+        pixel. Defaults to 2.
+    :return: The grown mask.
+    """
+    import scipy.ndimage
+
+    count = scipy.ndimage.correlate(
+        mask.astype("uint8"), np.ones((3, 3), dtype="uint8"), mode="nearest"
     )
-    #plt.xticks(ticks, rotation=90)
-    #plt.yticks(ticks)
-    plt.colorbar(fraction=0.046, pad=0.035)
-
-    if aperturexy is not None:
-        aperturexy = np.array(aperturexy)
-        if isinstance(apertureradius, (int, float)):
-            apertureradius = [apertureradius]
-        for apertureradius in apertureradius:
-            apertures = photutils.aperture.CircularAperture(aperturexy, r=apertureradius)
-            apertures.plot(color=aperturecolor, lw=1.5, alpha=0.5)
-
-    plt.show()
+    return mask | (count >= nneighbors)
+
+
+def show(*args, **kwargs):
+    """
+    Display an image. This is :func:`horno.display.show`, which is kept here
+    for existing scripts and notebooks.
+    """
+    return horno.display.show(*args, **kwargs)
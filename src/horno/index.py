@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+import horno.fits
+import horno.instrument
+import horno.log
+
+# The keywords stored in the index, in the order of the columns.
+keywords = ["exposuretime", "dateobs", "filter", "imagetype"]
+
+
+def headerkeywords(header):
+    """
+    Return a dict of the indexed keywords of a raw FITS header.
+
+    :param header: The raw FITS header.
+    :return: A dict with the keys in :data:`keywords`. The exposure time is
+        ``None`` if the header has none, for example in a product.
+    """
+    try:
+        exposuretime = horno.instrument.exposuretime(header)
+    except KeyError:
+        exposuretime = None
+    return {
+        "exposuretime": exposuretime,
+        "dateobs": horno.instrument.dateobs(header),
+        "filter": horno.instrument.filter(header),
+        "imagetype": horno.instrument.imagetype(header),
+    }
+
+
+def _connect(indexpath):
+    connection = sqlite3.connect(indexpath)
+    connection.execute(
+        "create table if not exists header ("
+        "path text primary key, size integer, mtime real, "
+        "exposuretime real, dateobs text, filter text, imagetype text)"
+    )
+    return connection
+
+
+def updateindex(fitspathlist, indexpath, name=None):
+    """
+    Update a header index and return the indexed keywords of FITS files.
+
+    The index is an SQLite database at ``indexpath`` that records the indexed
+    keywords of raw FITS files together with the size and modification time
+    of each file. A file is only opened and its header read if it is not in
+    the index or if its size or modification time have changed since it was
+    indexed. The index is created if it does not exist.
+
+    :param fitspathlist: The list of FITS paths.
+    :param indexpath: The path of the index.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: A dict mapping each FITS path to a dict of its indexed keywords.
+    """
+
+    connection = _connect(indexpath)
+
+    try:
+        cached = {}
+        for row in connection.execute(
+            "select path, size, mtime, %s from header" % ", ".join(keywords)
+        ):
+            cached[row[0]] = row[1:]
+
+        result = {}
+        nread = 0
+        for fitspath in fitspathlist:
+            path = os.path.abspath(fitspath)
+            stat = os.stat(path)
+            row = cached.get(path)
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                result[fitspath] = dict(zip(keywords, row[2:]))
+                continue
+            values = headerkeywords(horno.fits.readrawheader(fitspath))
+            connection.execute(
+                "insert or replace into header values (?, ?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime)
+                + tuple(values[keyword] for keyword in keywords),
+            )
+            result[fitspath] = values
+            nread += 1
+
+        connection.commit()
+
+    finally:
+        connection.close()
+
+    if name is not None:
+        horno.log.info(
+            "%s: read %d of %d headers to update %s.",
+            name,
+            nread,
+            len(fitspathlist),
+            os.path.basename(indexpath),
+        )
+
+    return result
@@ -6,6 +6,15 @@ import math
 def exposuretime(header):
     return float(header["EXPTIME"])
 
+def dateobs(header):
+    return header.get("DATE-OBS")
+
+def filter(header):
+    return header.get("FILTER")
+
+def imagetype(header):
+    return header.get("IMAGETYP")
+
 def datamax(header):
     return 4095
 
@@ -16,4 +25,12 @@ def trimyslice(header):
     return slice(0,2997)
 
 def flatmax(header):
-    return 3000
\ No newline at end of file
+    return 3000
+
+def hourangle(header):
+    value = header.get("HA")
+    return None if value is None else float(value)
+
+def declination(header):
+    value = header.get("DEC")
+    return None if value is None else float(value)
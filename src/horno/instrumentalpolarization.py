@@ -0,0 +1,271 @@
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+import horno.log
+
+# The latitude of the observatory in degrees, used for the parallactic angle.
+latitude = 31.0444
+
+# The columns of the geometry tables, after the path of the executor log.
+columns = ["h", "delta", "p", "theta"]
+
+
+def readgeometry(paths, name=None):
+    """
+    Return the rows of one or more geometry tables, such as
+    ``geometry.csv``, as arrays.
+
+    Each table has columns ``h`` and ``delta``, the hour angle and declination
+    in degrees, ``p`` and ``theta``, the measured polarization and its angle in
+    degrees, and ``file``, the path of the executor log of the exposure. The
+    night of each row is taken from the first date of the form ``YYYYMMDD`` in
+    its path. Rows with invalid numbers are dropped.
+
+    :param paths: A pattern to be expanded by :func:`glob.glob` or a list of
+        paths.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: A dict with a float64 array for each of :data:`columns` and
+        string arrays for ``file`` and ``night``.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    rows = []
+    for path in paths:
+        if name is not None:
+            horno.log.info("%s: reading %s.", name, path)
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    values = [float(row[column]) for column in columns]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                rows.append((values, row.get("file") or ""))
+    if len(rows) == 0:
+        raise RuntimeError("no valid rows found.")
+    values = np.array([values for values, file in rows], dtype="float64")
+    table = {column: values[:, i] for i, column in enumerate(columns)}
+    table["file"] = np.array([file for values, file in rows], dtype="str")
+    nights = []
+    for file in table["file"]:
+        match = re.search(r"\d{8}", file)
+        nights.append(match.group(0) if match else "")
+    table["night"] = np.array(nights, dtype="str")
+    if name is not None:
+        horno.log.info(
+            "%s: read %d rows from %d nights.",
+            name,
+            len(values),
+            len(set(table["night"])),
+        )
+    return table
+
+
+def parallacticangle(h, delta, latitude=latitude):
+    """
+    Return the parallactic angle.
+
+    :param h: The hour angle in degrees. This may be an array.
+    :param delta: The declination in degrees. This may be an array.
+    :param latitude: The latitude in degrees. Defaults to :data:`latitude`.
+    :return: The parallactic angle in degrees.
+    """
+    h = np.radians(h)
+    delta = np.radians(delta)
+    phi = np.radians(latitude)
+    return np.degrees(
+        np.arctan2(np.sin(h), np.tan(phi) * np.cos(delta) - np.sin(delta) * np.cos(h))
+    )
+
+
+def _design(model, h, delta):
+    # Return the design matrix of the polynomial terms of the model, with a
+    # column for each term and a row for each point. The coordinates are
+    # centered and scaled for conditioning.
+    x = (np.asarray(h, dtype="float64") - model["center"][0]) / model["scale"][0]
+    y = (np.asarray(delta, dtype="float64") - model["center"][1]) / model["scale"][1]
+    return np.stack([x**i * y**j for i, j in model["terms"]], axis=-1)
+
+
+def _bootstrapchunk(products, nbootstrap, seed):
+    # Return the coefficients fitted to nbootstrap resamples of the points.
+    # Each resample is represented by Poisson weights, so the normal equations
+    # of all of the resamples of the chunk are formed by a single product of
+    # the weights with the products of the design matrix and target for each
+    # point, and solved in one batch.
+    nterm = int(round(np.sqrt(products.shape[1] + 1) - 1))
+    rng = np.random.default_rng(seed)
+    weights = rng.poisson(1.0, size=(nbootstrap, len(products))).astype("float64")
+    sums = weights @ products
+    normal = sums[:, : nterm * nterm].reshape(nbootstrap, nterm, nterm)
+    right = sums[:, nterm * nterm :].reshape(nbootstrap, nterm, 2)
+    return np.linalg.solve(normal, right)
+
+
+def fit(
+    table,
+    degree=1,
+    nbootstrap=1000,
+    nchunk=100,
+    workers=None,
+    seed=0,
+    latitude=latitude,
+    name="fit",
+):
+    """
+    Fit a model of the instrumental polarization as a function of hour angle
+    and declination.
+
+    The measured polarization follows the parallactic angle, so the model is
+    fitted in the frame that rotates with it. Each measurement is converted to
+    Stokes ``q`` and ``u``, rotated by minus twice the parallactic angle, and
+    the rotated ``q`` and ``u`` are each fitted with a polynomial of the given
+    total degree in the hour angle and declination. Both are fitted at once
+    over all of the points by linear least squares.
+
+    The uncertainties of the coefficients are estimated by a Poisson
+    bootstrap: ``nbootstrap`` resamples are fitted, in chunks of ``nchunk``
+    that are each solved as a single batch of normal equations, on ``workers``
+    processes if ``workers`` is not ``None``. Each chunk has its own seed,
+    derived from ``seed``, so the result does not depend on the number of
+    workers.
+
+    :param table: The table, as returned by :func:`readgeometry`.
+    :param degree: The total degree of the polynomials. Defaults to 1.
+    :param nbootstrap: The number of bootstrap resamples, or 0 to skip the
+        bootstrap. Defaults to 1000.
+    :param nchunk: The number of resamples in each chunk. Defaults to 100.
+    :param workers: The number of worker processes, or ``None`` to fit the
+        chunks in this process. Defaults to ``None``.
+    :param seed: The seed of the bootstrap. Defaults to 0.
+    :param latitude: The latitude in degrees. Defaults to :data:`latitude`.
+    :param name: The name used in messages. Defaults to ``"fit"``.
+    :return: The model, as a dict that can be written by :func:`writemodel`.
+    """
+
+    h = table["h"]
+    delta = table["delta"]
+    npoints = len(h)
+    horno.log.info("%s: fitting degree %d model to %d points.", name, degree, npoints)
+
+    model = {
+        "degree": degree,
+        "latitude": latitude,
+        "terms": [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)],
+        "center": [float(np.mean(h)), float(np.mean(delta))],
+        "scale": [
+            float(max(np.std(h), 1e-6)),
+            float(max(np.std(delta), 1e-6)),
+        ],
+        "hrange": [float(np.min(h)), float(np.max(h))],
+        "deltarange": [float(np.min(delta)), float(np.max(delta))],
+        "npoints": npoints,
+    }
+    if npoints < len(model["terms"]):
+        raise RuntimeError("too few points for the model.")
+
+    angle = 2 * np.radians(table["theta"] - parallacticangle(h, delta, latitude))
+    target = np.column_stack([table["p"] * np.cos(angle), table["p"] * np.sin(angle)])
+    design = _design(model, h, delta)
+    coefficients, *_ = np.linalg.lstsq(design, target, rcond=None)
+    residual = target - design @ coefficients
+    rms = np.sqrt(np.mean(residual**2, axis=0))
+    model["coefficients"] = coefficients.tolist()
+    model["rms"] = rms.tolist()
+    horno.log.info("%s: rms residual is q = %.5f u = %.5f.", name, rms[0], rms[1])
+
+    if nbootstrap > 0:
+        seeds = np.random.SeedSequence(seed).spawn(-(-nbootstrap // nchunk))
+        sizes = [min(nchunk, nbootstrap - i * nchunk) for i in range(len(seeds))]
+        products = np.concatenate(
+            [
+                (design[:, :, np.newaxis] * design[:, np.newaxis, :]).reshape(
+                    npoints, -1
+                ),
+                (design[:, :, np.newaxis] * target[:, np.newaxis, :]).reshape(
+                    npoints, -1
+                ),
+            ],
+            axis=1,
+        )
+        args = ([products] * len(seeds), sizes, seeds)
+        if workers is None:
+            chunks = list(map(_bootstrapchunk, *args))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                chunks = list(executor.map(_bootstrapchunk, *args))
+        bootstrap = np.concatenate(chunks)
+        model["sigma"] = np.std(bootstrap, axis=0).tolist()
+        horno.log.info("%s: bootstrapped %d resamples.", name, len(bootstrap))
+
+    p, theta = evaluate(model, model["center"][0], model["center"][1])[2:]
+    horno.log.info(
+        "%s: at the center, p = %.5f theta = %.2f.", name, float(p), float(theta)
+    )
+
+    return model
+
+
+def evaluate(model, h, delta):
+    """
+    Return the instrumental polarization of a model.
+
+    This costs a few arithmetic operations, so it can be called for each frame
+    or vectorized over many.
+
+    :param model: The model, from :func:`fit` or :func:`readmodel`.
+    :param h: The hour angle in degrees. This may be an array.
+    :param delta: The declination in degrees. This may be an array.
+    :return: The Stokes ``q`` and ``u``, the polarization ``p``, and its angle
+        ``theta`` in degrees, in the frame of the measurements used for the
+        fit.
+    """
+    rotated = _design(model, h, delta) @ np.asarray(model["coefficients"])
+    angle = 2 * np.radians(parallacticangle(h, delta, model["latitude"]))
+    q = rotated[..., 0] * np.cos(angle) - rotated[..., 1] * np.sin(angle)
+    u = rotated[..., 0] * np.sin(angle) + rotated[..., 1] * np.cos(angle)
+    p = np.hypot(q, u)
+    theta = np.degrees(0.5 * np.arctan2(u, q)) % 180
+    return q, u, p, theta
+
+
+def writemodel(path, model, name=None):
+    """
+    Write a model to a JSON file.
+
+    The model is written to a temporary file which then replaces the file.
+
+    :param path: The path of the file.
+    :param model: The model.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if name is not None:
+        horno.log.info("%s: writing %s.", name, path)
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as f:
+        json.dump(model, f, indent=1)
+    os.replace(tmppath, path)
+    return
+
+
+def readmodel(path, name=None):
+    """
+    Return a model read from a JSON file.
+
+    :param path: The path of the file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: The model.
+    """
+    if name is not None:
+        horno.log.info("%s: reading %s.", name, path)
+    with open(path) as f:
+        model = json.load(f)
+    model["terms"] = [tuple(term) for term in model["terms"]]
+    return model
@@ -0,0 +1,74 @@
+import sys
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+# The current level. Messages below this level are discarded before they are
+# formatted.
+level = INFO
+
+
+def setlevel(newlevel):
+    """
+    Set the level below which messages are discarded.
+
+    :param newlevel: The level, either one of :data:`DEBUG`, :data:`INFO`,
+        :data:`WARNING`, and :data:`ERROR` or its name.
+    """
+    global level
+    if isinstance(newlevel, str):
+        newlevel = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}[
+            newlevel.upper()
+        ]
+    level = newlevel
+    return
+
+
+def isenabled(messagelevel):
+    """
+    Return whether messages at a level are written.
+
+    :param messagelevel: The level.
+    :return: ``True`` or ``False``.
+    """
+    return messagelevel >= level
+
+
+def log(messagelevel, message, *args):
+    """
+    Write a message if its level is enabled.
+
+    The message is only formatted with ``message % args`` if it is written, so
+    messages in loops cost almost nothing when their level is disabled. The
+    message is written to the current :data:`sys.stdout`, so it can be
+    captured with :func:`contextlib.redirect_stdout` like a call to
+    :func:`print`.
+
+    :param messagelevel: The level of the message.
+    :param message: The message or format string.
+    :param args: The arguments for the format string.
+    """
+    if messagelevel < level:
+        return
+    if len(args) > 0:
+        message = message % args
+    sys.stdout.write(message + "\n")
+    return
+
+
+def debug(message, *args):
+    log(DEBUG, message, *args)
+
+
+def info(message, *args):
+    log(INFO, message, *args)
+
+
+def warning(message, *args):
+    log(WARNING, message, *args)
+
+
+def error(message, *args):
+    log(ERROR, message, *args)
@@ -0,0 +1,602 @@
+import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+
+import horno.bake
+import horno.calibration
+import horno.display
+import horno.fits
+import horno.index
+import horno.instrument
+import horno.log
+import horno.path
+import horno.watch
+
+# The path templates of the products, relative to the output directory.
+darkpath = "dark-{exposuretime:.0f}.fits"
+flatpath = "flat.fits"
+objectpath = "{stem}.fits"
+
+# The calibration stores of this process, by configuration, so that a worker
+# process reads each master once for all of its nodes.
+_calibrations = {}
+
+
+def _calibration(darkpath, flatpath):
+    key = (darkpath, flatpath)
+    if key not in _calibrations:
+        _calibrations[key] = horno.calibration.CalibrationStore(
+            darkpath=darkpath, flatpath=flatpath
+        )
+    return _calibrations[key]
+
+
+def imagekind(imagetype):
+    """
+    Return the kind of a frame from its image type.
+
+    :param imagetype: The image type, from :func:`horno.instrument.imagetype`.
+    :return: ``"dark"``, ``"flat"``, or ``"object"``, or ``None`` if frames
+        of this type are not reduced.
+    """
+    if imagetype is None:
+        return None
+    imagetype = imagetype.lower()
+    if "dark" in imagetype:
+        return "dark"
+    if "flat" in imagetype:
+        return "flat"
+    if imagetype in ["object", "science", "light"]:
+        return "object"
+    return None
+
+
+def _objectproduct(fitspath, nightpath, outputpath):
+    return os.path.join(
+        outputpath, objectpath.format(stem=horno.path.stem(fitspath, nightpath))
+    )
+
+
+def _isoutput(fitspath, nightpath, outputpath):
+    # Return whether a file is a master dark or flat in the output directory
+    # or is anywhere in an output directory that is a subdirectory of the
+    # night.
+    path = os.path.realpath(fitspath)
+    night = os.path.realpath(nightpath)
+    output = os.path.realpath(outputpath)
+    if os.path.dirname(path) == output and any(
+        fnmatch.fnmatch(os.path.basename(path), re.sub(r"\{[^}]*\}", "*", template))
+        for template in (darkpath, flatpath)
+    ):
+        return True
+    return (
+        output != night
+        and os.path.commonpath([output, night]) == night
+        and os.path.commonpath([path, output]) == output
+    )
+
+
+def scan(nightpath, outputpath, indexpath=None, name="scan"):
+    """
+    Return the nodes of the reduction of a night.
+
+    The raw FITS files in ``nightpath`` and its subdirectories are grouped by
+    their image type and exposure time, which are read from their headers
+    through the header index at ``indexpath``. The nodes are:
+
+    - a dark node for each exposure time of the darks;
+    - a flat node for all of the flats, which depends on the dark nodes for
+      the exposure times of the flats;
+    - an object node for each object frame, which depends on the dark node
+      for its exposure time and on the flat node, and which is named
+      ``object:{stem}``, where ``{stem}`` is the :func:`horno.path.stem` of
+      the frame relative to ``nightpath``, as is its product.
+
+    Object frames with no dark for their exposure time are not reduced, nor
+    are those whose product would overwrite the frame, a master, or the
+    product of another frame, such as a frame named ``flat.fits``.
+
+    The products are not scanned, so the output directory can be the night
+    directory or one of its subdirectories. Frames with no exposure time are
+    not reduced.
+
+    :param nightpath: The directory of the night.
+    :param outputpath: The directory of the products.
+    :param indexpath: The path of the header index, or ``None`` to use
+        ``index.sqlite`` in ``outputpath``. Defaults to ``None``.
+    :param name: The name used in messages. Defaults to ``"scan"``.
+    :return: A dict mapping the name of each node to a dict with its
+        ``function``, ``args``, ``inputs``, ``product``, and ``dependencies``.
+    """
+
+    if indexpath is None:
+        indexpath = os.path.join(outputpath, "index.sqlite")
+
+    fitspathlist = [
+        fitspath
+        for fitspath in sorted(
+            glob.glob(os.path.join(nightpath, "**", "*.fits"), recursive=True)
+            + glob.glob(os.path.join(nightpath, "**", "*.fits.fz"), recursive=True)
+        )
+        if not _isoutput(fitspath, nightpath, outputpath)
+    ]
+    products = set()
+    for fitspath in fitspathlist:
+        product = os.path.realpath(_objectproduct(fitspath, nightpath, outputpath))
+        if product != os.path.realpath(fitspath):
+            products.add(product)
+    fitspathlist = [
+        fitspath
+        for fitspath in fitspathlist
+        if os.path.realpath(fitspath) not in products
+    ]
+    keywords = horno.index.updateindex(fitspathlist, indexpath, name=name)
+
+    groups = {"dark": {}, "flat": [], "object": []}
+    for fitspath in fitspathlist:
+        kind = imagekind(keywords[fitspath]["imagetype"])
+        if kind is not None and keywords[fitspath]["exposuretime"] is None:
+            horno.log.error(
+                "ERROR: no exposure time for %s.", os.path.basename(fitspath)
+            )
+        elif kind == "dark":
+            exposuretime = keywords[fitspath]["exposuretime"]
+            groups["dark"].setdefault(exposuretime, []).append(fitspath)
+        elif kind is not None:
+            groups[kind].append(fitspath)
+    horno.log.info(
+        "%s: found %d darks, %d flats, and %d objects.",
+        name,
+        sum(len(paths) for paths in groups["dark"].values()),
+        len(groups["flat"]),
+        len(groups["object"]),
+    )
+
+    darktemplate = os.path.join(outputpath, darkpath)
+    flattemplate = os.path.join(outputpath, flatpath)
+
+    nodes = {}
+    for exposuretime, paths in sorted(groups["dark"].items()):
+        nodes["dark-%.0f" % exposuretime] = {
+            "function": _makedarknode,
+            "args": (paths, exposuretime, darktemplate),
+            "inputs": paths,
+            "product": darktemplate.format(exposuretime=exposuretime),
+            "dependencies": [],
+        }
+
+    if len(groups["flat"]) > 0:
+        flatdependencies = sorted(
+            set(
+                "dark-%.0f" % keywords[fitspath]["exposuretime"]
+                for fitspath in groups["flat"]
+            )
+        )
+        missing = [node for node in flatdependencies if node not in nodes]
+        if len(missing) > 0:
+            horno.log.error("ERROR: no darks for the flats: %s.", ", ".join(missing))
+        else:
+            nodes["flat"] = {
+                "function": _makeflatnode,
+                "args": (groups["flat"], flattemplate, darktemplate),
+                "inputs": groups["flat"],
+                "product": flattemplate,
+                "dependencies": flatdependencies,
+            }
+
+    products = set(os.path.realpath(node["product"]) for node in nodes.values())
+    for fitspath in groups["object"]:
+        darknode = "dark-%.0f" % keywords[fitspath]["exposuretime"]
+        if darknode not in nodes or "flat" not in nodes:
+            horno.log.error(
+                "ERROR: no dark or flat for %s.", os.path.basename(fitspath)
+            )
+            continue
+        product = _objectproduct(fitspath, nightpath, outputpath)
+        if os.path.realpath(product) == os.path.realpath(fitspath):
+            horno.log.error(
+                "ERROR: the product of %s would overwrite it.",
+                os.path.basename(fitspath),
+            )
+            continue
+        if os.path.realpath(product) in products:
+            horno.log.error(
+                "ERROR: the product of %s would overwrite that of another node.",
+                os.path.basename(fitspath),
+            )
+            continue
+        products.add(os.path.realpath(product))
+        nodes["object:%s" % horno.path.stem(fitspath, nightpath)] = {
+            "function": _makeobjectnode,
+            "args": (fitspath, product, darktemplate, flattemplate),
+            "inputs": [fitspath],
+            "product": product,
+            "dependencies": [darknode, "flat"],
+        }
+
+    return nodes
+
+
+def _makedarknode(fitspathlist, exposuretime, darktemplate):
+    horno.bake.makedark(fitspathlist, exposuretime, darkpath=darktemplate)
+
+
+def _makeflatnode(fitspathlist, flattemplate, darktemplate):
+    horno.bake.makeflat(
+        fitspathlist,
+        flatpath=flattemplate,
+        calibration=_calibration(darktemplate, flattemplate),
+    )
+
+
+def _makeobjectnode(fitspath, product, darktemplate, flattemplate):
+    header, data = horno.bake.bake(
+        fitspath,
+        name="makeobject",
+        dotrim=True,
+        dodark=True,
+        doflat=True,
+        calibration=_calibration(darktemplate, flattemplate),
+    )
+    horno.fits.writeproduct(
+        product,
+        data,
+        name="makeobject",
+        filter=horno.instrument.filter(header),
+        exposuretime=horno.instrument.exposuretime(header),
+    )
+
+
+def _initrunworker(loglevel):
+    # Worker processes run without a display, so makedark and makeflat do not
+    # plot the masters.
+    horno.log.setlevel(loglevel)
+    horno.display.disable()
+
+
+def _runnode(function, args):
+    # Run a node, capturing its messages so that the parent can print them
+    # together rather than interleaved with those of other nodes.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        function(*args)
+    return log.getvalue()
+
+
+def _hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _filestate(path, previous=None):
+    # Return the size, modification time, and hash of a file. The hash is
+    # only calculated if the size or modification time differ from those in
+    # the previous state.
+    stat = os.stat(path)
+    if (
+        previous is not None
+        and previous["size"] == stat.st_size
+        and previous["mtime"] == stat.st_mtime_ns
+    ):
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": _hash(path)}
+
+
+def _signature(node, nodes, state):
+    # Return the state of the inputs of a node, including the products of
+    # the nodes on which it depends, or None if any is missing.
+    previous = state.get(node, {}).get("inputs", {})
+    paths = list(nodes[node]["inputs"])
+    paths += [
+        nodes[dependency]["product"] for dependency in nodes[node]["dependencies"]
+    ]
+    signature = {}
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        signature[path] = _filestate(path, previous.get(path))
+    return signature
+
+
+def _isuptodate(node, nodes, state, signature):
+    # A node is up to date if its product exists and the sizes and hashes of
+    # its inputs are those recorded when it was last run. The modification
+    # times are only used to avoid calculating the hashes.
+    if node not in state or signature is None:
+        return False
+    if not os.path.exists(nodes[node]["product"]):
+        return False
+    recorded = state[node]["inputs"]
+    if set(recorded) != set(signature):
+        return False
+    return all(
+        recorded[path]["size"] == signature[path]["size"]
+        and recorded[path]["hash"] == signature[path]["hash"]
+        for path in signature
+    )
+
+
+def readstate(statepath):
+    """
+    Return the state of a night reduction, or an empty state if there is none.
+
+    :param statepath: The path of the state file.
+    :return: A dict mapping the name of each completed node to a dict with
+        its product and the state of its inputs.
+    """
+    if not os.path.exists(statepath):
+        return {}
+    with open(statepath) as f:
+        return json.load(f)
+
+
+def writestate(statepath, state):
+    """
+    Write the state of a night reduction.
+
+    The state is written to a temporary file which then replaces the file, so
+    a crash never leaves a partial state.
+
+    :param statepath: The path of the state file.
+    :param state: The state.
+    """
+    tmppath = statepath + ".tmp"
+    with open(tmppath, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmppath, statepath)
+    return
+
+
+def run(nodes, statepath, workers=None, doforce=False, dodryrun=False, name="run"):
+    """
+    Run the nodes of a reduction in dependency order.
+
+    Each node is run in a pool of worker processes as soon as the nodes on
+    which it depends have finished, so independent nodes, such as the darks
+    for different exposure times or the object frames, run concurrently. The
+    messages of each node are printed together when it finishes.
+
+    A node is skipped if it is up to date, that is, if its product exists and
+    the sizes and SHA-256 hashes of its inputs and of the products of the
+    nodes on which it depends are those recorded in the state when it last
+    ran. So a node is not rerun if the products on which it depends were
+    remade with the same content. The hash of a file is only recalculated if
+    its size or modification time have changed, so checking an up-to-date
+    night costs one stat per file. The state is written after each node
+    finishes, so after a crash the reduction resumes from the nodes that had
+    not finished.
+
+    If a node fails, the nodes that depend on it are not run.
+
+    :param nodes: The nodes, as returned by :func:`scan`.
+    :param statepath: The path of the state file.
+    :param workers: The number of worker processes, or ``None`` for the
+        number of CPUs. Defaults to ``None``.
+    :param doforce: Whether to run all nodes, even if they are up to date.
+        Defaults to ``False``.
+    :param dodryrun: Whether to only print the nodes that would run. Defaults
+        to ``False``.
+    :param name: The name used in messages. Defaults to ``"run"``.
+    :return: A dict mapping the name of each node to ``"skipped"``,
+        ``"done"``, ``"failed"``, or ``"blocked"``, or in a dry run
+        ``"wouldrun"``.
+    """
+
+    state = readstate(statepath)
+    status = {}
+    pending = dict(nodes)
+    running = {}
+
+    def isready(node):
+        return all(
+            status.get(dependency) in ("skipped", "done", "wouldrun")
+            for dependency in nodes[node]["dependencies"]
+        )
+
+    def isblocked(node):
+        return any(
+            status.get(dependency) in ("failed", "blocked")
+            for dependency in nodes[node]["dependencies"]
+        )
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_initrunworker,
+        initargs=(horno.log.level,),
+    )
+    try:
+        while len(pending) > 0 or len(running) > 0:
+
+            for node in list(pending):
+                if isblocked(node):
+                    horno.log.info(
+                        "%s: %s: blocked by a failed dependency.", name, node
+                    )
+                    status[node] = "blocked"
+                    del pending[node]
+                elif isready(node):
+                    signature = _signature(node, nodes, state)
+                    # In a dry run, the products of the nodes that would run
+                    # have not changed yet, so assume that they will.
+                    wouldrun = any(
+                        status.get(dependency) == "wouldrun"
+                        for dependency in nodes[node]["dependencies"]
+                    )
+                    if (
+                        not doforce
+                        and not wouldrun
+                        and _isuptodate(node, nodes, state, signature)
+                    ):
+                        horno.log.info("%s: %s: up to date.", name, node)
+                        status[node] = "skipped"
+                    elif dodryrun:
+                        horno.log.info("%s: %s: would run.", name, node)
+                        status[node] = "wouldrun"
+                    else:
+                        horno.log.info("%s: %s: running.", name, node)
+                        future = executor.submit(
+                            _runnode, nodes[node]["function"], nodes[node]["args"]
+                        )
+                        running[future] = node
+                    del pending[node]
+
+            if len(running) == 0:
+                continue
+
+            done, notdone = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                node = running.pop(future)
+                try:
+                    sys.stdout.write(future.result())
+                except Exception as exception:
+                    horno.log.error("ERROR: %s: %s", node, exception)
+                    status[node] = "failed"
+                    state.pop(node, None)
+                    writestate(statepath, state)
+                    continue
+                if not os.path.exists(nodes[node]["product"]):
+                    horno.log.error("ERROR: %s: no product was written.", node)
+                    status[node] = "failed"
+                    continue
+                status[node] = "done"
+                state[node] = {
+                    "product": nodes[node]["product"],
+                    "inputs": _signature(node, nodes, state),
+                }
+                writestate(statepath, state)
+                horno.log.info("%s: %s: done.", name, node)
+
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    counts = {}
+    for value in status.values():
+        counts[value] = counts.get(value, 0) + 1
+    horno.log.info(
+        "%s: %s.",
+        name,
+        ", ".join("%d %s" % (count, value) for value, count in sorted(counts.items())),
+    )
+
+    return status
+
+
+def main(argv=None):
+    """
+    Reduce a night from the command line.
+
+    Run ``python -m horno --help`` for the usage.
+
+    With ``--watch``, once the night has been reduced, the object frames that
+    arrive later are baked as they arrive with the masters of the night, as
+    in :func:`horno.watch.watch`, until the watch is interrupted.
+
+    :param argv: The arguments, or ``None`` for :data:`sys.argv`. Defaults to
+        ``None``.
+    :return: The exit status: 0 if all nodes succeeded and 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        prog="horno",
+        description=(
+            "Reduce the raw frames of a night: make the master darks for each "
+            "exposure time and the master flat, and bake the object frames."
+        ),
+    )
+    parser.add_argument("nightpath", help="the directory of the raw frames")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=".",
+        help="the directory of the products (default: the current directory)",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="the number of worker processes (default: the number of CPUs)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="rerun nodes that are up to date"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only show the nodes that would run"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="then bake new object frames as they arrive",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="poll for new frames even if inotify is available",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=None,
+        help="warn when a new frame takes longer than this many seconds",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="the level of the messages (default: INFO)",
+    )
+    args = parser.parse_args(argv)
+
+    horno.log.setlevel(args.log_level)
+    horno.display.disable()
+    os.makedirs(args.output, exist_ok=True)
+    # The watcher is created before the scan, since it does not report the
+    # files that exist when it is created, so that the frames that arrive
+    # while the night is reduced are baked by the watch.
+    source = None
+    if args.watch and not args.dry_run:
+        source = horno.watch.watcher(args.nightpath, dopoll=args.poll)
+    try:
+        nodes = scan(args.nightpath, args.output)
+        status = run(
+            nodes,
+            os.path.join(args.output, "night.json"),
+            workers=args.workers,
+            doforce=args.force,
+            dodryrun=args.dry_run,
+        )
+    except BaseException:
+        if source is not None:
+            source.close()
+        raise
+    if args.watch and not args.dry_run:
+        horno.watch.watch(
+            args.nightpath,
+            outputpath=args.output,
+            productpath=objectpath,
+            darkpath=os.path.join(args.output, darkpath),
+            flatpath=os.path.join(args.output, flatpath),
+            exposuretimes=[
+                nodes[node]["args"][1] for node in nodes if node.startswith("dark-")
+            ],
+            workers=args.workers if args.workers is not None else os.cpu_count(),
+            dopoll=args.poll,
+            maxlatency=args.max_latency,
+            source=source,
+            products=[node["product"] for node in nodes.values()],
+        )
+    if any(value in ("failed", "blocked") for value in status.values()):
+        return 1
+    return 0
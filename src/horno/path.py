@@ -1,20 +1,36 @@
 import glob
+import os
 import horno.fits
+import horno.index
 import horno.instrument
 
-def getrawfitspaths(fitspaths, exposuretime=None, fitspathsslice=None):
+def getrawfitspaths(
+    fitspaths,
+    exposuretime=None,
+    fitspathsslice=None,
+    imagetype=None,
+    filter=None,
+    indexpath=None,
+):
     """
     Return an expanded and filtered list of FITS paths.
 
-    The ``fitspath`` argument will be expanded by :func:`glob.glob`. This
-    expansion must give a list of names of FITS files or compressed FITS files.
-    If ``exposuretime`` is not ``None``, then files which do not have that
-    exposure time are eliminated from the list. Finally, if ``fitspathsslice``
-    is not ``None``, then this list is sliced.
+    The ``fitspath`` argument will be expanded by :func:`glob.glob`, unless it
+    is already a list. This expansion must give a list of names of FITS files
+    or compressed FITS files.
+    If ``exposuretime``, ``imagetype``, or ``filter`` are not ``None``, then
+    files which do not have that exposure time, image type, or filter are
+    eliminated from the list. Finally, if ``fitspathsslice`` is not ``None``,
+    then this list is sliced.
 
-    :param fitspaths: A pattern to be expanded by :func:`glob.glob`. The
-        expansion must give a list of names of FITS files or compressed FITS
-        files.
+    By default, filtering reads the header of each file. If ``indexpath`` is
+    not ``None``, the keywords are instead taken from the header index at that
+    path, which is updated first by :func:`horno.index.updateindex` and only
+    reads the headers of new or changed files.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob` or a list
+        of paths. The expansion must give a list of names of FITS files or
+        compressed FITS files.
 
     :param exposuretime: An exposure time as a number or ``None``. If it is not
         ``None``, then files which do not have that exposure time are eliminated
@@ -26,15 +42,44 @@ def getrawfitspaths(fitspaths, exposuretime=None, fitspathsslice=None):
         ``"firsthalf"`` or ``"secondhalf"`` refer, as might be expected, to
         slices containing the first half and second half of the file names.
 
+    :param imagetype: An image type as a string or ``None``. If it is not
+        ``None``, then files which do not have that image type are eliminated
+        from the expanded list.
+
+    :param filter: A filter as a string or ``None``. If it is not ``None``,
+        then files which do not have that filter are eliminated from the
+        expanded list.
+
+    :param indexpath: The path of a header index or ``None``. If it is not
+        ``None``, then the index is used to filter the expanded list.
+
     :return: An expanded, filtered, and sliced list of FITS file name.
     """
-    fitspaths = sorted(glob.glob(fitspaths))
-    if exposuretime is not None:
+    if isinstance(fitspaths, str):
+        fitspaths = glob.glob(fitspaths)
+    fitspaths = sorted(fitspaths)
+    criteria = {
+        "exposuretime": exposuretime,
+        "imagetype": imagetype,
+        "filter": filter,
+    }
+    criteria = {key: value for key, value in criteria.items() if value is not None}
+    if len(criteria) > 0:
+        if indexpath is not None:
+            keywords = horno.index.updateindex(fitspaths, indexpath)
+        else:
+            keywords = {
+                fitspath: horno.index.headerkeywords(
+                    horno.fits.readrawheader(fitspath)
+                )
+                for fitspath in fitspaths
+            }
         fitspaths = list(
             fitspath
             for fitspath in fitspaths
-            if horno.instrument.exposuretime(horno.fits.readrawheader(fitspath))
-            == exposuretime
+            if all(
+                keywords[fitspath][key] == value for key, value in criteria.items()
+            )
         )
     if fitspathsslice == "firsthalf":
         fitspathsslice = slice(None, len(fitspaths) // 2)
@@ -43,3 +88,28 @@ def getrawfitspaths(fitspaths, exposuretime=None, fitspathsslice=None):
     if fitspathsslice is not None:
         fitspaths = fitspaths[fitspathsslice]
     return fitspaths
+
+
+def stem(fitspath, directory=None):
+    """
+    Return the name of a raw file without its ``.fits`` or ``.fits.fz``
+    suffix.
+
+    If ``directory`` is given, the name is the path of the file relative to
+    it with the separators replaced by ``-``, so files with the same name in
+    different subdirectories have different stems, and the products named
+    from them can be written in one directory.
+
+    :param fitspath: The path of the raw file.
+    :param directory: The directory to which the name is relative, or
+        ``None`` for the name without its directory. Defaults to ``None``.
+    :return: The stem.
+    """
+    if directory is None:
+        stem = os.path.basename(fitspath)
+    else:
+        stem = os.path.relpath(fitspath, directory).replace(os.sep, "-")
+    for suffix in (".fz", ".fits"):
+        if stem.endswith(suffix):
+            stem = stem[: -len(suffix)]
+    return stem
@@ -0,0 +1,225 @@
+import functools
+import math
+import warnings
+
+import numpy as np
+
+import photutils.geometry
+
+import horno.polarimetry
+
+# The number of steps per pixel to which the subpixel offsets of the aperture
+# centers are rounded. The masks are cached for each rounded offset.
+nsubpixel = 100
+
+# The data type of the results of the photometry.
+dtype = np.dtype(
+    [
+        ("star", "i4"),
+        ("frame", "i4"),
+        ("channel", "U2"),
+        ("x", "f8"),
+        ("y", "f8"),
+        ("flux", "f8"),
+        ("sky", "f8"),
+        ("area", "f8"),
+    ]
+)
+
+# The offsets (x, y) of the aperture centers in each of the 00, 01, 10, and 11
+# channel images with respect to the mean image, in channel pixels. The first
+# digit of the channel is its row parity and the second its column parity.
+# See horno.polarimetry.alignchannels.
+channeloffsets = {
+    "00": (+0.25, +0.25),
+    "01": (-0.25, +0.25),
+    "10": (+0.25, -0.25),
+    "11": (-0.25, -0.25),
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _circularmask(radius, ixoffset, iyoffset, nhalf):
+    # Return the exact fractional overlap of a circle with the pixels of a
+    # square cutout of 2 * nhalf + 1 pixels on a side. The center of the
+    # circle is offset by (ixoffset, iyoffset) / nsubpixel pixels from the
+    # center of the central pixel.
+    xoffset = ixoffset / nsubpixel
+    yoffset = iyoffset / nsubpixel
+    n = 2 * nhalf + 1
+    mask = photutils.geometry.circular_overlap_grid(
+        -nhalf - 0.5 - xoffset,
+        +nhalf + 0.5 - xoffset,
+        -nhalf - 0.5 - yoffset,
+        +nhalf + 0.5 - yoffset,
+        n,
+        n,
+        radius,
+        1,
+        1,
+    )
+    mask.setflags(write=False)
+    return mask
+
+
+def aperturemask(radius, xoffset, yoffset, nhalf):
+    """
+    Return the weights of a circular aperture in a square cutout.
+
+    The weights are the exact fractional overlaps of the circle with each
+    pixel. They are cached for each combination of radius, size, and offset,
+    with the offsets rounded to ``1 / nsubpixel`` of a pixel, so in a typical
+    reduction each mask is only calculated once.
+
+    :param radius: The radius of the aperture.
+    :param xoffset: The offset in x of the center of the aperture from the
+        center of the central pixel of the cutout.
+    :param yoffset: The offset in y of the center of the aperture from the
+        center of the central pixel of the cutout.
+    :param nhalf: The cutout has ``2 * nhalf + 1`` pixels on a side.
+    :return: The weights, as a read-only array.
+    """
+    return _circularmask(
+        float(radius),
+        int(round(xoffset * nsubpixel)),
+        int(round(yoffset * nsubpixel)),
+        int(nhalf),
+    )
+
+
+def annulusmask(innerradius, outerradius, xoffset, yoffset, nhalf):
+    """
+    Return the weights of a circular annulus in a square cutout.
+
+    :param innerradius: The inner radius of the annulus.
+    :param outerradius: The outer radius of the annulus.
+    :param xoffset: As for :func:`aperturemask`.
+    :param yoffset: As for :func:`aperturemask`.
+    :param nhalf: As for :func:`aperturemask`.
+    :return: The weights.
+    """
+    return aperturemask(outerradius, xoffset, yoffset, nhalf) - aperturemask(
+        innerradius, xoffset, yoffset, nhalf
+    )
+
+
+def photometry(
+    stack, positions, radius=40, skyradii=(80, 120), xoffset=0.0, yoffset=0.0
+):
+    """
+    Return aperture photometry of stars in a stack of frames.
+
+    For each star, the cutouts for all of the frames are taken at once as a
+    view of the stack, and the sky and flux are calculated for all of the
+    frames at once. The sky is the median of the valid pixels that are at
+    least half inside the annulus. The flux is the sum of the sky-subtracted
+    pixels weighted by the aperture mask, and is nan if any pixel in the
+    aperture is invalid or if the annulus extends beyond the frame.
+
+    :param stack: The frames, with shape ``(nframes, ny, nx)``, or a single
+        frame with shape ``(ny, nx)``.
+    :param positions: The positions ``(x, y)`` of the stars, with shape
+        ``(nstars, 2)``.
+    :param radius: The radius of the aperture. Defaults to 40.
+    :param skyradii: The inner and outer radii of the sky annulus. Defaults to
+        ``(80, 120)``.
+    :param xoffset: An offset to add to the x positions. Defaults to 0.
+    :param yoffset: An offset to add to the y positions. Defaults to 0.
+    :return: A structured array of type :data:`dtype` with one element for
+        each star and frame.
+    """
+
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    nframes, ny, nx = stack.shape
+    positions = np.atleast_2d(np.asarray(positions, dtype="float64"))
+    nstars = len(positions)
+
+    innerradius, outerradius = skyradii
+    nhalf = int(math.ceil(max(radius, outerradius))) + 1
+
+    result = np.zeros(nstars * nframes, dtype=dtype)
+    result["star"] = np.repeat(np.arange(nstars), nframes)
+    result["frame"] = np.tile(np.arange(nframes), nstars)
+    result = result.reshape(nstars, nframes)
+
+    for istar, (x, y) in enumerate(positions):
+
+        x += xoffset
+        y += yoffset
+        ix = int(round(x))
+        iy = int(round(y))
+
+        result[istar]["x"] = x
+        result[istar]["y"] = y
+
+        aperture = aperturemask(radius, x - ix, y - iy, nhalf)
+        annulus = annulusmask(innerradius, outerradius, x - ix, y - iy, nhalf)
+        result[istar]["area"] = aperture.sum()
+
+        if iy - nhalf < 0 or iy + nhalf >= ny or ix - nhalf < 0 or ix + nhalf >= nx:
+            result[istar]["flux"] = np.nan
+            result[istar]["sky"] = np.nan
+            continue
+
+        cutouts = stack[:, iy - nhalf : iy + nhalf + 1, ix - nhalf : ix + nhalf + 1]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            sky = np.nanmedian(cutouts[:, annulus >= 0.5], axis=1)
+
+        inaperture = aperture > 0
+        weights = aperture[inaperture]
+        flux = np.dot(cutouts[:, inaperture].astype("float64"), weights)
+        flux -= sky * weights.sum()
+
+        result[istar]["flux"] = flux
+        result[istar]["sky"] = sky
+
+    return result.reshape(-1)
+
+
+def channelphotometry(stack, positions, radius=40, skyradii=(80, 120)):
+    """
+    Return aperture photometry of stars in each polarization channel.
+
+    The positions are in the coordinates of the mean image, that is, of the
+    channel images from :func:`horno.polarimetry.channelview`, without
+    alignment. The aperture centers in each channel are offset by
+    :data:`channeloffsets` to account for the displacement of that channel
+    from the mean image.
+
+    :param stack: The baked frames, with shape ``(nframes, ny, nx)``, or a
+        single frame with shape ``(ny, nx)``.
+    :param positions: The positions ``(x, y)`` of the stars in the mean image,
+        with shape ``(nstars, 2)``.
+    :param radius: The radius of the aperture in channel pixels. Defaults to
+        40.
+    :param skyradii: The inner and outer radii of the sky annulus in channel
+        pixels. Defaults to ``(80, 120)``.
+    :return: A structured array of type :data:`dtype` with one element for
+        each star, frame, and channel.
+    """
+
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    channels = horno.polarimetry.channelview(stack)
+
+    resultlist = []
+    for channel, (xoffset, yoffset) in channeloffsets.items():
+        i = int(channel[0])
+        j = int(channel[1])
+        result = photometry(
+            channels[:, i, j],
+            positions,
+            radius=radius,
+            skyradii=skyradii,
+            xoffset=xoffset,
+            yoffset=yoffset,
+        )
+        result["channel"] = channel
+        resultlist.append(result)
+
+    return np.concatenate(resultlist)
@@ -0,0 +1,214 @@
+import numpy as np
+
+import horno.bake
+import horno.fits
+import horno.instrument
+import horno.instrumentalpolarization
+import horno.log
+import horno.path
+
+
+def channelview(data):
+    """
+    Return a view of the four polarization channels of data.
+
+    The detector has a 2 by 2 pattern of polarizers, so the pixels of each
+    channel are every second pixel in each direction. The result has shape
+    ``(..., 2, 2, ny // 2, nx // 2)``, and element ``[..., i, j, :, :]`` is the
+    ``ij`` channel, that is, ``data[..., i::2, j::2]``. Any odd last row or
+    column is dropped. The result is a view, so no data is copied.
+
+    A view with the channels along a single axis of length 4 is not possible,
+    since the offsets of the four channels in memory are not evenly spaced.
+    Use ``channelview(data).reshape(data.shape[:-2] + (4, ny // 2, nx // 2))``
+    to obtain a copy in that form, with the channels in the order 00, 01, 10,
+    and 11.
+
+    :param data: The data, with shape ``(..., ny, nx)``. This may be a single
+        frame or a stack of frames.
+    :return: The view.
+    """
+    ny = data.shape[-2] // 2 * 2
+    nx = data.shape[-1] // 2 * 2
+    data = data[..., :ny, :nx]
+    shape = data.shape[:-2] + (ny // 2, 2, nx // 2, 2)
+    data = data.reshape(shape)
+    return np.moveaxis(data, (-3, -1), (-4, -3))
+
+
+def alignchannels(channels):
+    """
+    Return the channels interpolated onto the grid of the mean image.
+
+    The mean of the four channels is centered on the middle of each 2 by 2
+    group of pixels, so each channel is displaced by half a pixel of the
+    original frame in each direction from the mean image. Equivalently, each
+    channel is displaced by a quarter of one of its own pixels. This function
+    removes the displacements by linear interpolation, with the edges
+    extended, for all of the channels and frames at once.
+
+    :param channels: The channels, as returned by :func:`channelview`.
+    :return: The aligned channels, as a new float32 array of the same shape.
+    """
+    channels = np.asarray(channels, dtype="float32")
+
+    # Along each axis, the channels with index 0 are sampled a quarter pixel
+    # before the mean image, and so are interpolated a quarter pixel forward
+    # towards their next pixel, and vice versa for the channels with index 1.
+
+    neighbor = np.empty_like(channels)
+    neighbor[..., 0, :, :-1, :] = channels[..., 0, :, 1:, :]
+    neighbor[..., 0, :, -1:, :] = channels[..., 0, :, -1:, :]
+    neighbor[..., 1, :, 1:, :] = channels[..., 1, :, :-1, :]
+    neighbor[..., 1, :, :1, :] = channels[..., 1, :, :1, :]
+    channels = 0.75 * channels + 0.25 * neighbor
+
+    neighbor[..., 0, :, :-1] = channels[..., 0, :, 1:]
+    neighbor[..., 0, :, -1:] = channels[..., 0, :, -1:]
+    neighbor[..., 1, :, 1:] = channels[..., 1, :, :-1]
+    neighbor[..., 1, :, :1] = channels[..., 1, :, :1]
+    channels = 0.75 * channels + 0.25 * neighbor
+
+    return channels
+
+
+def stokes(data, doalign=True):
+    """
+    Return the four polarization channels and the Stokes I, q, and u images.
+
+    As in :func:`horno.bake.makeflat`, I is the mean of the four channels, q is
+    the difference of the 00 and 11 channels divided by I, and u is the
+    difference of the 01 and 10 channels divided by I. All of the frames and
+    channels are handled at once.
+
+    :param data: The baked data, with shape ``(..., ny, nx)``. This may be a
+        single frame or a stack of frames.
+    :param doalign: Whether to align the channels with :func:`alignchannels`
+        before forming I, q, and u. Defaults to ``True``.
+    :return: The channels, with shape ``(..., 2, 2, ny // 2, nx // 2)``, and
+        the I, q, and u images, each with shape ``(..., ny // 2, nx // 2)``.
+    """
+    channels = channelview(data)
+    if doalign:
+        channels = alignchannels(channels)
+    intensity = np.mean(channels, axis=(-4, -3), dtype="float32")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = (channels[..., 0, 0, :, :] - channels[..., 1, 1, :, :]) / intensity
+        u = (channels[..., 0, 1, :, :] - channels[..., 1, 0, :, :]) / intensity
+    return channels, intensity, q, u
+
+
+def correctinstrumental(q, u, header, model):
+    """
+    Return q and u corrected for the instrumental polarization.
+
+    The instrumental polarization is evaluated from a model from
+    :func:`horno.instrumentalpolarization.fit` at the hour angle and
+    declination of the frame, and subtracted.
+
+    :param q: The q image.
+    :param u: The u image.
+    :param header: The raw FITS header of the frame.
+    :param model: The model.
+    :return: The corrected q and u images.
+    """
+    h = horno.instrument.hourangle(header)
+    delta = horno.instrument.declination(header)
+    if h is None or delta is None:
+        raise RuntimeError("no hour angle or declination in header.")
+    instrumentalq, instrumentalu, p, theta = horno.instrumentalpolarization.evaluate(
+        model, h, delta
+    )
+    return q - np.float32(instrumentalq), u - np.float32(instrumentalu)
+
+
+def writestokes(
+    productpath,
+    header,
+    intensity,
+    q,
+    u,
+    name="writestokes",
+    exposuretime=None,
+    doasync=False,
+):
+    """
+    Write Stokes I, q, and u images as products.
+
+    :param productpath: The path template of the products. It is formatted
+        with ``product`` set to ``"i"``, ``"q"``, and ``"u"``.
+    :param header: The raw FITS header of the frame, or ``None``.
+    :param intensity: The I image.
+    :param q: The q image.
+    :param u: The u image.
+    :param name: The name used in messages. Defaults to ``"writestokes"``.
+    :param exposuretime: The exposure time, or ``None`` to take it from the
+        header. Defaults to ``None``.
+    :param doasync: Passed to :func:`horno.fits.writeproduct`. Defaults to
+        ``False``.
+    """
+    if exposuretime is None and header is not None:
+        exposuretime = horno.instrument.exposuretime(header)
+    for product, data in (("i", intensity), ("q", q), ("u", u)):
+        path = productpath.format(product=product)
+        horno.log.info("%s: writing %s.", name, path)
+        horno.fits.writeproduct(path, data, exposuretime=exposuretime, doasync=doasync)
+    return
+
+
+def makestokes(
+    fitspaths,
+    productpath="{stem}-{product}.fits",
+    fitspathsslice=None,
+    doalign=True,
+    model=None,
+    **kwargs
+):
+    """
+    Bake object files and write Stokes I, q, and u products for each.
+
+    The frames are baked one at a time by :func:`horno.bake.iterobjects`, so
+    only one frame is in memory at any time, apart from the products that are
+    being written on a background thread while the next frame is baked.
+
+    :param fitspaths: A pattern to be expanded by :func:`glob.glob`.
+    :param productpath: The path template of the products. It is formatted
+        with ``stem`` set to the :func:`horno.path.stem` of the raw file and
+        ``product`` set to ``"i"``, ``"q"``, and ``"u"``. Defaults to ``"{stem}-{product}.fits"``.
+    :param fitspathsslice: Passed to :func:`horno.bake.iterobjects`. Defaults
+        to ``None``.
+    :param doalign: Passed to :func:`stokes`. Defaults to ``True``.
+    :param model: A model of the instrumental polarization from
+        :func:`horno.instrumentalpolarization.readmodel` with which to correct
+        q and u with :func:`correctinstrumental`, or ``None``. Defaults to
+        ``None``.
+    :param kwargs: Other keyword arguments passed to
+        :func:`horno.bake.iterobjects`.
+    """
+
+    horno.log.info("makestokes: making Stokes products for %s.", fitspaths)
+
+    for fitspath, header, data in horno.bake.iterobjects(
+        fitspaths, fitspathsslice=fitspathsslice, **kwargs
+    ):
+        channels, intensity, q, u = stokes(data, doalign=doalign)
+        if model is not None:
+            q, u = correctinstrumental(q, u, header, model)
+        horno.log.info(
+            "makestokes: median q = %+.4f u = %+.4f.", np.nanmedian(q), np.nanmedian(u)
+        )
+        writestokes(
+            productpath.replace("{stem}", horno.path.stem(fitspath)),
+            header,
+            intensity,
+            q,
+            u,
+            name="makestokes",
+            doasync=True,
+        )
+
+    horno.fits.waitforwrites()
+
+    horno.log.info("makestokes: finished.")
+
+    return
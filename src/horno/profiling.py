@@ -0,0 +1,346 @@
+import contextlib
+import csv
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+import horno.log
+
+# Whether profiling is enabled. When it is not, stage returns a shared no-op
+# context manager and the functions decorated with profiled call the function
+# directly, so the only overhead is a function call and a test.
+_enabled = False
+_domemory = False
+
+# The completed stages, as a list of dicts.
+_records = []
+
+# The active stages of each thread, innermost last.
+_local = threading.local()
+
+_nullstage = contextlib.nullcontext()
+
+fields = [
+    "stage",
+    "name",
+    "frame",
+    "seconds",
+    "selfseconds",
+    "bytesread",
+    "byteswritten",
+    "peakbytes",
+]
+
+
+def enable(domemory=False):
+    """
+    Enable profiling and discard any previous records.
+
+    :param domemory: Whether to record the peak memory allocated for arrays in
+        each stage, with :mod:`tracemalloc`. This slows allocations, so it is
+        off by default. The peak is for the whole process, so it is only
+        approximate for stages that run concurrently on different threads.
+        Defaults to ``False``.
+    """
+    global _enabled
+    global _domemory
+    reset()
+    _enabled = True
+    _domemory = domemory
+    if domemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return
+
+
+def disable():
+    """
+    Disable profiling. The records are kept.
+    """
+    global _enabled
+    global _domemory
+    if _domemory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _domemory = False
+    return
+
+
+def isenabled():
+    """
+    Return whether profiling is enabled.
+    """
+    return _enabled
+
+
+def ismemoryenabled():
+    """
+    Return whether profiling records memory.
+    """
+    return _domemory
+
+
+def reset():
+    """
+    Discard the records.
+    """
+    global _records
+    _records = []
+    return
+
+
+def records():
+    """
+    Return the records of the completed stages.
+
+    Each record is a dict with the keys in :data:`fields`. The ``stage`` is
+    the path of the stage, with the names of the enclosing stages separated by
+    ``;``, and ``frame`` is the frame given to the nearest enclosing stage, or
+    ``""``. The ``selfseconds`` exclude the time in nested stages.
+
+    :return: The list of records.
+    """
+    return _records
+
+
+def addrecords(newrecords):
+    """
+    Add records from elsewhere, for example from a worker process.
+
+    :param newrecords: The records.
+    """
+    _records.extend(newrecords)
+    return
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = []
+        _local.stack = stack
+    return stack
+
+
+@contextlib.contextmanager
+def _stage(name, frame):
+    stack = _stack()
+    parent = stack[-1] if len(stack) > 0 else None
+    if frame is None:
+        frame = "" if parent is None else parent["frame"]
+    entry = {
+        "stage": name if parent is None else parent["stage"] + ";" + name,
+        "name": name,
+        "frame": frame,
+        "bytesread": 0,
+        "byteswritten": 0,
+        "childseconds": 0.0,
+    }
+    if _domemory:
+        current, peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent["peak"] = max(parent["peak"], peak)
+        tracemalloc.reset_peak()
+        entry["current"] = current
+        entry["peak"] = current
+    stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        peakbytes = 0
+        if _domemory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(entry["peak"], peak)
+            peakbytes = peak - entry["current"]
+            if parent is not None:
+                parent["peak"] = max(parent["peak"], peak)
+            tracemalloc.reset_peak()
+        if parent is not None:
+            parent["childseconds"] += seconds
+            parent["bytesread"] += entry["bytesread"]
+            parent["byteswritten"] += entry["byteswritten"]
+        _records.append(
+            {
+                "stage": entry["stage"],
+                "name": name,
+                "frame": entry["frame"],
+                "seconds": seconds,
+                "selfseconds": seconds - entry["childseconds"],
+                "bytesread": entry["bytesread"],
+                "byteswritten": entry["byteswritten"],
+                "peakbytes": peakbytes,
+            }
+        )
+
+
+def stage(name, frame=None):
+    """
+    Return a context manager that records a stage.
+
+    Stages may be nested. If profiling is not enabled, this returns a shared
+    context manager that does nothing.
+
+    :param name: The name of the stage.
+    :param frame: The frame being processed, normally the name of the file, or
+        ``None`` to take it from the enclosing stage. Defaults to ``None``.
+    :return: The context manager.
+    """
+    if not _enabled:
+        return _nullstage
+    return _stage(name, frame)
+
+
+def profiled(name):
+    """
+    Return a decorator that records each call of a function as a stage.
+
+    :param name: The name of the stage.
+    :return: The decorator.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _stage(name, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def addbytes(read=0, written=0):
+    """
+    Add to the bytes read and written by the innermost active stage. The
+    bytes are also counted in the enclosing stages.
+
+    :param read: The number of bytes read. Defaults to 0.
+    :param written: The number of bytes written. Defaults to 0.
+    """
+    if not _enabled:
+        return
+    stack = _stack()
+    if len(stack) > 0:
+        stack[-1]["bytesread"] += read
+        stack[-1]["byteswritten"] += written
+    return
+
+
+def _totals():
+    totals = {}
+    for record in _records:
+        total = totals.setdefault(
+            record["stage"],
+            {
+                "calls": 0,
+                "seconds": 0.0,
+                "selfseconds": 0.0,
+                "bytesread": 0,
+                "byteswritten": 0,
+                "peakbytes": 0,
+            },
+        )
+        total["calls"] += 1
+        total["seconds"] += record["seconds"]
+        total["selfseconds"] += record["selfseconds"]
+        total["bytesread"] += record["bytesread"]
+        total["byteswritten"] += record["byteswritten"]
+        total["peakbytes"] = max(total["peakbytes"], record["peakbytes"])
+    return totals
+
+
+def summary(name="profiling"):
+    """
+    Log and return the totals for each stage.
+
+    :param name: The name used in messages. Defaults to ``"profiling"``.
+    :return: A dict from the path of each stage to a dict with the number of
+        calls and the totals of the fields of the records, except that
+        ``peakbytes`` is the maximum.
+    """
+    totals = _totals()
+    for stagepath in sorted(totals):
+        total = totals[stagepath]
+        horno.log.info(
+            "%s: %s: %d calls in %.3f s (%.3f s self).",
+            name,
+            stagepath,
+            total["calls"],
+            total["seconds"],
+            total["selfseconds"],
+        )
+        if total["bytesread"] > 0 or total["byteswritten"] > 0:
+            horno.log.info(
+                "%s: %s: %.1f MB read and %.1f MB written.",
+                name,
+                stagepath,
+                total["bytesread"] / 1e6,
+                total["byteswritten"] / 1e6,
+            )
+        if total["peakbytes"] > 0:
+            horno.log.info(
+                "%s: %s: peak memory %.1f MB.",
+                name,
+                stagepath,
+                total["peakbytes"] / 1e6,
+            )
+    return totals
+
+
+def writejson(path, name=None):
+    """
+    Write the records and the totals for each stage to a JSON file.
+
+    :param path: The path of the file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if name is not None:
+        horno.log.info("%s: writing %s.", name, path)
+    with open(path, "w") as f:
+        json.dump({"records": _records, "totals": _totals()}, f, indent=1)
+    return
+
+
+def writecsv(path, name=None):
+    """
+    Write the records to a CSV file, one row per stage and frame.
+
+    :param path: The path of the file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if name is not None:
+        horno.log.info("%s: writing %s.", name, path)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(_records)
+    return
+
+
+def writeflame(path, name=None):
+    """
+    Write the self time of each stage in the folded format read by
+    ``flamegraph.pl`` and speedscope.
+
+    Each line is the path of a stage followed by its total self time in
+    microseconds.
+
+    :param path: The path of the file.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if name is not None:
+        horno.log.info("%s: writing %s.", name, path)
+    selfseconds = {}
+    for record in _records:
+        selfseconds[record["stage"]] = (
+            selfseconds.get(record["stage"], 0.0) + record["selfseconds"]
+        )
+    with open(path, "w") as f:
+        for stagepath in sorted(selfseconds):
+            f.write("%s %d\n" % (stagepath, round(selfseconds[stagepath] * 1e6)))
+    return
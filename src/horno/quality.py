@@ -0,0 +1,177 @@
+import numpy as np
+
+import horno.log
+
+# The bits of a quality plane. A quality plane is a uint8 array with the shape
+# of the data that it describes, in which a pixel is good if its value is 0
+# and otherwise has a bit set for each reason that it is bad. The data under
+# bad pixels are left finite, so that they can be combined with fast
+# reductions that take the quality plane as a mask rather than with the nan
+# reductions. INVALID marks pixels whose calibrated value was not finite for
+# any other reason, for example because the dark had no valid values there,
+# and which have been set to 0.
+SATURATED = 1
+FLATBAD = 2
+COSMICRAY = 4
+OFFTRIM = 8
+INVALID = 16
+
+# The names of the bits, used in messages.
+names = {
+    SATURATED: "saturated",
+    FLATBAD: "flat-bad",
+    COSMICRAY: "cosmic-ray",
+    OFFTRIM: "off-trim",
+    INVALID: "invalid",
+}
+
+dtype = np.uint8
+
+
+def newquality(shape):
+    """
+    Return a quality plane with all of its pixels good.
+
+    :param shape: The shape of the data.
+    :return: The quality plane.
+    """
+    return np.zeros(shape, dtype=dtype)
+
+
+def setbit(quality, bit, where):
+    """
+    Set a bit of a quality plane in place.
+
+    :param quality: The quality plane.
+    :param bit: The bit.
+    :param where: A boolean array that is true for the pixels to mark.
+    :return: The quality plane.
+    """
+    np.bitwise_or(quality, dtype(bit), out=quality, where=where)
+    return quality
+
+
+def markofftrim(quality, yslice, xslice):
+    """
+    Mark the pixels outside the trim region of an untrimmed frame in place.
+
+    :param quality: The quality plane of the untrimmed frame.
+    :param yslice: The slice of rows of the trim region.
+    :param xslice: The slice of columns of the trim region.
+    :return: The quality plane.
+    """
+    quality |= dtype(OFFTRIM)
+    quality[yslice, xslice] &= dtype(~OFFTRIM & 0xFF)
+    return quality
+
+
+def flatbadmask(flatdata, maskdata=None):
+    """
+    Return the mask of the bad pixels of a flat.
+
+    :param flatdata: The flat.
+    :param maskdata: The mask of the flat, as written by
+        :func:`horno.bake.makeflat`, or ``None``. Defaults to ``None``.
+    :return: A boolean array that is true for the pixels that are masked or
+        for which the flat is not finite.
+    """
+    flatmaskdata = ~np.isfinite(flatdata)
+    if maskdata is not None:
+        flatmaskdata |= maskdata
+    return flatmaskdata
+
+
+def markcosmicrays(
+    data, quality=None, nsigma=5.0, contrast=2.0, nstride=7, name="markcosmicrays"
+):
+    """
+    Mark the cosmic rays in calibrated data.
+
+    A pixel is a cosmic ray if it exceeds the mean of its four neighbours by
+    more than ``nsigma`` times the noise and by more than ``contrast`` times
+    the height of that mean above the background. Stars are sampled over many
+    pixels, so their peaks exceed their neighbours by only a few percent, but
+    cosmic rays are one or two pixels wide. The neighbours of a cosmic ray
+    that are more than ``nsigma`` times the noise above the background are
+    then also marked, to cover the longer tracks. The background and noise
+    are the median and the scaled median absolute deviation of the good pixels
+    in every ``nstride``-th row and column. All of this is a few elementwise
+    passes over the data.
+
+    :param data: The calibrated data.
+    :param quality: The quality plane of the data, which is updated in place,
+        or ``None`` to return a new one. Bad pixels are not used for the
+        background and noise. Defaults to ``None``.
+    :param nsigma: The detection threshold in units of the noise. Defaults to
+        5.0.
+    :param contrast: The minimum ratio of the excess over the neighbours to
+        the height of the neighbours. Defaults to 2.0.
+    :param nstride: The stride of the pixels used for the background and
+        noise. Defaults to 7.
+    :param name: The name used in messages. Defaults to ``"markcosmicrays"``.
+    :return: The quality plane.
+    """
+
+    if quality is None:
+        quality = newquality(data.shape)
+
+    sample = data[::nstride, ::nstride]
+    sample = sample[(quality[::nstride, ::nstride] == 0) & np.isfinite(sample)]
+    if len(sample) == 0:
+        return quality
+    background = np.median(sample)
+    sigma = 1.482602218505602 * np.median(np.abs(sample - background))
+    threshold = np.float32(nsigma * sigma)
+
+    center = data[1:-1, 1:-1]
+    neighbours = data[:-2, 1:-1] + data[2:, 1:-1]
+    neighbours += data[1:-1, :-2]
+    neighbours += data[1:-1, 2:]
+    neighbours *= np.float32(0.25)
+    excess = center - neighbours
+    neighbours -= np.float32(background)
+    neighbours *= np.float32(contrast)
+    hit = (excess > threshold) & (excess > neighbours)
+    del excess
+    del neighbours
+
+    # Grow the hits into their bright neighbours.
+    grown = np.zeros(data.shape, dtype=bool)
+    grown[1:-1, 1:-1] = hit
+    grown[:-2, 1:-1] |= hit
+    grown[2:, 1:-1] |= hit
+    grown[1:-1, :-2] |= hit
+    grown[1:-1, 2:] |= hit
+    grown &= data > np.float32(background) + threshold
+    grown[1:-1, 1:-1] |= hit
+
+    horno.log.info(
+        "%s: marked %d cosmic-ray pixels.", name, int(np.count_nonzero(grown))
+    )
+    return setbit(quality, COSMICRAY, grown)
+
+
+def describe(quality, name="describe", level=horno.log.INFO):
+    """
+    Log the number of pixels with each bit set in a quality plane.
+
+    The counts are taken from a single histogram of the values of the plane.
+    The plane may also be a stack of quality planes, in which case the counts
+    are summed over its frames.
+
+    :param quality: The quality plane.
+    :param name: The name used in messages. Defaults to ``"describe"``.
+    :param level: The level of the message. Defaults to :data:`horno.log.INFO`.
+    :return: A dict of the number of pixels with each bit set, keyed by the
+        names in :data:`names`.
+    """
+    histogram = np.bincount(quality.ravel(), minlength=256)
+    values = np.arange(len(histogram))
+    counts = {names[bit]: int(np.sum(histogram[(values & bit) != 0])) for bit in names}
+    horno.log.log(
+        level,
+        "%s: %s pixels.",
+        name,
+        ", ".join("%d %s" % (count, bitname) for bitname, count in counts.items()),
+    )
+    return counts
@@ -0,0 +1,205 @@
+import warnings
+
+import numpy as np
+
+import horno.image
+
+
+def median(data, mask=None):
+    """
+    Return the exact median of the valid pixels.
+
+    If a mask is given, the data are assumed to be finite, and the median of
+    the unmasked pixels is calculated without the nan handling of
+    :func:`numpy.nanmedian`.
+
+    :param data: The data.
+    :param mask: An array that is nonzero for bad pixels, such as a quality
+        plane, or ``None``. Defaults to ``None``.
+    :return: The median.
+    """
+    if mask is None:
+        return float(np.nanmedian(data))
+    return _maskedmedian(data, mask)
+
+
+def _maskedmedian(data, mask):
+    # Return the median of the finite data that are not masked, or nan if
+    # there are none.
+    data = data[mask == 0]
+    if len(data) == 0:
+        return np.nan
+    return float(np.median(data))
+
+
+def subsampledmedian(data, nstride=3, mask=None):
+    """
+    Return the median of the valid pixels in every ``nstride``-th row and
+    column.
+
+    With the default ``nstride`` of 3, this uses one pixel in 9. An even
+    stride would only use pixels of one polarization channel.
+
+    :param data: The data.
+    :param nstride: The stride in rows and columns. Defaults to 3.
+    :param mask: As for :func:`median`. Defaults to ``None``.
+    :return: The median.
+    """
+    if mask is None:
+        return float(np.nanmedian(data[::nstride, ::nstride]))
+    return _maskedmedian(data[::nstride, ::nstride], mask[::nstride, ::nstride])
+
+
+def histogrammode(data, nstride=1, binwidth=1.0, nsmooth=5, mask=None):
+    """
+    Return the mode of the valid pixels, estimated from their histogram.
+
+    The histogram is accumulated with :func:`numpy.bincount` in bins of
+    ``binwidth`` DN over the range of the central 98% of a sample of the
+    pixels, which takes a few elementwise passes over the data rather than the
+    partial sort of a median. It is smoothed with a boxcar of ``nsmooth``
+    bins, and the mode is refined to a fraction of a bin by fitting a parabola
+    to the peak bin and its two neighbours.
+
+    :param data: The data.
+    :param nstride: The stride in rows and columns. Defaults to 1.
+    :param binwidth: The width of the bins in DN. Defaults to 1.
+    :param nsmooth: The width of the smoothing boxcar in bins. Defaults to 5.
+    :param mask: An array that is nonzero for bad pixels, such as a quality
+        plane, or ``None``. Defaults to ``None``.
+    :return: The mode.
+    """
+    data = data[::nstride, ::nstride]
+    samplestep = (max(1, data.shape[0] // 100), max(1, data.shape[1] // 100))
+    sample = data[:: samplestep[0], :: samplestep[1]]
+    if mask is not None:
+        mask = mask[::nstride, ::nstride]
+        sample = sample[mask[:: samplestep[0], :: samplestep[1]] == 0]
+    if not np.isfinite(sample).any():
+        return np.nan
+    # Ignore the tails, which would otherwise make the histogram very long.
+    lo, hi = np.nanpercentile(sample, [1, 99])
+    lo -= 10 * binwidth
+    hi += 10 * binwidth
+    nbin = int((hi - lo) / binwidth)
+    # Avoid boolean indexing: clamp the tails and invalid pixels into an
+    # underflow bin and an overflow bin, which are then discarded. Note that
+    # np.fmax maps nan to the underflow bin.
+    index = (data - np.float32(lo)) / np.float32(binwidth) + 1
+    np.fmax(index, 0, out=index)
+    np.fmin(index, nbin + 1, out=index)
+    if mask is not None:
+        np.copyto(index, 0, where=mask != 0)
+    histogram = np.bincount(index.astype("int32").ravel(), minlength=nbin + 2)
+    histogram = histogram[1:-1]
+    histogram = np.convolve(histogram, np.ones(nsmooth) / nsmooth, mode="same")
+    ipeak = int(np.argmax(histogram))
+    offset = 0.0
+    if 0 < ipeak < len(histogram) - 1:
+        left, peak, right = histogram[ipeak - 1 : ipeak + 2]
+        denominator = left - 2 * peak + right
+        if denominator != 0:
+            offset = 0.5 * (left - right) / denominator
+    return float(lo + (ipeak + 0.5 + offset) * binwidth)
+
+
+def meshbackground(data, nmesh=128, nsample=3, sigma=3.0, mask=None):
+    """
+    Return a background map from the clipped medians of a mesh of tiles.
+
+    The data are divided into square tiles of ``nmesh`` pixels on a side, and
+    the sigma-clipped medians of every ``nsample``-th pixel of each tile are
+    calculated, a row of tiles at a time, with
+    :func:`horno.image._sigmaclippedstatsblock`. Tiles with no valid pixels
+    take the median of the other tiles. The map is then bilinearly
+    interpolated between the tile centers to the full size of the data. This
+    follows gradients that a single scalar sky cannot.
+
+    If a mask is given, the data are assumed to be finite, and the masked
+    pixels and the padding are passed to the clipping as a mask.
+
+    :param data: The data.
+    :param nmesh: The size of the tiles. Defaults to 128.
+    :param nsample: The stride of the pixels used in each tile. Defaults to 3.
+    :param sigma: The clipping limit in standard deviations. Defaults to 3.
+    :param mask: An array that is nonzero for bad pixels, such as a quality
+        plane, or ``None``. Defaults to ``None``.
+    :return: The background map, with the same shape as the data.
+    """
+
+    ny, nx = data.shape
+    nmeshy = -(-ny // nmesh)
+    nmeshx = -(-nx // nmesh)
+
+    # Pad the data with nan to a whole number of tiles, and arrange the pixels
+    # of each tile along the first axis.
+    padded = np.full((nmeshy * nmesh, nmeshx * nmesh), np.nan, dtype="float32")
+    padded[:ny, :nx] = data
+    tiles = padded.reshape(nmeshy, nmesh, nmeshx, nmesh).transpose(1, 3, 0, 2)
+    tiles = tiles.reshape(nmesh * nmesh, nmeshy, nmeshx)[::nsample]
+    del padded
+    if mask is None:
+        masktiles = None
+    else:
+        padded = np.ones((nmeshy * nmesh, nmeshx * nmesh), dtype=bool)
+        padded[:ny, :nx] = mask != 0
+        masktiles = padded.reshape(nmeshy, nmesh, nmeshx, nmesh).transpose(1, 3, 0, 2)
+        masktiles = masktiles.reshape(nmesh * nmesh, nmeshy, nmeshx)[::nsample]
+        del padded
+
+    mesh = np.empty((nmeshy, nmeshx), dtype="float32")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Warning)
+        for iy in range(nmeshy):
+            mean, mesh[iy : iy + 1], std = horno.image._sigmaclippedstatsblock(
+                tiles[:, iy : iy + 1, :],
+                sigma=sigma,
+                mask=None if masktiles is None else masktiles[:, iy : iy + 1, :],
+            )
+    mesh[np.isnan(mesh)] = np.nanmedian(mesh)
+
+    # The tile centers are at (i + 0.5) * nmesh - 0.5.
+    def weights(n, nmesh, nmeshn):
+        position = np.clip((np.arange(n) + 0.5) / nmesh - 0.5, 0, nmeshn - 1)
+        i0 = np.minimum(position.astype("intp"), max(nmeshn - 2, 0))
+        i1 = np.minimum(i0 + 1, nmeshn - 1)
+        w = (position - i0).astype("float32")
+        return i0, i1, w
+
+    iy0, iy1, wy = weights(ny, nmesh, nmeshy)
+    ix0, ix1, wx = weights(nx, nmesh, nmeshx)
+    rows = (1 - wy)[:, np.newaxis] * mesh[iy0] + wy[:, np.newaxis] * mesh[iy1]
+    background = (1 - wx) * rows[:, ix0] + wx * rows[:, ix1]
+
+    return background.astype("float32")
+
+
+# The sky estimators that can be selected by name in horno.bake.bake.
+methods = {
+    "median": median,
+    "subsampled": subsampledmedian,
+    "histogram": histogrammode,
+    "mesh": meshbackground,
+}
+
+
+def sky(data, method="median", mask=None):
+    """
+    Return the sky of the data, as a scalar or as a map.
+
+    :param data: The data.
+    :param method: The name of one of the estimators in :data:`methods`, or a
+        function that takes the data and returns a scalar or a map. Defaults to
+        ``"median"``.
+    :param mask: An array that is nonzero for bad pixels, such as a quality
+        plane, or ``None``. If it is given, it is passed to the estimator as
+        ``mask``. Defaults to ``None``.
+    :return: The sky.
+    """
+    if not callable(method):
+        if method not in methods:
+            raise RuntimeError("invalid sky method %r." % method)
+        method = methods[method]
+    if mask is None:
+        return method(data)
+    return method(data, mask=mask)
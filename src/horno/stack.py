@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+import horno.log
+
+
+def newstack(nframes, shape, path=None, name=None, dtype="float32"):
+    """
+    Return a new stack of frames.
+
+    A stack is a 3D float32 array of shape ``(nframes, ny, nx)`` into which
+    frames are written one at a time as they are baked, so that the frames
+    never have to be collected in a list and then copied into a single array.
+    The elements are initially undefined. A stack of another type, such as
+    the uint8 quality planes of :mod:`horno.quality`, can be made by giving
+    ``dtype``.
+
+    If ``path`` is ``None``, the stack is an ordinary preallocated ndarray.
+    Otherwise, it is a memory-mapped ndarray backed by an ``.npy`` file at
+    ``path``, so that the memory needed to build it is bounded by the page
+    cache rather than by the number of frames.
+
+    :param nframes: The maximum number of frames in the stack.
+    :param shape: The shape ``(ny, nx)`` of each frame.
+    :param path: The path of the file that backs the stack or ``None``.
+        Defaults to ``None``.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :param dtype: The type of the elements. Defaults to ``"float32"``.
+    :return: The stack.
+    """
+    shape = (nframes,) + tuple(shape)
+    if path is None:
+        if name is not None:
+            horno.log.debug(
+                "%s: allocating stack of %d frames in memory.", name, nframes
+            )
+        stack = np.empty(shape, dtype=dtype)
+    else:
+        if name is not None:
+            horno.log.debug(
+                "%s: allocating stack of %d frames in %s.",
+                name,
+                nframes,
+                os.path.basename(path),
+            )
+        stack = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    return stack
+
+
+def openstack(path, mode="r+", name=None):
+    """
+    Return a memory-mapped stack previously created by :func:`newstack`.
+
+    :param path: The path of the file that backs the stack.
+    :param mode: The mode in which to map the file. Defaults to ``"r+"``.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    :return: The stack.
+    """
+    if name is not None:
+        horno.log.debug("%s: opening stack %s.", name, os.path.basename(path))
+    return np.load(path, mmap_mode=mode)
+
+
+def closestack(stack, delete=True, name=None):
+    """
+    Close a stack.
+
+    If the stack is memory-mapped, it is flushed and, if ``delete`` is true,
+    its backing file is removed. If it is an ordinary ndarray, nothing is
+    done. In either case, the caller should drop its references to the stack
+    after calling this.
+
+    :param stack: The stack.
+    :param delete: Whether to remove the backing file. Defaults to ``True``.
+    :param name: The name used in messages or ``None``. Defaults to ``None``.
+    """
+    if not isinstance(stack, np.memmap):
+        return
+    path = stack.filename
+    stack.flush()
+    if delete and path is not None and os.path.exists(path):
+        if name is not None:
+            horno.log.debug("%s: removing stack %s.", name, os.path.basename(path))
+        os.remove(path)
+    return
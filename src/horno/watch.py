@@ -0,0 +1,567 @@
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import io
+import os
+import select
+import signal
+import struct
+import sys
+import time
+
+import astropy.io.fits
+import numpy as np
+
+import horno.bake
+import horno.calibration
+import horno.display
+import horno.fits
+import horno.instrument
+import horno.log
+import horno.night
+import horno.path
+
+# The suffixes of raw files.
+suffixes = (".fits", ".fits.fz")
+
+# The inotify event masks, from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+
+def _israw(path):
+    return path.endswith(suffixes)
+
+
+def _isnewer(path, otherpath):
+    # Return whether a file exists and was modified after another.
+    try:
+        return os.stat(path).st_mtime_ns >= os.stat(otherpath).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _isinside(path, directory):
+    # Return whether a path is in a directory or its subdirectories.
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+class InotifyWatcher:
+    """
+    A watcher of a directory tree that reports raw files when their writers
+    close them, using the Linux inotify interface through :mod:`ctypes`.
+
+    Subdirectories, such as the dated directories of each night, are watched
+    as soon as they are created. Raw files in a subdirectory that is moved
+    into the tree are reported when it is moved, since they are complete.
+    Raw files that are written in a new subdirectory before its watch is
+    added are found when it is added, and are reported when they are closed
+    or, if they were closed before the watch was added, once their size and
+    modification time have not changed for ``interval`` seconds, as by
+    :class:`PollingWatcher`. Each file is reported only once.
+
+    :param directory: The directory.
+    :param interval: The time in seconds for which the size and modification
+        time of a file found in a new subdirectory must not change. Defaults
+        to 1.
+    """
+
+    def __init__(self, directory, interval=1.0):
+        libcpath = ctypes.util.find_library("c")
+        if libcpath is None:
+            raise OSError("libc not found.")
+        self._libc = ctypes.CDLL(libcpath, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available.")
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+        self._interval = interval
+        self._directories = {}
+        self._pending = []
+        self._candidates = {}
+        self._reported = set()
+        self._addtree(directory, doreport=False)
+
+    def _addtree(self, directory, doreport=True, docandidates=False):
+        # Watch a directory tree. Its existing raw files are reported if
+        # doreport is true, or become candidates if docandidates is true.
+        for path, dirnames, filenames in os.walk(directory):
+            wd = self._libc.inotify_add_watch(
+                self._fd,
+                os.fsencode(path),
+                _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE,
+            )
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed.")
+            self._directories[wd] = path
+            fitspaths = [
+                os.path.join(path, filename)
+                for filename in sorted(filenames)
+                if _israw(filename)
+            ]
+            if doreport:
+                self._pending += fitspaths
+            elif docandidates:
+                for fitspath in fitspaths:
+                    self._candidates.setdefault(fitspath, (None, 0.0))
+
+    def _checkcandidates(self):
+        # Report the candidates whose size and modification time have not
+        # changed for the interval.
+        now = time.monotonic()
+        for fitspath, (previous, since) in list(self._candidates.items()):
+            try:
+                stat = os.stat(fitspath)
+            except FileNotFoundError:
+                del self._candidates[fitspath]
+                continue
+            stat = (stat.st_size, stat.st_mtime_ns)
+            if stat != previous:
+                self._candidates[fitspath] = (stat, now)
+            elif now - since >= self._interval:
+                self._pending.append(fitspath)
+
+    def fileno(self):
+        return self._fd
+
+    def read(self, timeout):
+        """
+        Return the raw files that have been completed, waiting for at most
+        ``timeout`` seconds if there are none.
+
+        :param timeout: The timeout in seconds.
+        :return: A list of paths.
+        """
+        if len(self._pending) == 0:
+            if len(self._candidates) > 0:
+                timeout = min(timeout, self._interval / 4)
+            select.select([self._fd], [], [], timeout)
+        try:
+            buffer = os.read(self._fd, 65536)
+        except BlockingIOError:
+            buffer = b""
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = struct.unpack_from("iIII", buffer, offset)
+            offset += struct.calcsize("iIII")
+            filename = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                horno.log.warning(
+                    "WARNING: inotify queue overflowed; some files may be missed."
+                )
+                continue
+            if wd not in self._directories:
+                continue
+            path = os.path.join(self._directories[wd], filename)
+            if mask & _IN_ISDIR:
+                # Files in a new directory may still be open, so they are
+                # reported when they are closed, as the directory is now
+                # watched, or, since they may already have been closed, when
+                # they are stable. Files in a moved directory are reported
+                # now.
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._addtree(
+                        path,
+                        doreport=bool(mask & _IN_MOVED_TO),
+                        docandidates=bool(mask & _IN_CREATE),
+                    )
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO) and _israw(filename):
+                self._pending.append(path)
+        self._checkcandidates()
+        paths = []
+        for path in self._pending:
+            if path not in self._reported:
+                self._reported.add(path)
+                self._candidates.pop(path, None)
+                paths.append(path)
+        self._pending = []
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    A watcher of a directory tree that reports raw files by polling.
+
+    A file is reported when its size and modification time are the same in
+    two successive polls, so a file that is still being written is not
+    reported.
+
+    :param directory: The directory.
+    :param interval: The interval between polls in seconds. Defaults to 1.
+    """
+
+    def __init__(self, directory, interval=1.0):
+        self._directory = directory
+        self._interval = interval
+        self._candidates = {}
+        self._seen = set(self._scan())
+        self._lastpoll = 0.0
+
+    def _scan(self):
+        result = {}
+        for path, dirnames, filenames in os.walk(self._directory):
+            for filename in filenames:
+                if _israw(filename):
+                    fitspath = os.path.join(path, filename)
+                    try:
+                        stat = os.stat(fitspath)
+                    except FileNotFoundError:
+                        continue
+                    result[fitspath] = (stat.st_size, stat.st_mtime_ns)
+        return result
+
+    def fileno(self):
+        return None
+
+    def read(self, timeout):
+        """
+        Return the raw files that have been completed, waiting for at most
+        ``timeout`` seconds.
+
+        :param timeout: The timeout in seconds.
+        :return: A list of paths.
+        """
+        delay = self._lastpoll + self._interval - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+            if delay > timeout:
+                return []
+        self._lastpoll = time.monotonic()
+        paths = []
+        for fitspath, stat in self._scan().items():
+            if fitspath in self._seen:
+                continue
+            if self._candidates.get(fitspath) == stat:
+                paths.append(fitspath)
+                self._seen.add(fitspath)
+                del self._candidates[fitspath]
+            else:
+                self._candidates[fitspath] = stat
+        return sorted(paths)
+
+    def close(self):
+        pass
+
+
+def watcher(directory, dopoll=False, interval=1.0):
+    """
+    Return a watcher of a directory tree for completed raw files.
+
+    This is an :class:`InotifyWatcher` if inotify is available and
+    ``dopoll`` is false, and otherwise a :class:`PollingWatcher`.
+
+    :param directory: The directory.
+    :param dopoll: Whether to poll even if inotify is available. Defaults to
+        ``False``.
+    :param interval: The interval between polls in seconds, or for an
+        :class:`InotifyWatcher` the time for which files found in a new
+        subdirectory must be stable. Defaults to 1.
+    :return: The watcher.
+    """
+    if not dopoll:
+        try:
+            return InotifyWatcher(directory, interval=interval)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory, interval=interval)
+
+
+# The calibration store of this process.
+_calibration = None
+
+
+def _initwatchworker(darkpath, flatpath, exposuretimes, loglevel, isprocess):
+    # Create the calibration store of a worker and read the masters for the
+    # expected exposure times, so that the first frame does not wait for them.
+    # Worker processes ignore interrupts, which are handled by the parent, and
+    # run without a display.
+    global _calibration
+    if isprocess:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        horno.display.disable()
+    horno.log.setlevel(loglevel)
+    _calibration = horno.calibration.CalibrationStore(
+        darkpath=darkpath, flatpath=flatpath, name="watch"
+    )
+    for exposuretime in exposuretimes:
+        header = astropy.io.fits.Header()
+        header.append(("EXPTIME", exposuretime))
+        with contextlib.suppress(RuntimeError):
+            _calibration.dark(header)
+        with contextlib.suppress(RuntimeError):
+            _calibration.flat(header)
+
+
+def _warmwatchworker():
+    # Return after a short delay, so that each of the warm-up tasks submitted
+    # when the pool is created starts a separate worker.
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def _watchworker(fitspath, productpath, doreturn, docapture):
+    # Bake an object frame and optionally write it. Return the messages, the
+    # header, and, if doreturn is true, the data, or None for the header if
+    # the frame is not an object. The messages are captured only if docapture
+    # is true, in a worker process, since redirecting sys.stdout in a thread
+    # would also capture the messages of the main thread.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log) if docapture else contextlib.nullcontext():
+        header = horno.fits.readrawheader(fitspath)
+        if horno.night.imagekind(horno.instrument.imagetype(header)) != "object":
+            horno.log.info("watch: ignoring %s.", os.path.basename(fitspath))
+            return log.getvalue(), None, None
+        if productpath is not None and os.path.realpath(
+            productpath
+        ) == os.path.realpath(fitspath):
+            horno.log.error(
+                "ERROR: the product of %s would overwrite it.",
+                os.path.basename(fitspath),
+            )
+            return log.getvalue(), None, None
+        header, data = horno.bake.bake(
+            fitspath,
+            name="watch",
+            dotrim=True,
+            dodark=True,
+            doflat=True,
+            calibration=_calibration,
+        )
+        if productpath is not None:
+            horno.fits.writeproduct(
+                productpath,
+                data,
+                name="watch",
+                filter=horno.instrument.filter(header),
+                exposuretime=horno.instrument.exposuretime(header),
+            )
+    return log.getvalue(), header, data if doreturn else None
+
+
+def watch(
+    directory,
+    outputpath=".",
+    productpath="{stem}.fits",
+    callback=None,
+    darkpath="dark-{exposuretime:.0f}.fits",
+    flatpath="flat.fits",
+    exposuretimes=(),
+    workers=None,
+    dopoll=False,
+    interval=1.0,
+    maxlatency=None,
+    nframes=None,
+    idletimeout=None,
+    source=None,
+    products=(),
+    name="watch",
+):
+    """
+    Bake object frames as they arrive in a directory tree.
+
+    New raw files are detected by :func:`watcher`, which uses inotify where
+    it is available and otherwise polls. Each object frame is baked with the
+    masters from a :class:`horno.calibration.CalibrationStore` and written
+    as a product, passed to ``callback``, or both. Other frames are ignored,
+    as are the products and any output directory inside ``directory``. A
+    frame whose product would overwrite it is not reduced.
+
+    To avoid paying startup costs for each frame, the frames are baked in a
+    pool of ``workers`` processes that is started and warmed before the first
+    frame arrives, and each worker reads the masters for ``exposuretimes``
+    when it starts and keeps them. If ``workers`` is ``None``, the frames are
+    baked in this process instead, with the same preloading.
+
+    For each frame, the latency from the last modification of the raw file,
+    which is when the executor finished writing it, to the end of the
+    reduction is printed, together with the part of it spent before the
+    file was detected. A warning is printed if the latency exceeds
+    ``maxlatency``.
+
+    The watch continues until ``nframes`` objects have been reduced, until
+    no files have arrived for ``idletimeout`` seconds, or until it is
+    interrupted.
+
+    :param directory: The directory to watch, for example the directory of
+        the images of the executor.
+    :param outputpath: The directory of the products. Defaults to ``"."``.
+    :param productpath: The path template of the products, relative to
+        ``outputpath``, formatted with ``stem`` as for
+        :func:`horno.path.stem` relative to ``directory``, or ``None`` to
+        not write products. Defaults to ``"{stem}.fits"``.
+    :param callback: A function called as ``callback(fitspath, header, data)``
+        in this process for each baked frame, or ``None``. Defaults to
+        ``None``.
+    :param darkpath: The path template of the master darks. Defaults to
+        ``"dark-{exposuretime:.0f}.fits"``.
+    :param flatpath: The path template of the master flats. Defaults to
+        ``"flat.fits"``.
+    :param exposuretimes: The exposure times whose masters are preloaded.
+        Defaults to ``()``.
+    :param workers: The number of worker processes, or ``None``. Defaults to
+        ``None``.
+    :param dopoll: As for :func:`watcher`. Defaults to ``False``.
+    :param interval: As for :func:`watcher`. Defaults to 1.
+    :param maxlatency: The latency in seconds above which to warn, or
+        ``None``. Defaults to ``None``.
+    :param nframes: The number of objects after which to stop, or ``None``.
+        Defaults to ``None``.
+    :param idletimeout: The time in seconds without new files after which to
+        stop, or ``None``. Defaults to ``None``.
+    :param source: A watcher from :func:`watcher`, which is closed when the
+        watch finishes, or ``None`` to create one once the workers have
+        started. The files that exist when a watcher is created are not
+        reported, so a caller that reduces the existing files first creates
+        the watcher before it lists them. Frames whose products are newer
+        than them have already been reduced and are not reduced again.
+        Defaults to ``None``.
+    :param products: The paths of products already written in the watched
+        directory, for example by :func:`horno.night.run`, which are ignored
+        as are the products of the watch. Defaults to ``()``.
+    :param name: The name used in messages. Defaults to ``"watch"``.
+    :return: A dict mapping the path of each reduced frame to its latency in
+        seconds.
+    """
+
+    horno.log.info("%s: watching %s.", name, directory)
+
+    loglevel = horno.log.level
+    if workers is None:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        _initwatchworker(darkpath, flatpath, exposuretimes, loglevel, False)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initwatchworker,
+            initargs=(darkpath, flatpath, exposuretimes, loglevel, True),
+        )
+        concurrent.futures.wait(
+            [executor.submit(_warmwatchworker) for i in range(workers)]
+        )
+        horno.log.info("%s: started %d workers.", name, workers)
+
+    if source is None:
+        source = watcher(directory, dopoll=dopoll, interval=interval)
+    horno.log.info("%s: using %s.", name, type(source).__name__)
+
+    # The products written into the watched tree are reported as new files,
+    # so they are ignored, as is an output directory inside the tree.
+    output = os.path.realpath(outputpath)
+    isoutputinside = output != os.path.realpath(directory) and _isinside(
+        output, directory
+    )
+    products = set(os.path.realpath(path) for path in products)
+
+    latencies = {}
+    running = {}
+    lastarrival = time.time()
+
+    try:
+        while nframes is None or len(latencies) < nframes:
+
+            for fitspath in source.read(0.1 if len(running) > 0 else 0.5):
+                if os.path.realpath(fitspath) in products or (
+                    isoutputinside and _isinside(fitspath, output)
+                ):
+                    continue
+                detected = time.time()
+                lastarrival = detected
+                if productpath is None:
+                    path = None
+                else:
+                    path = os.path.join(
+                        outputpath,
+                        productpath.format(stem=horno.path.stem(fitspath, directory)),
+                    )
+                    # A product that would overwrite its frame is reported
+                    # by the worker once it has read the image type.
+                    if os.path.realpath(path) != os.path.realpath(fitspath):
+                        products.add(os.path.realpath(path))
+                        if _isnewer(path, fitspath):
+                            horno.log.info(
+                                "%s: %s: already reduced.",
+                                name,
+                                os.path.basename(fitspath),
+                            )
+                            continue
+                future = executor.submit(
+                    _watchworker,
+                    fitspath,
+                    path,
+                    callback is not None,
+                    workers is not None,
+                )
+                running[future] = (fitspath, detected)
+
+            for future in [future for future in running if future.done()]:
+                fitspath, detected = running.pop(future)
+                try:
+                    log, header, data = future.result()
+                except Exception as exception:
+                    horno.log.error(
+                        "ERROR: %s: %s", os.path.basename(fitspath), exception
+                    )
+                    continue
+                sys.stdout.write(log)
+                if header is None:
+                    continue
+                if callback is not None:
+                    callback(fitspath, header, data)
+                finished = time.time()
+                latency = finished - os.stat(fitspath).st_mtime
+                latencies[fitspath] = latency
+                horno.log.info(
+                    "%s: %s: latency %.2f s, of which %.2f s before detection.",
+                    name,
+                    os.path.basename(fitspath),
+                    latency,
+                    latency - (finished - detected),
+                )
+                if maxlatency is not None and latency > maxlatency:
+                    horno.log.warning(
+                        "WARNING: latency of %.2f s exceeds %.2f s.",
+                        latency,
+                        maxlatency,
+                    )
+
+            if (
+                idletimeout is not None
+                and len(running) == 0
+                and time.time() - lastarrival > idletimeout
+            ):
+                horno.log.info("%s: no new files for %.0f s.", name, idletimeout)
+                break
+
+    except KeyboardInterrupt:
+        horno.log.info("%s: interrupted.", name)
+
+    finally:
+        source.close()
+        executor.shutdown(cancel_futures=True)
+
+    if len(latencies) > 0:
+        values = np.array(list(latencies.values()))
+        horno.log.info(
+            "%s: reduced %d frames with median latency %.2f s and maximum %.2f s.",
+            name,
+            len(values),
+            np.median(values),
+            np.max(values),
+        )
+
+    horno.log.info("%s: finished.", name)
+
+    return latencies
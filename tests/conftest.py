@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The package is not installed, so import it from the source tree.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("HORNO_HEADLESS", "1")
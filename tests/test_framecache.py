@@ -0,0 +1,76 @@
+import functools
+
+import astropy.io.fits
+import numpy as np
+import pytest
+
+import horno.bake
+import horno.fits
+import horno.framecache
+import horno.sky
+
+
+def _writeraw(path, seed):
+    rng = np.random.default_rng(seed)
+    data = rng.integers(100, 200, size=(32, 32)).astype("uint16")
+    header = astropy.io.fits.Header()
+    header["EXPTIME"] = 10.0
+    astropy.io.fits.PrimaryHDU(data, header).writeto(path)
+
+
+@pytest.fixture
+def rawpaths(tmp_path):
+    paths = [str(tmp_path / ("raw%d.fits" % i)) for i in range(4)]
+    for i, path in enumerate(paths):
+        _writeraw(path, i)
+    horno.bake.usefakedark()
+    horno.bake.usefakeflat()
+    return paths
+
+
+def test_prefetchskipscachedfiles(tmp_path, rawpaths, monkeypatch):
+    cache = horno.framecache.FrameCache(str(tmp_path / "cache"))
+    cold = [data.copy() for header, data in horno.bake.bakelist(rawpaths, cache=cache)]
+
+    calls = []
+    readrawnative = horno.fits.readrawnative
+
+    def countingreadrawnative(fitspath, *args, **kwargs):
+        calls.append(fitspath)
+        return readrawnative(fitspath, *args, **kwargs)
+
+    monkeypatch.setattr(horno.fits, "readrawnative", countingreadrawnative)
+    warm = list(horno.bake.bakelist(rawpaths, prefetch=1, cache=cache))
+    assert calls == []
+    for data, (header, cacheddata) in zip(cold, warm):
+        assert isinstance(cacheddata, np.memmap)
+        assert np.array_equal(data, cacheddata)
+
+
+def test_partialskymethod(tmp_path, rawpaths):
+    cache = horno.framecache.FrameCache(str(tmp_path / "cache"))
+    results = {}
+    for nstride in [3, 5]:
+        skymethod = functools.partial(horno.sky.subsampledmedian, nstride=nstride)
+        for i in range(2):
+            header, data = horno.bake.bake(
+                rawpaths[0], dosky=True, skymethod=skymethod, cache=cache
+            )
+            results[nstride, i] = np.array(data)
+    assert len(cache._entries()) == 2
+    for nstride in [3, 5]:
+        header, data = horno.bake.bake(
+            rawpaths[0],
+            dosky=True,
+            skymethod=functools.partial(horno.sky.subsampledmedian, nstride=nstride),
+        )
+        assert np.array_equal(results[nstride, 0], data)
+        assert np.array_equal(results[nstride, 1], data)
+
+
+def test_lambdaskymethod(tmp_path, rawpaths):
+    cache = horno.framecache.FrameCache(str(tmp_path / "cache"))
+    with pytest.raises(RuntimeError, match="cannot cache"):
+        horno.bake.bake(
+            rawpaths[0], dosky=True, skymethod=lambda data: 0.0, cache=cache
+        )
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import horno.image
+
+
+def _stack(nframes, seed=0):
+    # A stack with noise, outliers, scattered NaNs, an all-NaN pixel, and a
+    # constant pixel.
+    rng = np.random.default_rng(seed)
+    data = rng.normal(1000, 10, size=(nframes, 20, 24)).astype("float32")
+    outliers = rng.random(data.shape) < 0.05
+    data[outliers] += rng.choice([-1, 1], size=np.count_nonzero(outliers)) * 500
+    data[rng.random(data.shape) < 0.05] = np.nan
+    data[:, 3, 4] = np.nan
+    data[:, 5, 6] = 1234.0
+    return data
+
+
+def _assertclose(actual, expected):
+    # The absolute tolerance, which is far below the float32 rounding of the
+    # data, allows for the standard deviations of pixels with only a few
+    # nearly equal values left after clipping.
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, rtol=1e-5, atol=1e-6, equal_nan=True)
+
+
+@pytest.mark.parametrize("nframes", [1, 2, 3, 4, 5, 8, 11, 20, 51])
+def test_sigmaclippedstats(nframes):
+    data = _stack(nframes)
+    _assertclose(
+        horno.image.sigmaclippedstats(data, axis=0, method="numpy", nblock=7),
+        horno.image.sigmaclippedstats(data, axis=0, method="astropy"),
+    )
+
+
+@pytest.mark.parametrize("nframes", [1, 5, 51])
+def test_sigmaclippedstatsmask(nframes):
+    data = _stack(nframes, seed=1)
+    mask = ~np.isfinite(data)
+    data[mask] = 0
+    _assertclose(
+        horno.image.sigmaclippedstats(data, axis=0, method="numpy", mask=mask),
+        horno.image.sigmaclippedstats(data, axis=0, method="astropy", mask=mask),
+    )
@@ -0,0 +1,68 @@
+import os
+
+import astropy.io.fits
+import numpy as np
+
+import horno.night
+
+
+def _writeraw(path, imagetype=None, exposuretime=None):
+    header = astropy.io.fits.Header()
+    if imagetype is not None:
+        header["IMAGETYP"] = imagetype
+    if exposuretime is not None:
+        header["EXPTIME"] = exposuretime
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = np.zeros((8, 8), dtype="uint16")
+    astropy.io.fits.PrimaryHDU(data, header).writeto(path)
+
+
+def test_scanignoresproducts(tmp_path):
+    nightpath = str(tmp_path)
+    _writeraw(os.path.join(nightpath, "raw", "dark.fits"), "dark", 10.0)
+    _writeraw(os.path.join(nightpath, "raw", "flat.fits"), "flat", 10.0)
+    _writeraw(os.path.join(nightpath, "raw", "object.fits"), "object", 10.0)
+    expected = {"dark-10", "flat", "object:raw-object"}
+    assert set(horno.night.scan(nightpath, nightpath)) == expected
+
+    # The products, which have no image type or exposure time, in the night.
+    _writeraw(os.path.join(nightpath, "dark-10.fits"))
+    _writeraw(os.path.join(nightpath, "flat.fits"))
+    _writeraw(os.path.join(nightpath, "raw-object.fits"))
+    assert set(horno.night.scan(nightpath, nightpath)) == expected
+    assert set(horno.night.scan(nightpath, nightpath)) == expected
+
+
+def test_scanmissingexposuretime(tmp_path):
+    nightpath = str(tmp_path / "night")
+    _writeraw(os.path.join(nightpath, "dark.fits"), "dark", 10.0)
+    _writeraw(os.path.join(nightpath, "flat.fits"), "flat", 10.0)
+    _writeraw(os.path.join(nightpath, "object.fits"), "object")
+    nodes = horno.night.scan(nightpath, str(tmp_path))
+    assert set(nodes) == {"dark-10", "flat"}
+
+
+def test_scansubdirectories(tmp_path):
+    nightpath = str(tmp_path / "night")
+    _writeraw(os.path.join(nightpath, "dark.fits"), "dark", 10.0)
+    _writeraw(os.path.join(nightpath, "flat.fits"), "flat", 10.0)
+    _writeraw(os.path.join(nightpath, "a", "object.fits"), "object", 10.0)
+    _writeraw(os.path.join(nightpath, "b", "object.fits"), "object", 10.0)
+    nodes = horno.night.scan(nightpath, str(tmp_path))
+    assert set(nodes) == {"dark-10", "flat", "object:a-object", "object:b-object"}
+    assert nodes["object:a-object"]["product"] == str(tmp_path / "a-object.fits")
+    assert nodes["object:b-object"]["product"] == str(tmp_path / "b-object.fits")
+
+
+def test_scanreservednames(tmp_path):
+    nightpath = str(tmp_path / "night")
+    _writeraw(os.path.join(nightpath, "dark.fits"), "dark", 10.0)
+    _writeraw(os.path.join(nightpath, "flat.fits"), "flat", 10.0)
+    _writeraw(os.path.join(nightpath, "object", "flat.fits"), "object", 10.0)
+    _writeraw(os.path.join(nightpath, "object-flat.fits"), "object", 10.0)
+    _writeraw(os.path.join(nightpath, "dark-10.fits"), "object", 10.0)
+    nodes = horno.night.scan(nightpath, str(tmp_path))
+    assert nodes["flat"]["product"] == str(tmp_path / "flat.fits")
+    assert nodes["dark-10"]["product"] == str(tmp_path / "dark-10.fits")
+    assert len(nodes) == 3
+    assert nodes["object:object-flat"]["product"] == str(tmp_path / "object-flat.fits")
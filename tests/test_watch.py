@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+import astropy.io.fits
+import numpy as np
+import pytest
+
+import horno.watch
+
+
+def _collect(watcher, n, timeout=10.0):
+    # Return the paths reported by a watcher until n have been reported or
+    # the timeout has passed.
+    paths = []
+    deadline = time.monotonic() + timeout
+    while len(paths) < n and time.monotonic() < deadline:
+        paths += watcher.read(0.1)
+    # Give the watcher a chance to report anything twice.
+    paths += watcher.read(0.5)
+    return paths
+
+
+def _write(path):
+    with open(path, "wb") as f:
+        f.write(b"\0" * 2880)
+
+
+@pytest.mark.parametrize("dopoll", [False, True])
+def test_newdirectory(tmp_path, dopoll):
+    # A file written and closed in a new directory before the watcher has seen
+    # the directory must still be reported, and only once.
+    watcher = horno.watch.watcher(str(tmp_path), dopoll=dopoll, interval=0.2)
+    if not dopoll and not isinstance(watcher, horno.watch.InotifyWatcher):
+        pytest.skip("inotify is not available.")
+    try:
+        directory = tmp_path / "20240101"
+        os.mkdir(directory)
+        _write(directory / "x0.fits")
+        watcher.read(0)
+        _write(directory / "x1.fits")
+        paths = _collect(watcher, 2)
+    finally:
+        watcher.close()
+    assert sorted(paths) == [str(directory / "x0.fits"), str(directory / "x1.fits")]
+
+
+def test_closedfile(tmp_path):
+    # A file closed in a watched directory is reported once.
+    watcher = horno.watch.watcher(str(tmp_path), interval=0.2)
+    try:
+        _write(tmp_path / "x0.fits.fz")
+        _write(tmp_path / "notraw.txt")
+        paths = _collect(watcher, 1)
+    finally:
+        watcher.close()
+    assert paths == [str(tmp_path / "x0.fits.fz")]
+
+
+def _watchwhilewriting(paths, write=None, **kwargs):
+    # Watch a directory while the files are written.
+    if write is None:
+        write = _write
+
+    def writeall():
+        time.sleep(0.5)
+        for path in paths:
+            write(path)
+
+    thread = threading.Thread(target=writeall)
+    thread.start()
+    try:
+        horno.watch.watch(dopoll=True, interval=0.2, idletimeout=2.0, **kwargs)
+    finally:
+        thread.join()
+
+
+def test_watchdoesnotoverwrite(tmp_path, capsys):
+    # A raw object frame whose product would overwrite it is not reduced.
+    rawpath = tmp_path / "x.fits"
+    header = astropy.io.fits.Header()
+    header["IMAGETYP"] = "object"
+    astropy.io.fits.PrimaryHDU(np.zeros((8, 8), dtype="uint16"), header).writeto(
+        tmp_path / "object.fits"
+    )
+
+    def write(path):
+        os.replace(tmp_path / "object.fits", path)
+
+    before = (tmp_path / "object.fits").read_bytes()
+    _watchwhilewriting(
+        [rawpath], write=write, directory=str(tmp_path), outputpath=str(tmp_path)
+    )
+    assert rawpath.read_bytes() == before
+    assert "the product of x.fits would overwrite it" in capsys.readouterr().out
+
+
+def test_watchignoresoutput(tmp_path, capsys):
+    # Files in an output directory inside the watched directory are ignored.
+    outputpath = tmp_path / "products"
+    os.mkdir(outputpath)
+    _watchwhilewriting(
+        [outputpath / "y.fits"], directory=str(tmp_path), outputpath=str(outputpath)
+    )
+    assert "y.fits" not in capsys.readouterr().out
+
+
+def test_watchsource(tmp_path, capsys):
+    # A watcher created before the watch starts reports the files written in
+    # between.
+    source = horno.watch.watcher(str(tmp_path), dopoll=True, interval=0.2)
+    _write(tmp_path / "x.fits")
+    horno.watch.watch(
+        str(tmp_path),
+        productpath=None,
+        source=source,
+        interval=0.2,
+        idletimeout=1.0,
+    )
+    assert "x.fits" in capsys.readouterr().out